@@ -1,16 +1,35 @@
 from django.apps import AppConfig
-from api.utils import change_api_updated_at
-from django.db.models.signals import post_delete, post_save
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save, pre_save
 
 
 class ApiConfig(AppConfig):
     name = 'api'
 
     def ready(self):
+        from api import authentication, geo
+        from api.utils import (
+            invalidate_tourpoint, invalidate_user, record_tombstone,
+            remember_tourpoint_scopes)
+
         # auth.User signals
-        post_save.connect(receiver=change_api_updated_at, sender='auth.User', dispatch_uid='F8423A12-676D-4111-BCF2-809F1DAB8C25')
-        post_delete.connect(receiver=change_api_updated_at, sender='auth.User' dispatch_uid='A7517433-72FE-4250-AB61-7DE2242C31C9')
+        post_save.connect(receiver=invalidate_user, sender='auth.User', dispatch_uid='F8423A12-676D-4111-BCF2-809F1DAB8C25')
+        post_delete.connect(receiver=invalidate_user, sender='auth.User', dispatch_uid='A7517433-72FE-4250-AB61-7DE2242C31C9')
+
+        # cached authentication
+        post_save.connect(receiver=authentication.forget_user, sender='auth.User', dispatch_uid='5D0E8B7A-2C4F-4A91-B6E3-9F1C7A2D4E86')
+        post_delete.connect(receiver=authentication.forget_user, sender='auth.User', dispatch_uid='C4A7E1F9-8B3D-4E62-A05C-3D9F6B1E7A24')
+        post_delete.connect(receiver=authentication.forget_token, sender='authtoken.Token', dispatch_uid='9E2B6F4D-1A7C-4C38-8D5E-B0F3A9C6E172')
+        user_logged_out.connect(receiver=authentication.forget_logged_out_user, dispatch_uid='2F8C5A1E-7D3B-4B96-9E40-A6C1D8F2B53E')
 
         # tourpoint.TourPoint signals
-        post_save.connect(receiver=change_api_updated_at, sender='tourpoint.TourPoint', dispatch_uid='3F4CF5F2-E961-4822-9D6B-A03E46864B59')
-        post_delete.connect(receiver=change_api_updated_at, sender='tourpoint.TourPoint', dispatch_uid='462BCF38-3C0E-4071-BD2C-64286A1F4AD5')
\ No newline at end of file
+        pre_save.connect(receiver=remember_tourpoint_scopes, sender='tourpoint.TourPoint', dispatch_uid='0C0B6C8E-3A57-4F0C-9E59-2B1E55C0E0A4')
+        post_save.connect(receiver=invalidate_tourpoint, sender='tourpoint.TourPoint', dispatch_uid='3F4CF5F2-E961-4822-9D6B-A03E46864B59')
+        post_delete.connect(receiver=invalidate_tourpoint, sender='tourpoint.TourPoint', dispatch_uid='462BCF38-3C0E-4071-BD2C-64286A1F4AD5')
+        post_save.connect(receiver=record_tombstone, sender='tourpoint.TourPoint', dispatch_uid='5A3E9C71-2D8B-4F06-B4E1-7C92D0A6F318')
+        post_delete.connect(receiver=record_tombstone, sender='tourpoint.TourPoint', dispatch_uid='E81F4B26-9C5A-4D37-8B0E-3F6A1C7D9E42')
+
+        # in memory geo search engine
+        post_save.connect(receiver=geo.update_tourpoint, sender='tourpoint.TourPoint', dispatch_uid='7D1E4A52-1C4B-4E8B-A2F7-5B8C3E9D0F61')
+        post_delete.connect(receiver=geo.remove_tourpoint, sender='tourpoint.TourPoint', dispatch_uid='B3A9F0C4-6E2D-4F7A-9C1B-8D5E2F4A7C30')
+        post_save.connect(receiver=geo.update_username, sender='auth.User', dispatch_uid='E6C2D8A1-9F3B-4D5E-8A7C-1B4F6E9D2A53')
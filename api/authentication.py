@@ -0,0 +1,85 @@
+from allauth.account.auth_backends import AuthenticationBackend
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+
+TOKEN_KEY_PREFIX = 'api:token:'
+USER_KEY_PREFIX = 'api:user:'
+
+
+def get_cached_user(pk):
+    """
+    The user with a primary key, from the cache when possible. None when it
+    doesn't exist.
+    """
+    key = USER_KEY_PREFIX + str(pk)
+    user = cache.get(key)
+    if user is None:
+        user = get_user_model()._default_manager.filter(pk=pk).first()
+        if user is not None:
+            cache.set(key, user, settings.AUTH_CACHE_TIMEOUT)
+    return user
+
+
+def forget_user(sender=None, instance=None, *args, **kwargs):
+    cache.delete(USER_KEY_PREFIX + str(instance.pk))
+
+
+def forget_token(sender=None, instance=None, *args, **kwargs):
+    cache.delete(TOKEN_KEY_PREFIX + instance.key)
+
+
+def forget_logged_out_user(sender=None, request=None, user=None, *args,
+                           **kwargs):
+    if user is not None:
+        forget_user(instance=user)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication resolving the token to its user through the cache,
+    so an authenticated request doesn't take any query. Tokens are dropped
+    from the cache when deleted, users when saved, deleted or logged out.
+    """
+
+    def authenticate_credentials(self, key):
+        model = self.get_model()
+        cache_key = TOKEN_KEY_PREFIX + key
+        user_pk = cache.get(cache_key)
+        if user_pk is None:
+            user_pk = model.objects.filter(key=key).values_list(
+                'user_id', flat=True).first()
+            if user_pk is None:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            cache.set(cache_key, user_pk, settings.AUTH_CACHE_TIMEOUT)
+
+        user = get_cached_user(user_pk)
+        if user is None or not user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.'))
+        return (user, model(key=key, user=user))
+
+
+class CachedUserMixin(object):
+    """
+    Load the user of a session through the cache.
+    """
+
+    def get_user(self, user_id):
+        user = get_cached_user(user_id)
+        if user is not None and self.user_can_authenticate(user):
+            return user
+        return None
+
+
+class CachedModelBackend(CachedUserMixin, ModelBackend):
+    pass
+
+
+class CachedAuthenticationBackend(CachedUserMixin, AuthenticationBackend):
+    pass
@@ -0,0 +1,127 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from elasticsearch import exceptions
+from api import metrics
+from api.search_backends import failing_loudly
+
+
+BREAKER_KEY_PREFIX = 'api:breaker:'
+STATES = ('closed', 'open', 'half_open')
+
+
+def is_outage(error):
+    """
+    Whether an Elasticsearch error means it is down or overloaded, rather
+    than a bad request.
+    """
+    if isinstance(error, exceptions.ConnectionError):
+        return True
+    return (isinstance(error.status_code, int) and
+            (error.status_code >= 500 or error.status_code == 429))
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a service that keeps failing. Every process shares the
+    state through the cache.
+
+    After `failures` outages within `window` seconds the circuit opens and
+    calls go to the fallback for `reset` seconds. Then it is half open, a
+    single call tries the service again, closing the circuit when it works
+    and opening it again when it doesn't.
+    """
+
+    def __init__(self, name, failures, window, reset):
+        self.name = name
+        self.failures, self.window, self.reset = failures, window, reset
+        self.key = BREAKER_KEY_PREFIX + name + ':'
+
+    @property
+    def metrics(self):
+        return tuple('breaker.%s.%s' % (self.name, event)
+                     for event in ('failure', 'opened', 'fallback'))
+
+    def state(self):
+        open_until = cache.get(self.key + 'open_until')
+        if open_until is None:
+            return 'closed'
+        return 'open' if time.time() < open_until else 'half_open'
+
+    def call(self, func, fallback):
+        """
+        `func()`, or `fallback()` when the circuit is open or `func` fails
+        with an outage.
+        """
+        state = self.state()
+        if state == 'open' or (state == 'half_open' and not cache.add(
+                self.key + 'trial', True, self.reset)):
+            metrics.incr('breaker.%s.fallback' % self.name)
+            return fallback()
+        try:
+            result = func()
+        except exceptions.TransportError as error:
+            if not is_outage(error):
+                raise
+            self.failed(state)
+            metrics.incr('breaker.%s.fallback' % self.name)
+            return fallback()
+        if state == 'half_open':
+            cache.delete_many([self.key + 'open_until', self.key + 'trial',
+                               self.key + 'failures'])
+        return result
+
+    def failed(self, state):
+        metrics.incr('breaker.%s.failure' % self.name)
+        key = self.key + 'failures'
+        cache.add(key, 0, self.window)
+        try:
+            failures = cache.incr(key)
+        except ValueError:
+            failures = 1
+        if state == 'half_open' or failures >= self.failures:
+            cache.set(self.key + 'open_until', time.time() + self.reset, None)
+            cache.delete_many([key, self.key + 'trial'])
+            metrics.incr('breaker.%s.opened' % self.name)
+
+    def prometheus(self):
+        """
+        The state as a Prometheus gauge per state, 1 for the current one.
+        """
+        state = self.state()
+        lines = ['# TYPE api_circuit_breaker_state gauge']
+        lines.extend('api_circuit_breaker_state{name="%s",state="%s"} %d' % (
+            self.name, name, name == state) for name in STATES)
+        return '\n'.join(lines) + '\n'
+
+
+search_breaker = CircuitBreaker(
+    'elasticsearch', failures=settings.SEARCH_BREAKER_FAILURES,
+    window=settings.SEARCH_BREAKER_WINDOW, reset=settings.SEARCH_BREAKER_RESET)
+
+
+class FallbackSearchResults(object):
+    """
+    Search results read from `primary` through `search_breaker`, and from
+    `fallback`, which behaves the same, when it is open. Only slices are
+    read, as `DistancePagination` does.
+    """
+
+    def __init__(self, primary, fallback):
+        self.primary, self.fallback = primary, fallback
+
+    @property
+    def query(self):
+        return self.primary.query
+
+    def after(self, km, pk):
+        return FallbackSearchResults(self.primary.after(km, pk),
+                                     self.fallback.after(km, pk))
+
+    def __getitem__(self, index):
+        return search_breaker.call(lambda: self.search(index),
+                                   lambda: self.fallback[index])
+
+    def search(self, index):
+        with failing_loudly():
+            return self.primary[index]
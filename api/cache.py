@@ -0,0 +1,231 @@
+import gzip
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import (
+    http_date,
+    parse_etags,
+    parse_http_date_safe,
+    quote_etag,
+)
+from rest_framework import status
+from rest_framework.response import Response
+from api import metrics
+from api.utils import (
+    default_list_cache_key_func,
+    default_validator_func,
+    get_request_versions,
+)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+RESPONSE_KEY_PREFIX = 'api:response:'
+# How often a worker waiting for another one to rebuild a response checks
+# if it is done.
+LOCK_POLL_INTERVAL = 0.05
+# Cached responses are compressed once, when they are built, so it pays off to
+# compress them hard. Responses shorter than COMPRESS_MIN_LENGTH are only kept
+# uncompressed.
+COMPRESS_MIN_LENGTH = 200
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+# Renderers whose output depends on more than the data, like the CSRF token of
+# the browsable API, are never cached.
+UNCACHED_FORMATS = ('api',)
+
+
+def not_modified(request, etag, last_modified):
+    """
+    Whether the client already has the current response, following
+    RFC 7232: If-None-Match wins over If-Modified-Since.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # weak comparison, nginx weakens the ETags it compresses
+        etags = [tag[2:] if tag.startswith('W/') else tag
+                 for tag in parse_etags(if_none_match)]
+        return '*' in etags or etag in etags
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return (if_modified_since is not None and
+            int(last_modified) <= if_modified_since)
+
+
+def conditional_response(validator_func=default_validator_func):
+    """
+    Answer conditional GET requests with a 304 before running the view
+    method, from the generations of the view scopes alone. The ETag comes
+    from `validator_func` and `Last-Modified` from the last change of the
+    scopes, both are added to the full responses as well.
+
+    Goes on top of `cache_response`, so cached responses don't keep them.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def inner(self, request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view_method(self, request, *args, **kwargs)
+            with metrics.span('cache_key'):
+                etag = quote_etag(validator_func(
+                    view_instance=self, view_method=view_method,
+                    request=request, args=args, kwargs=kwargs))
+                _, last_modified = get_request_versions(self, request)
+            if not_modified(request, etag, last_modified):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                response = view_method(self, request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+            # the compressed bytes are another representation
+            response['ETag'] = ('W/' + etag if response.has_header(
+                'Content-Encoding') else etag)
+            response['Last-Modified'] = http_date(last_modified)
+            return response
+        return inner
+    return decorator
+
+
+def compress(content):
+    """
+    The encodings a response is kept in, from the most to the least
+    preferred, `identity` being the uncompressed content.
+    """
+    encodings = [('identity', content)]
+    if len(content) < COMPRESS_MIN_LENGTH:
+        return encodings
+    encodings.insert(0, ('gzip', gzip.compress(content, GZIP_LEVEL)))
+    if brotli is not None:
+        encodings.insert(0, ('br', brotli.compress(
+            content, quality=BROTLI_QUALITY)))
+    return encodings
+
+
+def accepted_encodings(request):
+    """
+    Content codings of the `Accept-Encoding` header of a request, without
+    the ones refused with `q=0`.
+    """
+    accepted, refused = set(), set()
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip().lower()
+        quality = params.strip().replace(' ', '')
+        if quality in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            refused.add(name)
+        elif name:
+            accepted.add(name)
+    if '*' in accepted:
+        accepted.update(['br', 'gzip'])
+    return accepted - refused | ({'identity'} - refused)
+
+
+def cached_response(entry, request):
+    """
+    The response of a cache entry, in the encoding the client prefers. Only
+    the kept bytes are sent, nothing is rendered nor compressed again.
+    """
+    accepted = accepted_encodings(request)
+    encoding, content = next(
+        ((encoding, content) for encoding, content in entry['content']
+         if encoding in accepted), entry['content'][-1])
+    response = HttpResponse(content=content, status=entry['status'])
+    for name, value in entry['headers']:
+        response[name] = value
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if encoding != 'identity':
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def cache_response(key_func=default_list_cache_key_func, timeout=None):
+    """
+    Cache the rendered responses of a view method under a key from
+    `key_func` and the format of the renderer, along with the generations of
+    the view scopes they were built from. The rendered bytes are kept, and
+    compressed, as `compress` does, so a hit is served as is.
+
+    A missing or outdated response is rebuilt by a single worker, the one
+    adding a lock next to it in the cache, holding the time it was taken.
+    The others serve the outdated response meanwhile, for the first
+    `API_CACHE_STALE_WINDOW` seconds of the rebuild. They only wait for the
+    new one when there is no outdated response or the rebuild takes longer,
+    for at most `API_CACHE_LOCK_TIMEOUT` seconds.
+
+    Views may cap how long their responses are kept with a
+    `get_cache_timeout` method.
+    """
+    key_name = getattr(key_func, '__name__', type(key_func).__name__)
+
+    def decorator(view_method):
+        @wraps(view_method)
+        def inner(self, request, *args, **kwargs):
+            renderer_format = request.accepted_renderer.format
+            if renderer_format in UNCACHED_FORMATS:
+                return view_method(self, request, *args, **kwargs)
+            with metrics.span('cache_key'):
+                key = '%s%s:%s' % (RESPONSE_KEY_PREFIX, key_func(
+                    view_instance=self, view_method=view_method,
+                    request=request, args=args, kwargs=kwargs),
+                    renderer_format)
+                generations, _ = get_request_versions(self, request)
+            version = '.'.join(map(str, generations))
+            entry = cache.get(key)
+            if entry is not None and entry['version'] == version:
+                metrics.count(key_name + '.hit')
+                return cached_response(entry, request)
+
+            lock_key = key + ':lock'
+            lock_timeout = settings.API_CACHE_LOCK_TIMEOUT
+            deadline = time.time() + lock_timeout
+            locked = cache.add(lock_key, time.time(), lock_timeout)
+            while not locked:
+                if entry is not None:
+                    locked_at = cache.get(lock_key)
+                    if locked_at is not None and (
+                            time.time() - locked_at <=
+                            settings.API_CACHE_STALE_WINDOW):
+                        metrics.count(key_name + '.stale')
+                        return cached_response(entry, request)
+                if time.time() >= deadline:
+                    # The worker holding the lock is stuck, don't wait on it.
+                    break
+                time.sleep(LOCK_POLL_INTERVAL)
+                entry = cache.get(key)
+                if entry is not None and entry['version'] == version:
+                    metrics.count(key_name + '.hit')
+                    return cached_response(entry, request)
+                locked = cache.add(lock_key, time.time(), lock_timeout)
+
+            metrics.count(key_name + '.miss')
+            cache_timeout = timeout or settings.API_CACHE_TIMEOUT
+            get_cache_timeout = getattr(self, 'get_cache_timeout', None)
+            if get_cache_timeout is not None:
+                cache_timeout = min(
+                    cache_timeout, get_cache_timeout() or cache_timeout)
+            try:
+                response = view_method(self, request, *args, **kwargs)
+                response = self.finalize_response(
+                    request, response, *args, **kwargs)
+                response.render()
+                # the same as the cached responses, whatever the encoding
+                patch_vary_headers(response, ['Accept-Encoding'])
+                if response.status_code == status.HTTP_200_OK:
+                    cache.set(key, {
+                        'version': version,
+                        'content': compress(response.rendered_content),
+                        'status': response.status_code,
+                        'headers': list(response.items()),
+                    }, cache_timeout)
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+            return response
+        return inner
+    return decorator
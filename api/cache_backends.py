@@ -0,0 +1,220 @@
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils.module_loading import import_string
+from api import metrics
+from api.metrics import METRIC_KEY_PREFIX
+
+
+MISSING = object()
+TIERS = ('local_hit', 'remote_hit', 'miss')
+# Counters of each tier, added up for every process in the remote cache and
+# read with `api.metrics.read`.
+METRICS = tuple('cache.' + tier for tier in TIERS)
+STATS_FLUSH_INTERVAL = 10
+
+
+class TimedBackend(object):
+    """
+    Proxy of a cache backend timing its calls as the `cache` span of the
+    request.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            with metrics.span('cache'):
+                return attr(*args, **kwargs)
+        return timed
+
+
+class TwoTierCache(BaseCache):
+    """
+    Cache backend keeping the values it reads from a remote backend, like
+    memcached, in a small LRU of the process for a few seconds.
+
+    Writes go through to the remote backend. A value changed by another
+    process is seen here after `LOCAL_TIMEOUT` seconds at most, so the
+    generations, and everything built on them, never lag more than that.
+
+        CACHES = {'default': {
+            'BACKEND': 'api.cache_backends.TwoTierCache',
+            'LOCATION': 'cache',
+            'OPTIONS': {
+                'REMOTE_BACKEND':
+                    'django.core.cache.backends.memcached.PyLibMCCache',
+                'LOCAL_MAX_ENTRIES': 1000,
+                'LOCAL_TIMEOUT': 1,
+            },
+        }}
+
+    The remaining `OPTIONS` go to the remote backend, whose calls are timed
+    as the `cache` span of the request.
+    """
+
+    def __init__(self, location, params):
+        params = dict(params)
+        options = dict(params.get('OPTIONS', {}))
+        remote_backend = options.pop('REMOTE_BACKEND')
+        self.local_max_entries = options.pop('LOCAL_MAX_ENTRIES', 1000)
+        self.local_timeout = options.pop('LOCAL_TIMEOUT', 1)
+        params['OPTIONS'] = options
+        super().__init__(params)
+        self.remote = TimedBackend(
+            import_string(remote_backend)(location, params))
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = Counter()
+        self.flushed_hits = Counter()
+        self.flushed_at = time.time()
+
+    def stats(self):
+        """
+        Hits of each tier and misses seen by this process, and the size of
+        its LRU.
+        """
+        with self.lock:
+            stats = dict((tier, self.hits[tier]) for tier in TIERS)
+            stats['local_entries'] = len(self.local)
+        return stats
+
+    def _count(self, tier, value=1):
+        with self.lock:
+            self.hits[tier] += value
+            if time.time() - self.flushed_at < STATS_FLUSH_INTERVAL:
+                return
+            deltas = self.hits - self.flushed_hits
+            self.flushed_hits = self.hits.copy()
+            self.flushed_at = time.time()
+        for tier, delta in deltas.items():
+            key = METRIC_KEY_PREFIX + 'cache.' + tier
+            try:
+                self.remote.incr(key, delta)
+            except ValueError:
+                if not self.remote.add(key, delta, None):
+                    self.remote.incr(key, delta)
+
+    def _remember(self, key, value, timeout=DEFAULT_TIMEOUT):
+        timeout = self.local_timeout if timeout in (DEFAULT_TIMEOUT, None) \
+            else min(timeout, self.local_timeout)
+        if timeout <= 0:
+            self._forget(key)
+            return
+        entry = (time.time() + timeout,
+                 pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.local[key] = entry
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_max_entries:
+                self.local.popitem(last=False)
+
+    def _forget(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+
+    def _recall(self, key):
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] <= time.time():
+                del self.local[key]
+                return MISSING
+            self.local.move_to_end(key)
+        return pickle.loads(entry[1])
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_key(key, version)
+        value = self._recall(local_key)
+        if value is not MISSING:
+            self._count('local_hit')
+            return value
+        value = self.remote.get(key, MISSING, version=version)
+        if value is MISSING:
+            self._count('miss')
+            return default
+        self._count('remote_hit')
+        self._remember(local_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        values, missing = {}, []
+        for key in keys:
+            value = self._recall(self.make_key(key, version))
+            if value is MISSING:
+                missing.append(key)
+            else:
+                values[key] = value
+        if values:
+            self._count('local_hit', len(values))
+        if missing:
+            remote_values = self.remote.get_many(missing, version=version)
+            for key, value in remote_values.items():
+                self._remember(self.make_key(key, version), value)
+            values.update(remote_values)
+            if remote_values:
+                self._count('remote_hit', len(remote_values))
+            if len(remote_values) < len(missing):
+                self._count('miss', len(missing) - len(remote_values))
+        return values
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        result = self.remote.set(key, value, timeout, version=version)
+        self._remember(self.make_key(key, version), value, timeout)
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_key(key, version)
+        if self.remote.add(key, value, timeout, version=version):
+            self._remember(local_key, value, timeout)
+            return True
+        # somebody else holds a value, ours may be outdated
+        self._forget(local_key)
+        return False
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        result = self.remote.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            self._remember(self.make_key(key, version), value, timeout)
+        return result
+
+    def delete(self, key, version=None):
+        self._forget(self.make_key(key, version))
+        return self.remote.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._forget(self.make_key(key, version))
+        return self.remote.delete_many(keys, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        local_key = self.make_key(key, version)
+        try:
+            value = self.remote.incr(key, delta, version=version)
+        except ValueError:
+            self._forget(local_key)
+            raise
+        self._remember(local_key, value)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, MISSING, version=version) is not MISSING
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+        self.remote.clear()
+
+    def close(self, **kwargs):
+        self.remote.close(**kwargs)
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from django.db.models import Avg, Count, F, FloatField, Func
+from haystack import connections
+from haystack.constants import DJANGO_CT
+from haystack.utils import get_model_ct
+from tourpoint.models import CATEGORIES, TourPoint
+from api import metrics
+from api.search_cache import geohash
+
+
+# Geohash precision used for each map zoom level, about one cell per tile.
+ZOOM_PRECISION = (1, 1, 1, 2, 2, 3, 3, 3, 4, 4, 5, 5, 5, 6, 6, 7, 7, 7, 8)
+MAX_CELLS = 10000
+
+
+def precision_for(zoom):
+    return ZOOM_PRECISION[min(zoom, len(ZOOM_PRECISION) - 1)]
+
+
+def cell_size(precision):
+    """
+    `(lat, lng)` size in degrees of the geohash cells of a precision.
+    Geohashes interleave bits starting with the longitude.
+    """
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** (bits - bits // 2)
+
+
+def cluster(geohash_, count, categories, lat, lng):
+    """
+    A cluster with the centroid in the fields of the tour points, see
+    `geo.point_of`.
+    """
+    return OrderedDict([
+        ('geohash', geohash_),
+        ('count', count),
+        ('categories', categories),
+        ('longitude', lat),
+        ('latitude', lng),
+    ])
+
+
+def es_clusters(bbox, precision, filters):
+    """
+    Clusters from a `geohash_grid` aggregation, with a `terms` aggregation
+    for the categories and a `geo_centroid` one for the position. No
+    document is fetched.
+    """
+    min_lat, min_lng, max_lat, max_lng = bbox
+    backend = connections['default'].get_backend()
+    body = {
+        'size': 0,
+        'query': {'filtered': {'filter': {'bool': {'must': [
+            {'term': {DJANGO_CT: get_model_ct(TourPoint)}},
+            {'geo_bounding_box': {'coordinates': {
+                'top_left': {'lat': max_lat, 'lon': min_lng},
+                'bottom_right': {'lat': min_lat, 'lon': max_lng}}}},
+        ] + list(filters)}}}},
+        'aggs': {'cells': {
+            'geohash_grid': {'field': 'coordinates', 'precision': precision,
+                             'size': MAX_CELLS},
+            'aggs': {
+                'categories': {'terms': {'field': 'category_exact',
+                                         'size': len(CATEGORIES)}},
+                'centroid': {'geo_centroid': {'field': 'coordinates'}},
+            }}},
+    }
+    with metrics.span('elasticsearch'):
+        response = backend.conn.search(index=backend.index_name,
+                                       doc_type='modelresult', body=body)
+    clusters = []
+    for bucket in response['aggregations']['cells']['buckets']:
+        location = bucket['centroid']['location']
+        clusters.append(cluster(
+            bucket['key'], bucket['doc_count'],
+            dict((category['key'], category['doc_count'])
+                 for category in bucket['categories']['buckets']),
+            location['lat'], location['lon']))
+    return clusters
+
+
+def db_clusters(queryset, bbox, precision):
+    """
+    The same clusters grouped by Postgres, on a grid matching the geohash
+    cells of `precision`.
+    """
+    min_lat, min_lng, max_lat, max_lng = bbox
+    lat_size, lng_size = cell_size(precision)
+    # (lat, lng) is (longitude, latitude), see `geo.point_of`
+    rows = queryset.filter(
+        longitude__range=(min_lat, max_lat),
+        latitude__range=(min_lng, max_lng),
+    ).annotate(
+        cell_lat=Func((F('longitude') + 90) / lat_size, function='FLOOR',
+                      output_field=FloatField()),
+        cell_lng=Func((F('latitude') + 180) / lng_size, function='FLOOR',
+                      output_field=FloatField()),
+    ).values('cell_lat', 'cell_lng', 'category').annotate(
+        count=Count('id'), lat=Avg('longitude'), lng=Avg('latitude'),
+    ).order_by()
+
+    cells = OrderedDict()
+    for row in rows:
+        cell = cells.setdefault((row['cell_lat'], row['cell_lng']), {
+            'count': 0, 'categories': {}, 'lat': 0.0, 'lng': 0.0})
+        cell['count'] += row['count']
+        cell['categories'][row['category']] = row['count']
+        cell['lat'] += row['lat'] * row['count']
+        cell['lng'] += row['lng'] * row['count']
+
+    clusters = []
+    for (cell_lat, cell_lng), cell in cells.items():
+        geohash_, _, _ = geohash(-90 + (cell_lat + 0.5) * lat_size,
+                                 -180 + (cell_lng + 0.5) * lng_size,
+                                 precision)
+        clusters.append(cluster(
+            geohash_, cell['count'], cell['categories'],
+            cell['lat'] / cell['count'], cell['lng'] / cell['count']))
+    # the order of the geohash_grid buckets
+    clusters.sort(key=lambda cluster: -cluster['count'])
+    return clusters
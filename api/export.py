@@ -0,0 +1,61 @@
+import csv
+import json
+from api.serializers import TourPointRowSerializer
+
+
+FIELDS = ('url', 'name', 'category', 'owner', 'longitude', 'latitude',
+          'private')
+ROWS_PER_CHUNK = 500
+
+
+class Echo(object):
+    """
+    File-like object handing back what `csv.writer` writes to it.
+    """
+    def write(self, value):
+        return value
+
+
+def export_rows(queryset, request):
+    """
+    The tour points of the queryset as `TourPointSerializer` would represent
+    them, read in chunks from a server side cursor.
+    """
+    serializer = TourPointRowSerializer(None, context={'request': request})
+    rows = queryset.order_by('pk').values(
+        *TourPointRowSerializer.values).iterator()
+    return (serializer.to_representation(row) for row in rows)
+
+
+def chunked(lines):
+    """
+    Join lines into chunks, so the response isn't written a line at a time.
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == ROWS_PER_CHUNK:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def stream_ndjson(queryset, request):
+    return chunked(json.dumps(row) + '\n'
+                   for row in export_rows(queryset, request))
+
+
+def stream_csv(queryset, request):
+    writer = csv.writer(Echo())
+    # The header goes out before the query even starts.
+    yield writer.writerow(FIELDS)
+    for chunk in chunked(writer.writerow(list(row.values()))
+                         for row in export_rows(queryset, request)):
+        yield chunk
+
+
+EXPORTS = {
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+    'csv': (stream_csv, 'text/csv'),
+}
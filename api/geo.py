@@ -0,0 +1,572 @@
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F, FloatField, Func, Q
+from django.utils import timezone
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+from haystack.utils.geo import D
+from api.utils import last_write
+from tourpoint.models import CATEGORIES, TourPoint, TourPointTombstone
+
+
+# Mean earth radius, the same Elasticsearch uses for arc distances.
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+CATEGORY_CODES = dict((category, code)
+                      for code, (category, _) in enumerate(CATEGORIES))
+
+
+def parse_point(value):
+    """
+    Parse the `from` query parameter into `(lat, lng)`.
+
+    `TourPoint.coordinates` is `Point(latitude, longitude)`, so Elasticsearch
+    indexes the `longitude` field as the latitude, and drf-haystack reads
+    `from` as `latitude,longitude`. Everything here goes through `point_of`
+    and this function, so distances match the ones Elasticsearch computes.
+    """
+    lat, lng = map(float, value.split(','))
+    return lat, lng
+
+
+def point_of(tourpoint):
+    """
+    `(lat, lng)` of a tour point as indexed by Elasticsearch.
+    """
+    return tourpoint.coordinates.y, tourpoint.coordinates.x
+
+
+def haversine(lat, lng, lats, lngs):
+    """
+    Distances in km from `(lat, lng)` to every point in the `lats` and
+    `lngs` arrays.
+    """
+    lat, lng = math.radians(lat), math.radians(lng)
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    a = (np.sin((lats - lat) / 2) ** 2 +
+         math.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def box_around(lat, lng, km):
+    """
+    `(dlat, dlng)` half sizes in degrees of a box holding every point within
+    `km` of `(lat, lng)`. `dlng` is 360 near the poles.
+    """
+    dlat = km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+    dlng = km / (KM_PER_DEGREE * cos_lat) if cos_lat > 1e-9 else 360.0
+    return dlat, dlng
+
+
+def lng_ranges(lng, dlng):
+    """
+    `(min_lng, max_lng)` ranges covering `lng - dlng` to `lng + dlng`, split
+    in two when they cross the antimeridian.
+    """
+    if dlng >= 180:
+        return [(-180.0, 180.0)]
+    low, high = lng - dlng, lng + dlng
+    if low < -180:
+        return [(low + 360, 180.0), (-180.0, high)]
+    if high > 180:
+        return [(low, 180.0), (-180.0, high - 360)]
+    return [(low, high)]
+
+
+def in_bbox(lats, lngs, bbox):
+    """
+    Mask of the points inside a `(min_lat, min_lng, max_lat, max_lng)` box.
+    """
+    min_lat, min_lng, max_lat, max_lng = bbox
+    return ((lats >= min_lat) & (lats <= max_lat) &
+            (lngs >= min_lng) & (lngs <= max_lng))
+
+
+def nearest(distances, pks, km, limit=None, after=None):
+    """
+    Indexes of the `distances` within `km` that come after the `(km, pk)`
+    position `after`, nearest first and then by primary key.
+
+    Only the `limit` nearest ones are sorted, keeping every tie of the last
+    distance so the primary key decides between them.
+    """
+    keep = distances <= km
+    if after is not None:
+        after_km, after_pk = after
+        keep &= (distances > after_km) | (
+            (distances == after_km) & (pks > after_pk))
+    indexes = np.flatnonzero(keep)
+    if limit is not None and limit < len(indexes):
+        bound = np.partition(distances[indexes], limit - 1)[limit - 1]
+        indexes = indexes[distances[indexes] <= bound]
+    order = np.lexsort((pks[indexes], distances[indexes]))[:limit]
+    return indexes[order]
+
+
+class GeoHit(object):
+    """
+    A search result built by the in memory engine, with the same attributes
+    `TourPointLocationSerializer` reads from a Haystack `SearchResult`.
+    """
+
+    def __init__(self, pk, name, category, latitude, longitude, private,
+                 owner, owner_id, distance):
+        self.pk = pk
+        self.name = name
+        self.category = category
+        self.latitude = latitude
+        self.longitude = longitude
+        self.private = private
+        self.owner = owner
+        self.owner_id = owner_id
+        self.distance = distance
+        self.model = TourPoint
+        self.searchindex = connections[DEFAULT_ALIAS].get_unified_index(
+            ).get_index(TourPoint)
+
+
+class GeoEngine(object):
+    """
+    In memory radius search over every tour point.
+
+    Locations, categories, privacy flags and owners are kept in contiguous
+    NumPy arrays. Rows are bucketed in a grid of `cell_size` degrees, a query
+    only looks at the cells around the point and then filters them with a
+    vectorized haversine.
+
+    Each process keeps its own copy, updated by the model signals of the
+    writes it serves. The ones served by other processes are read again from
+    the database once `last_write` tells there are some, and the index is
+    fully reloaded every `max_age` seconds.
+    """
+
+    # Attributes holding the index, swapped at once by `load`.
+    STATE = ('size', 'pks', 'lats', 'lngs', 'categories', 'private',
+             'owners', 'names', 'rows', 'cells', 'usernames')
+
+    def __init__(self, cell_size=0.25, max_age=300):
+        self.cell_size = cell_size
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        # Held by the thread reloading the index.
+        self.load_lock = threading.Lock()
+        # Changes made while a reload runs, applied again on top of it.
+        self.replay = None
+        self.loaded_at = None
+        # Rows updated since `synced_at`, a datetime, may be missing, the
+        # writes are looked for again when some happened after `checked_at`.
+        self.synced_at = None
+        self.checked_at = None
+        self.reset()
+
+    def reset(self, capacity=1024):
+        with self.lock:
+            self.size = 0
+            self.pks = np.zeros(capacity, dtype=np.int64)
+            self.lats = np.zeros(capacity, dtype=np.float64)
+            self.lngs = np.zeros(capacity, dtype=np.float64)
+            self.categories = np.zeros(capacity, dtype=np.int8)
+            self.private = np.zeros(capacity, dtype=np.bool_)
+            self.owners = np.zeros(capacity, dtype=np.int64)
+            self.names = [None] * capacity
+            self.rows = {}
+            self.cells = defaultdict(set)
+            self.usernames = {}
+
+    def clear(self):
+        with self.lock:
+            self.reset()
+            self.loaded_at = None
+
+    def is_stale(self):
+        return self.loaded_at is None or (
+            time.time() - self.loaded_at > self.max_age)
+
+    def has_writes(self):
+        """
+        Whether any process wrote since the last check. Writes bump the
+        generations before they commit, so they are looked for again for
+        `SYNC_LAG` seconds.
+        """
+        written = last_write()
+        return written is not None and (
+            written > self.checked_at - settings.SYNC_LAG)
+
+    def ensure_loaded(self):
+        """
+        Reload the index when it is too old, or catch up with the writes of
+        the other processes. A single thread does it, the others keep
+        searching the current index, unless there is none yet.
+        """
+        if self.is_stale():
+            blocking = self.loaded_at is None
+        elif self.has_writes():
+            blocking = False
+        else:
+            return
+        if not self.load_lock.acquire(blocking=blocking):
+            return
+        try:
+            if self.is_stale():
+                self._load()
+            elif self.has_writes():
+                self._catch_up()
+        finally:
+            self.load_lock.release()
+
+    def _catch_up(self):
+        """
+        Apply the tour points updated and removed since the last sync, read
+        with the same lag as the delta sync of the list.
+        """
+        checked_at, synced_at = time.time(), timezone.now()
+        since = self.synced_at - timedelta(seconds=settings.SYNC_LAG)
+        rows = list(TourPoint.objects.filter(updated__gte=since).values_list(
+            'pk', 'name', 'category', 'latitude', 'longitude', 'private',
+            'owner_id', 'owner__username'))
+        removed = set(TourPointTombstone.objects.filter(
+            removed__gte=since).values_list('tourpoint_id', flat=True))
+        removed -= set(TourPoint.objects.filter(pk__in=removed).values_list(
+            'pk', flat=True))
+
+        def change():
+            for (pk, name, category, latitude, longitude, private, owner_id,
+                    username) in rows:
+                self.usernames[owner_id] = username
+                # (lat, lng) is (longitude, latitude), see `point_of`
+                self._upsert(pk, name, category, longitude, latitude,
+                             private, owner_id)
+            for pk in removed:
+                self._remove(pk)
+        self._apply(change)
+        self.checked_at, self.synced_at = checked_at, synced_at
+
+    def load(self):
+        """
+        Replace the whole index with the tour points from the database.
+        """
+        with self.load_lock:
+            self._load()
+
+    def _load(self):
+        # The new index is built aside, searches only wait for the swap.
+        with self.lock:
+            self.replay = []
+        checked_at, synced_at = time.time(), timezone.now()
+        try:
+            staging = GeoEngine(self.cell_size, self.max_age)
+            staging.reset(max(1024, TourPoint.objects.count()))
+            rows = TourPoint.objects.values_list(
+                'pk', 'name', 'category', 'latitude', 'longitude', 'private',
+                'owner_id', 'owner__username').iterator()
+            for (pk, name, category, latitude, longitude, private, owner_id,
+                    username) in rows:
+                staging.usernames[owner_id] = username
+                # (lat, lng) is (longitude, latitude), see `point_of`
+                staging._upsert(pk, name, category, longitude, latitude,
+                                private, owner_id)
+            with self.lock:
+                for attr in self.STATE:
+                    setattr(self, attr, getattr(staging, attr))
+                # the rows may have been read before these changes
+                for change in self.replay:
+                    change()
+                self.loaded_at = time.time()
+                self.checked_at, self.synced_at = checked_at, synced_at
+        finally:
+            with self.lock:
+                self.replay = None
+
+    def _apply(self, change):
+        with self.lock:
+            change()
+            if self.replay is not None:
+                self.replay.append(change)
+
+    def cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lng / self.cell_size)))
+
+    def update(self, tourpoint):
+        username = tourpoint.owner.username
+        lat, lng = point_of(tourpoint)
+        values = (tourpoint.pk, tourpoint.name, tourpoint.category, lat, lng,
+                  tourpoint.private, tourpoint.owner_id)
+
+        def change():
+            self.usernames[tourpoint.owner_id] = username
+            self._upsert(*values)
+        self._apply(change)
+
+    def update_username(self, user):
+        def change():
+            if user.pk in self.usernames:
+                self.usernames[user.pk] = user.username
+        self._apply(change)
+
+    def remove(self, pk):
+        self._apply(lambda: self._remove(pk))
+
+    def _remove(self, pk):
+        row = self.rows.pop(pk, None)
+        if row is None:
+            return
+        self.cells[self.cell(self.lats[row], self.lngs[row])].discard(row)
+        last = self.size - 1
+        if row != last:
+            # move the last row into the hole, keeping arrays contiguous
+            last_cell = self.cell(self.lats[last], self.lngs[last])
+            self.cells[last_cell].discard(last)
+            self.cells[last_cell].add(row)
+            for array in (self.pks, self.lats, self.lngs,
+                          self.categories, self.private, self.owners):
+                array[row] = array[last]
+            self.names[row] = self.names[last]
+            self.rows[int(self.pks[row])] = row
+        self.names[last] = None
+        self.size = last
+
+    def _upsert(self, pk, name, category, lat, lng, private, owner_id):
+        row = self.rows.get(pk)
+        if row is None:
+            if self.size == len(self.pks):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.rows[pk] = row
+        else:
+            self.cells[self.cell(self.lats[row], self.lngs[row])].discard(row)
+        self.pks[row] = pk
+        self.lats[row] = lat
+        self.lngs[row] = lng
+        self.categories[row] = CATEGORY_CODES[category]
+        self.private[row] = private
+        self.owners[row] = owner_id
+        self.names[row] = name
+        self.cells[self.cell(lat, lng)].add(row)
+
+    def _grow(self):
+        capacity = len(self.pks) * 2
+        for attr in ('pks', 'lats', 'lngs', 'categories', 'private',
+                     'owners'):
+            array = getattr(self, attr)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, attr, grown)
+        self.names.extend([None] * (capacity - len(self.names)))
+
+    def candidates(self, lat, lng, km):
+        """
+        Rows in the grid cells that may hold points within `km` of the point.
+        """
+        dlat, dlng = box_around(lat, lng, km)
+        boxes = [(self.cell(lat - dlat, min_lng),
+                  self.cell(lat + dlat, max_lng))
+                 for min_lng, max_lng in lng_ranges(lng, dlng)]
+        cells = sum((max_cell[0] - min_cell[0] + 1) *
+                    (max_cell[1] - min_cell[1] + 1)
+                    for min_cell, max_cell in boxes)
+        if dlng >= 180 or cells >= len(self.cells):
+            # the box covers most of the grid, there is nothing to prefilter
+            return np.arange(self.size)
+        rows = []
+        for min_cell, max_cell in boxes:
+            for i in range(min_cell[0], max_cell[0] + 1):
+                for j in range(min_cell[1], max_cell[1] + 1):
+                    rows.extend(self.cells.get((i, j), ()))
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+    def search(self, lat, lng, km, user, limit=None, after=None, bbox=None):
+        """
+        Tour points visible to `user` within `km` of `(lat, lng)`, nearest
+        first and then by primary key.
+
+        Only the `limit` nearest ones are sorted, the ones coming after the
+        `(km, pk)` position given in `after`. `bbox` is an optional
+        `(min_lat, min_lng, max_lat, max_lng)` box the results must lie in.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            rows = self.candidates(lat, lng, km)
+            if user.is_anonymous():
+                visible = ((self.categories[rows] ==
+                            CATEGORY_CODES['restaurant']) &
+                           ~self.private[rows])
+            else:
+                visible = ~self.private[rows] | (self.owners[rows] == user.pk)
+            rows = rows[visible]
+            if bbox is not None:
+                rows = rows[in_bbox(self.lats[rows], self.lngs[rows], bbox)]
+            distances = haversine(lat, lng, self.lats[rows], self.lngs[rows])
+            order = nearest(distances, self.pks[rows], km, limit, after)
+            return [self.hit(row, distance)
+                    for row, distance in zip(rows[order], distances[order])]
+
+    def hit(self, row, distance):
+        owner_id = int(self.owners[row])
+        return GeoHit(
+            pk=int(self.pks[row]),
+            name=self.names[row],
+            category=CATEGORIES[self.categories[row]][0],
+            # back to the model fields, see `parse_point`
+            latitude=float(self.lngs[row]),
+            longitude=float(self.lats[row]),
+            private=bool(self.private[row]),
+            owner=self.usernames.get(owner_id),
+            owner_id=owner_id,
+            distance=D(km=float(distance)))
+
+
+def _sql(function, *expressions):
+    return Func(*expressions, function=function, output_field=FloatField())
+
+
+def sql_haversine(lat, lng):
+    """
+    `haversine` from `(lat, lng)` to the tour points as a SQL expression.
+    """
+    # (lat, lng) is (longitude, latitude), see `point_of`
+    lats = _sql('RADIANS', F('longitude'))
+    lngs = _sql('RADIANS', F('latitude'))
+    lat, lng = math.radians(lat), math.radians(lng)
+    a = (_sql('POWER', _sql('SIN', (lats - lat) / 2), 2) +
+         math.cos(lat) * _sql('COS', lats) *
+         _sql('POWER', _sql('SIN', (lngs - lng) / 2), 2))
+    distance = 2 * EARTH_RADIUS_KM * _sql(
+        'ASIN', _sql('SQRT', _sql('LEAST', a, 1.0)))
+    return ExpressionWrapper(distance, output_field=FloatField())
+
+
+class DatabaseEngine(object):
+    """
+    Radius search on Postgres, for when Elasticsearch can't answer. A box
+    around the circle narrows the tour points down on the `latitude` and
+    `longitude` index, then the exact distance is checked, sorted and
+    limited by Postgres, so only the page is transferred.
+    """
+
+    def search(self, lat, lng, km, user, limit=None, after=None, bbox=None):
+        """
+        The same results as `GeoEngine.search`.
+        """
+        dlat, dlng = box_around(lat, lng, km)
+        # (lat, lng) is (longitude, latitude), see `point_of`
+        queryset = TourPoint.objects.visible_to(user).filter(
+            longitude__range=(lat - dlat, lat + dlat))
+        if dlng < 180:
+            # split in two ranges across the antimeridian
+            in_range = Q()
+            for min_lng, max_lng in lng_ranges(lng, dlng):
+                in_range |= Q(latitude__range=(min_lng, max_lng))
+            queryset = queryset.filter(in_range)
+        if bbox is not None:
+            min_lat, min_lng, max_lat, max_lng = bbox
+            queryset = queryset.filter(longitude__range=(min_lat, max_lat),
+                                       latitude__range=(min_lng, max_lng))
+        queryset = queryset.annotate(
+            distance=sql_haversine(lat, lng)).filter(distance__lte=km)
+        if after is not None:
+            after_km, after_pk = after
+            queryset = queryset.filter(
+                Q(distance__gt=after_km) |
+                Q(distance=after_km, pk__gt=after_pk))
+        rows = queryset.order_by('distance', 'pk').values_list(
+            'pk', 'name', 'category', 'latitude', 'longitude', 'private',
+            'owner__username', 'owner_id', 'distance')
+        if limit is not None:
+            rows = rows[:limit]
+        return [GeoHit(*(row[:-1] + (D(km=row[-1]),))) for row in rows]
+
+
+class GeoSearchResults(object):
+    """
+    Lazy results of a radius query on the in memory or the database engine.
+    Like a `SearchQuerySet`, nothing runs until it is iterated, and `query`
+    gives `ListSqlQueryKeyBit` something to build the cache key from.
+    """
+
+    def __init__(self, engine, lat, lng, km, user, limit=None, after=None,
+                 bbox=None):
+        self.engine = engine
+        self.lat, self.lng, self.km = lat, lng, km
+        self.user = user
+        self.limit, self.after_position, self.bbox = limit, after, bbox
+        self._results = None
+
+    @property
+    def query(self):
+        return self
+
+    def __str__(self):
+        return 'geo lat=%r lng=%r km=%r user=%s bbox=%r' % (
+            self.lat, self.lng, self.km, self.user.pk, self.bbox)
+
+    def _clone(self, **kwargs):
+        attrs = dict(limit=self.limit, after=self.after_position,
+                     bbox=self.bbox)
+        attrs.update(kwargs)
+        return GeoSearchResults(self.engine, self.lat, self.lng, self.km,
+                                self.user, **attrs)
+
+    def after(self, km, pk):
+        """
+        Results coming after `(km, pk)`, for keyset pagination.
+        """
+        return self._clone(after=(km, pk))
+
+    def _fetch(self):
+        if self._results is None:
+            self._results = self.engine.search(
+                self.lat, self.lng, self.km, self.user, limit=self.limit,
+                after=self.after_position, bbox=self.bbox)
+        return self._results
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+    def __len__(self):
+        return len(self._fetch())
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice) and not index.start and
+                index.stop is not None and self._results is None):
+            # Only the first results are wanted, let the engine skip sorting
+            # the rest.
+            limit = index.stop
+            if self.limit is not None:
+                limit = min(limit, self.limit)
+            return self._clone(limit=limit)._fetch()
+        return self._fetch()[index]
+
+
+engine = GeoEngine(
+    cell_size=getattr(settings, 'GEO_SEARCH_CELL_SIZE', 0.25),
+    max_age=getattr(settings, 'GEO_SEARCH_MAX_AGE', 300))
+database = DatabaseEngine()
+
+
+def update_tourpoint(sender=None, instance=None, *args, **kwargs):
+    """
+    Keep the engine of this process up to date, once the write is committed.
+    """
+    if engine.loaded_at is not None:
+        transaction.on_commit(lambda: engine.update(instance))
+
+
+def remove_tourpoint(sender=None, instance=None, *args, **kwargs):
+    if engine.loaded_at is not None:
+        pk = instance.pk
+        transaction.on_commit(lambda: engine.remove(pk))
+
+
+def update_username(sender=None, instance=None, *args, **kwargs):
+    if engine.loaded_at is not None:
+        transaction.on_commit(lambda: engine.update_username(instance))
@@ -0,0 +1,101 @@
+import random
+import time
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from haystack.query import SearchQuerySet
+from haystack.utils.geo import D, Point
+from api import geo, metrics, search_cache
+from api.search_backends import DistanceSearchQuerySet
+from tourpoint.models import TourPoint
+
+
+def percentile(timings, percent):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = ('Compare the latency of radius searches on Elasticsearch, on '
+            'the in memory engine and through the quantized search cache, '
+            'over the tour points in the database. Searches start a random '
+            'distance of up to --jitter km away from a tour point, like '
+            'clients sending their own position would.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--km', type=float, default=5.0)
+        parser.add_argument('--jitter', type=float, default=0.5)
+        parser.add_argument('--limit', type=int, default=20)
+
+    def handle(self, *args, **options):
+        km = options['km']
+        jitter = options['jitter'] / geo.KM_PER_DEGREE
+        centers = [
+            (lat + random.uniform(-jitter, jitter),
+             lng + random.uniform(-jitter, jitter))
+            for lat, lng in (
+                geo.point_of(tourpoint) for tourpoint in
+                TourPoint.objects.order_by('?')[:options['queries']])]
+        if not centers:
+            self.stderr.write('There are no tour points to search around.')
+            return
+
+        started = time.time()
+        geo.engine.load()
+        self.stdout.write('Loaded %d tour points in memory in %.2fs' % (
+            geo.engine.size, time.time() - started))
+
+        user = AnonymousUser()
+        self.report('memory', [
+            self.timed(lambda: geo.engine.search(lat, lng, km, user))
+            for lat, lng in centers])
+        self.report('elasticsearch', [
+            self.timed(lambda: self.search(lat, lng, km))
+            for lat, lng in centers])
+
+        limit = options['limit']
+        self.report('es top-k', [
+            self.timed(lambda: self.nearest(lat, lng, km, user)[:limit])
+            for lat, lng in centers])
+        metrics.flush()
+        metrics.reset(search_cache.METRICS)
+        self.report('quantized', [
+            self.timed(lambda: search_cache.QuantizedSearchResults(
+                self.nearest(lat, lng, km, user), lat, lng, km, user)[:limit])
+            for lat, lng in centers])
+        metrics.flush()
+        counters = metrics.read(search_cache.METRICS)
+        lookups = (counters['geo_search.cell_hit'] +
+                   counters['geo_search.cell_miss'])
+        self.stdout.write('cell cache hit rate %.1f%% (%d lookups, %d too '
+                          'large to cache)' % (
+                              100.0 * counters['geo_search.cell_hit'] /
+                              max(lookups, 1), lookups,
+                              counters['geo_search.cell_overflow']))
+
+    def search(self, lat, lng, km):
+        point = Point(lng, lat)
+        return list(SearchQuerySet().models(TourPoint).filter(
+            category='restaurant', private='false').dwithin(
+                'coordinates', point, D(km=km)).distance(
+                    'coordinates', point))
+
+    def nearest(self, lat, lng, km, user):
+        point = Point(lng, lat)
+        return DistanceSearchQuerySet().models(TourPoint).dwithin(
+            'coordinates', point, D(km=km)).distance(
+                'coordinates', point).order_by(
+                    'distance', 'tourpoint_id').context_filter(
+                        {'term': {'category_exact': 'restaurant'}},
+                        {'term': {'private': False}})
+
+    def timed(self, search):
+        started = time.time()
+        search()
+        return (time.time() - started) * 1000
+
+    def report(self, name, timings):
+        self.stdout.write(
+            '%-14s mean %8.3fms  p50 %8.3fms  p95 %8.3fms  p99 %8.3fms' % (
+                name, sum(timings) / len(timings), percentile(timings, 50),
+                percentile(timings, 95), percentile(timings, 99)))
@@ -0,0 +1,63 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+from api.views import TourPointLocationGeoSearchViewSet, TourPointViewSet
+from tourpoint.models import TourPoint
+
+
+CACHES = {
+    'hit': {'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark_response_cache'}},
+    'miss': {'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+}
+
+
+class Command(BaseCommand):
+    help = ('Compare the CPU time of serving a page of tour points and a '
+            'radius search from the response cache with building, rendering '
+            'and compressing them on every request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--encoding', default='gzip')
+
+    def handle(self, *args, **options):
+        tourpoint = TourPoint.objects.order_by('?').first()
+        if tourpoint is None:
+            raise CommandError('There are no tour points to serve.')
+        factory = APIRequestFactory()
+        endpoints = (
+            ('tourpoints', TourPointViewSet.as_view({'get': 'list'}),
+             '/api/v1/tourpoints/'),
+            ('search', TourPointLocationGeoSearchViewSet.as_view(
+                {'get': 'list'}),
+             '/api/v1/search/?from=%s,%s&km=5' % (
+                 tourpoint.longitude, tourpoint.latitude)),
+        )
+
+        for name, view, url in endpoints:
+            def get():
+                response = view(factory.get(
+                    url, HTTP_ACCEPT_ENCODING=options['encoding']))
+                if response.status_code != 200:
+                    raise CommandError('%s answered %s.' % (
+                        url, response.status_code))
+                return response
+
+            timings = {}
+            for case in ('miss', 'hit'):
+                with override_settings(CACHES=CACHES[case]):
+                    response = get()
+                    started = time.process_time()
+                    for _ in range(options['repeat']):
+                        response = get()
+                    timings[case] = ((time.process_time() - started) * 1000 /
+                                     options['repeat'])
+            self.stdout.write(
+                '%-10s miss %8.3fms  hit %8.3fms  CPU saved per hit %8.3fms '
+                '(%s)' % (name, timings['miss'], timings['hit'],
+                          timings['miss'] - timings['hit'],
+                          response.get('Content-Encoding', 'identity')))
@@ -0,0 +1,49 @@
+import time
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from api.serializers import TourPointRowSerializer, TourPointSerializer
+from tourpoint.models import TourPoint
+
+
+class Command(BaseCommand):
+    help = ('Compare serializing and rendering a page of tour points with '
+            'TourPointSerializer and with the TourPointRowSerializer fast path.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get('/api/v1/tourpoints/'))
+        request.user = AnonymousUser()
+        context = {'request': request}
+        renderer = JSONRenderer()
+        queryset = TourPoint.objects.order_by('-created', '-id')[
+            :options['rows']]
+
+        def current():
+            return renderer.render(TourPointSerializer(
+                list(queryset), many=True, context=context).data)
+
+        def fast():
+            return renderer.render(TourPointRowSerializer(
+                list(queryset.values(*TourPointRowSerializer.values)),
+                context=context).data)
+
+        if current() != fast():
+            raise CommandError('The serializers output is not the same.')
+
+        timings = {}
+        for name, serialize in (('TourPointSerializer', current),
+                                ('TourPointRowSerializer', fast)):
+            started = time.time()
+            for _ in range(options['repeat']):
+                serialize()
+            timings[name] = (time.time() - started) * 1000 / options['repeat']
+            self.stdout.write('%-24s %8.3fms per page of %d rows' % (
+                name, timings[name], options['rows']))
+        self.stdout.write('Speedup: %.1fx' % (
+            timings['TourPointSerializer'] / timings['TourPointRowSerializer']))
@@ -0,0 +1,121 @@
+import io
+import time
+from datetime import timedelta
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from tourpoint.models import TourPoint
+from api.utils import bump_generations
+
+
+SIZES = {'10k': 10000, '1m': 1000000, '10m': 10000000}
+# (lat, lng, share of the tour points, spread in degrees) of the cities the
+# tour points gather around.
+CITIES = (
+    (-23.5505, -46.6333, 0.35, 0.15),
+    (-22.9068, -43.1729, 0.20, 0.12),
+    (-25.4284, -49.2733, 0.15, 0.08),
+    (-19.9167, -43.9345, 0.12, 0.08),
+    (-30.0346, -51.2177, 0.10, 0.07),
+    (-27.5954, -48.5480, 0.08, 0.06),
+)
+CATEGORY_SHARES = (('restaurant', 0.55), ('park', 0.25), ('museum', 0.20))
+PRIVATE_SHARE = 0.3
+# Tour points per owner follow a power law, a few users own most of them.
+OWNER_EXPONENT = 1.1
+
+
+def parse_count(value):
+    return SIZES.get(value.lower()) or int(value)
+
+
+class Command(BaseCommand):
+    help = ('Load synthetic tour points for benchmarks, --count 10k, 1m or '
+            '10m or any number, with COPY. They gather around a few cities, '
+            'most of them are restaurants and a few users own most of them. '
+            'The search index is left to reindex_tourpoints.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=parse_count, default='10k')
+        parser.add_argument(
+            '--points-per-user', type=int, default=50,
+            help='Average tour points of each synthetic user.')
+        parser.add_argument(
+            '--prefix', default='bench',
+            help='Prefix of the usernames and tour point names.')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        prefix, count = options['prefix'], options['count']
+        User = get_user_model()
+        if User.objects.filter(username__startswith=prefix + '-').exists():
+            raise CommandError(
+                'There is synthetic data with the prefix %r already, use '
+                'another --prefix.' % prefix)
+        random = np.random.RandomState(options['seed'])
+        started = time.time()
+
+        users = max(count // options['points_per_user'], 1)
+        password = make_password(None)
+        now = timezone.now()
+        User.objects.bulk_create(
+            (User(username='%s-%d' % (prefix, i), password=password,
+                  date_joined=now) for i in range(users)),
+            batch_size=10000)
+        owners = np.array(User.objects.filter(
+            username__startswith=prefix + '-').order_by('pk').values_list(
+                'pk', flat=True))
+        weights = 1.0 / np.arange(1, len(owners) + 1) ** OWNER_EXPONENT
+        weights /= weights.sum()
+        self.stdout.write('Created %d users' % len(owners))
+
+        table = TourPoint._meta.db_table
+        sql = ('COPY %s (name, longitude, latitude, private, owner_id, '
+               'category, created, updated) FROM STDIN' % table)
+        for start in range(0, count, options['batch_size']):
+            size = min(options['batch_size'], count - start)
+            buffer = io.StringIO()
+            buffer.write(self.rows(random, start, size, owners, weights, now,
+                                   prefix))
+            buffer.seek(0)
+            with connection.cursor() as cursor:
+                cursor.copy_expert(sql, buffer)
+            self.stdout.write('%d/%d tour points, %.1fs' % (
+                start + size, count, time.time() - started))
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s' % table)
+        bump_generations(['tourpoints'])
+        self.stdout.write(
+            'Loaded %d tour points in %.1fs, run reindex_tourpoints to search '
+            'them.' % (count, time.time() - started))
+
+    def rows(self, random, start, size, owners, weights, now, prefix):
+        """
+        `size` tour points as lines for COPY. The `longitude` field holds the
+        latitude and `latitude` the longitude, see `geo.point_of`.
+        """
+        cities = random.choice(len(CITIES), size,
+                               p=[city[2] for city in CITIES])
+        centers = np.array([city[:2] for city in CITIES])[cities]
+        spreads = np.array([city[3] for city in CITIES])[cities]
+        lats = centers[:, 0] + random.normal(0, 1, size) * spreads
+        lngs = centers[:, 1] + random.normal(0, 1, size) * spreads
+        categories = random.choice(
+            [name for name, _ in CATEGORY_SHARES], size,
+            p=[share for _, share in CATEGORY_SHARES])
+        private = random.random_sample(size) < PRIVATE_SHARE
+        owner_ids = random.choice(owners, size, p=weights)
+        ages = random.randint(0, 365 * 24 * 3600, size)
+        lines = []
+        for i in range(size):
+            created = (now - timedelta(seconds=int(ages[i]))).isoformat()
+            lines.append('%s tour point %d\t%r\t%r\t%s\t%d\t%s\t%s\t%s' % (
+                prefix, start + i, float(lats[i]), float(lngs[i]),
+                't' if private[i] else 'f', int(owner_ids[i]), categories[i],
+                created, created))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,179 @@
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, OrderedDict
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from api.management.commands.benchmark_geo_search import percentile
+from tourpoint.models import TourPoint
+
+
+ENDPOINTS = ('root', 'tourpoints', 'tourpoints-auth', 'user-tourpoints',
+             'search')
+# Queries of a request, as sent back by api.middleware.ServerTimingMiddleware.
+SQL_TIMING = re.compile(r'sql;dur=[0-9.]+;desc="(\d+) calls"')
+
+
+class Command(BaseCommand):
+    help = ('Drive the API endpoints with concurrent clients over HTTP and '
+            'report the p50, p95 and p99 latency, the throughput and the SQL '
+            'queries per request of each, saving them as JSON to compare '
+            'runs. Load the data with generate_tourpoints first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://localhost')
+        parser.add_argument('--clients', type=int, default=16)
+        parser.add_argument(
+            '--requests', type=int, default=1000,
+            help='Requests sent to each endpoint.')
+        parser.add_argument('--km', type=float, default=5.0)
+        parser.add_argument(
+            '--endpoint', action='append', choices=ENDPOINTS,
+            help='Only drive these endpoints.')
+        parser.add_argument('--output', help='File to save the results to.')
+        parser.add_argument(
+            '--compare', help='Results of a previous run to compare with.')
+
+    def handle(self, *args, **options):
+        owner = TourPoint.objects.values('owner').annotate(
+            count=Count('id')).order_by('-count').values_list(
+                'owner', flat=True).first()
+        if owner is None:
+            raise CommandError('There are no tour points, run '
+                               'generate_tourpoints first.')
+        token = Token.objects.get_or_create(user_id=owner)[0].key
+        centers = self.sample_centers(200)
+        km = options['km']
+
+        requests = OrderedDict([
+            ('root', lambda: ('/api/v1/', None)),
+            ('tourpoints', lambda: ('/api/v1/tourpoints/', None)),
+            ('tourpoints-auth', lambda: ('/api/v1/tourpoints/', token)),
+            ('user-tourpoints', lambda: (
+                '/api/v1/users/%s/tourpoints/' % owner, token)),
+            ('search', lambda: ('/api/v1/search/?from=%s,%s&km=%s' % (
+                random.choice(centers) + (km,)), None)),
+        ])
+        results = OrderedDict([
+            ('started', timezone.now().isoformat()),
+            ('base_url', options['base_url']),
+            ('clients', options['clients']),
+            ('dataset', {
+                'tourpoints': TourPoint.objects.count(),
+                'users': get_user_model().objects.count(),
+            }),
+            ('endpoints', OrderedDict()),
+        ])
+        for name, request in requests.items():
+            if options['endpoint'] and name not in options['endpoint']:
+                continue
+            result = self.drive(options['base_url'], request,
+                                options['clients'], options['requests'])
+            results['endpoints'][name] = result
+            self.stdout.write(
+                '%-16s %7.1f req/s  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  '
+                '%5.2f queries  %d errors' % (
+                    name, result['throughput'], result['p50_ms'],
+                    result['p95_ms'], result['p99_ms'],
+                    result['queries_per_request'] or 0, result['errors']))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+        if options['compare']:
+            with open(options['compare']) as previous:
+                self.compare(json.load(previous), results)
+
+    def sample_centers(self, count):
+        """
+        `(lat, lng)` of random tour points, picked by primary key since
+        ordering millions of rows randomly takes too long.
+        """
+        bounds = TourPoint.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        pks = [random.randint(bounds['first'], bounds['last'])
+               for _ in range(count * 2)]
+        # (lat, lng) is (longitude, latitude), see `geo.point_of`
+        return list(TourPoint.objects.filter(pk__in=pks).values_list(
+            'longitude', 'latitude')[:count])
+
+    def drive(self, base_url, request, clients, count):
+        """
+        Send `count` requests from `clients` threads, each one waiting for
+        its response before sending the next.
+        """
+        latencies, queries, statuses = [], [], Counter()
+        lock = threading.Lock()
+        remaining = [count]
+
+        def client():
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return
+                    remaining[0] -= 1
+                path, token = request()
+                headers = {'Accept': 'application/json',
+                           'Accept-Encoding': 'gzip'}
+                if token:
+                    headers['Authorization'] = 'Token ' + token
+                started = time.time()
+                try:
+                    with urllib.request.urlopen(urllib.request.Request(
+                            base_url + path, headers=headers)) as response:
+                        response.read()
+                        status = response.status
+                        timing = response.headers.get('Server-Timing', '')
+                except urllib.error.HTTPError as error:
+                    status, timing = error.code, ''
+                except OSError:
+                    status, timing = None, ''
+                latency = (time.time() - started) * 1000
+                match = SQL_TIMING.search(timing)
+                with lock:
+                    latencies.append(latency)
+                    statuses[status] += 1
+                    if match:
+                        queries.append(int(match.group(1)))
+                    elif 'total;dur=' in timing:
+                        queries.append(0)
+
+        started = time.time()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        return OrderedDict([
+            ('requests', count),
+            ('errors', count - statuses[200]),
+            ('statuses', dict((str(status), value)
+                              for status, value in statuses.items())),
+            ('throughput', count / elapsed),
+            ('mean_ms', sum(latencies) / len(latencies)),
+            ('p50_ms', percentile(latencies, 50)),
+            ('p95_ms', percentile(latencies, 95)),
+            ('p99_ms', percentile(latencies, 99)),
+            ('queries_per_request',
+             sum(queries) / len(queries) if queries else None),
+        ])
+
+    def compare(self, previous, current):
+        self.stdout.write('Compared with the run of %s:' % previous['started'])
+        for name, result in current['endpoints'].items():
+            before = previous['endpoints'].get(name)
+            if before is None:
+                continue
+            self.stdout.write(
+                '%-16s throughput %+6.1f%%  p95 %+6.1f%%  p99 %+6.1f%%' % (
+                    name,
+                    100.0 * result['throughput'] / before['throughput'] - 100,
+                    100.0 * result['p95_ms'] / before['p95_ms'] - 100,
+                    100.0 * result['p99_ms'] / before['p99_ms'] - 100))
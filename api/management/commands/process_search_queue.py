@@ -0,0 +1,47 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.models import QueuedIndexUpdate
+from api.signals import process_queue
+
+
+class Command(BaseCommand):
+    help = ('Send the objects queued by QueuedSignalProcessor to the search '
+            'index in bulk. Changes are held until a full batch builds up or '
+            'the oldest one reaches the maximum staleness.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.SEARCH_QUEUE_BATCH_SIZE)
+        parser.add_argument(
+            '--max-staleness', type=float,
+            default=settings.SEARCH_QUEUE_MAX_STALENESS,
+            help='Seconds a change may wait before being indexed.')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Empty the queue and exit instead of running forever.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        max_staleness = options['max_staleness']
+        while True:
+            if options['once']:
+                if not process_queue(batch_size):
+                    return
+                continue
+
+            oldest = QueuedIndexUpdate.objects.order_by('queued').values_list(
+                'queued', flat=True).first()
+            if oldest is None:
+                time.sleep(max_staleness / 2)
+                continue
+            age = (timezone.now() - oldest).total_seconds()
+            if (age < max_staleness and
+                    QueuedIndexUpdate.objects.count() < batch_size):
+                time.sleep(min(max_staleness - age, max_staleness / 2))
+                continue
+            processed = process_queue(batch_size)
+            if options['verbosity'] > 1:
+                self.stdout.write('Indexed %d queued objects' % processed)
@@ -0,0 +1,22 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from tourpoint.models import TourPointTombstone
+
+
+class Command(BaseCommand):
+    help = ('Delete the tombstones of removed tour points older than any '
+            'cursor a sync still accepts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=settings.SYNC_TOMBSTONE_MAX_AGE,
+            help='Seconds a tombstone is kept.')
+
+    def handle(self, *args, **options):
+        deleted, _ = TourPointTombstone.objects.filter(
+            removed__lt=timezone.now() - timedelta(
+                seconds=options['max_age'])).delete()
+        if options['verbosity'] > 1:
+            self.stdout.write('Deleted %d tombstones' % deleted)
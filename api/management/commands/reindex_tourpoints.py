@@ -0,0 +1,196 @@
+import json
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from django.db import connections as db_connections
+from django.db.models import Max, Min
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from haystack import connections
+from api.search_backends import failing_loudly
+from api.utils import bump_generations
+from tourpoint.models import TourPoint, TourPointTombstone
+
+
+# Writes committed this long after their `updated` time are still caught up.
+CATCH_UP_MARGIN = 60
+
+
+def setup_worker():
+    """
+    Forked workers must not share the database and Elasticsearch connections
+    of the parent process.
+    """
+    db_connections.close_all()
+    connections.reload('default')
+
+
+@contextmanager
+def indexing_into(index_name):
+    """
+    Send the updates of a block to `index_name` and let their errors raise,
+    a failed chunk must not be checkpointed. The backend is left as it was.
+    """
+    backend = connections['default'].get_backend()
+    alias, backend.index_name = backend.index_name, index_name
+    try:
+        with failing_loudly():
+            yield backend
+    finally:
+        backend.index_name = alias
+
+
+def index_chunk(args):
+    """
+    Index the tour points with primary keys in `[start, end)` in a single
+    bulk request.
+    """
+    index_name, start, end = args
+    index = connections['default'].get_unified_index().get_index(TourPoint)
+    queryset = index.index_queryset().filter(
+        pk__gte=start, pk__lt=end).order_by('pk')
+    with indexing_into(index_name) as backend:
+        backend.update(index, queryset, commit=False)
+    return start
+
+
+class Command(BaseCommand):
+    help = ('Index every tour point splitting the primary keys across a pool '
+            'of processes. Progress is checkpointed, so an interrupted run '
+            'picks up where it stopped. With --new-index the tour points go '
+            'to a brand new index and the alias is only moved to it once it '
+            'is complete, so searches never see a partial index. The changes '
+            'made meanwhile are indexed again before and after the swap. '
+            'The first --new-index run replaces the index named like the '
+            'alias, searches fail for the moment between its deletion and '
+            'the creation of the alias.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            default=multiprocessing.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--checkpoint', default='.reindex_tourpoints.json')
+        parser.add_argument(
+            '--new-index', action='store_true',
+            help='Build a new index and swap the alias when it is done.')
+        parser.add_argument(
+            '--keep-old', action='store_true',
+            help='Keep the indexes the alias pointed to before the swap.')
+
+    def handle(self, *args, **options):
+        backend = connections['default'].get_backend()
+        self.alias = backend.index_name
+        checkpoint = self.load_checkpoint(options)
+
+        bounds = TourPoint.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            self.stdout.write('There are no tour points to index.')
+            return
+        chunk_size = checkpoint['chunk_size']
+        done = set(checkpoint['done'])
+        chunks = [
+            (checkpoint['index'], start, start + chunk_size)
+            for start in range(bounds['first'], bounds['last'] + 1,
+                               chunk_size)
+            if start not in done]
+        self.stdout.write('Indexing %d chunks of %d tour points into %s, '
+                          '%d already done.' % (
+                              len(chunks), chunk_size, checkpoint['index'],
+                              len(done)))
+
+        started = time.time()
+        # Children are forked, they can't inherit open connections.
+        db_connections.close_all()
+        pool = multiprocessing.Pool(options['workers'],
+                                    initializer=setup_worker)
+        try:
+            for start in pool.imap_unordered(index_chunk, chunks):
+                checkpoint['done'].append(start)
+                self.save_checkpoint(options['checkpoint'], checkpoint)
+        finally:
+            pool.close()
+            pool.join()
+
+        if checkpoint['index'] != self.alias:
+            # The queue kept sending the changes to the old index.
+            caught_up = time.time()
+            self.catch_up(checkpoint['index'], checkpoint['started'])
+            backend.conn.indices.refresh(index=checkpoint['index'])
+            self.swap_alias(backend.conn, checkpoint['index'],
+                            options['keep_old'])
+            self.catch_up(checkpoint['index'], caught_up)
+            bump_generations(['tourpoints'])
+        backend.conn.indices.refresh(index=checkpoint['index'])
+        os.remove(options['checkpoint'])
+        self.stdout.write('Indexed %d chunks in %.1fs' % (
+            len(chunks), time.time() - started))
+
+    def load_checkpoint(self, options):
+        if os.path.exists(options['checkpoint']):
+            with open(options['checkpoint']) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            self.stdout.write('Resuming from %s' % options['checkpoint'])
+            return checkpoint
+        index = self.alias
+        if options['new_index']:
+            index = '%s_%s' % (self.alias, time.strftime('%Y%m%d%H%M%S'))
+        checkpoint = {'index': index, 'chunk_size': options['chunk_size'],
+                      'done': [], 'started': time.time()}
+        self.save_checkpoint(options['checkpoint'], checkpoint)
+        return checkpoint
+
+    def save_checkpoint(self, path, checkpoint):
+        with open(path + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.rename(path + '.tmp', path)
+
+    def catch_up(self, index_name, since):
+        """
+        Index again the tour points changed since the `since` timestamp and
+        drop the deleted ones, which the chunks may have missed.
+        """
+        since = datetime.fromtimestamp(since, timezone.utc) - timedelta(
+            seconds=CATCH_UP_MARGIN)
+        index = connections['default'].get_unified_index().get_index(
+            TourPoint)
+        changed = index.index_queryset().filter(updated__gte=since)
+        deleted = set(TourPointTombstone.objects.filter(
+            removed__gte=since).values_list('tourpoint_id', flat=True))
+        deleted -= set(TourPoint.objects.filter(pk__in=deleted).values_list(
+            'pk', flat=True))
+        with indexing_into(index_name) as backend:
+            backend.update(index, changed)
+            for pk in deleted:
+                backend.remove('%s.%s' % (TourPoint._meta.label_lower, pk))
+        self.stdout.write('Caught up %d changed and %d deleted tour points' % (
+            changed.count(), len(deleted)))
+
+    def swap_alias(self, conn, index, keep_old):
+        """
+        Point the alias to the new index in a single atomic operation.
+        """
+        if conn.indices.exists_alias(name=self.alias):
+            old = list(conn.indices.get_alias(name=self.alias))
+            conn.indices.update_aliases(body={'actions': [
+                {'remove': {'index': name, 'alias': self.alias}}
+                for name in old] + [
+                {'add': {'index': index, 'alias': self.alias}}]})
+        elif conn.indices.exists(index=self.alias):
+            # The first time around the alias name is taken by a concrete
+            # index, which has to go before the alias can be created.
+            # Elasticsearch 2 can't do both in one update, searches fail in
+            # between.
+            self.stdout.write('Replacing index %s with an alias, searches '
+                              'fail until it is created' % self.alias)
+            old = []
+            conn.indices.delete(index=self.alias)
+            conn.indices.put_alias(index=index, name=self.alias)
+        else:
+            old = []
+            conn.indices.put_alias(index=index, name=self.alias)
+        self.stdout.write('Alias %s now points to %s' % (self.alias, index))
+        if not keep_old:
+            for name in old:
+                conn.indices.delete(index=name)
@@ -0,0 +1,63 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api.utils import last_write
+from api.warmup import Warmer, learn_requests
+
+
+class Command(BaseCommand):
+    help = ('Refill the response cache by replaying the hot requests, the '
+            'CACHE_WARMUP_REQUESTS and the ones requested the most in access '
+            'logs, through the views. With --loop they are replayed again '
+            'after every write, before clients ask for them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--log', action='append', default=[],
+            help='Access log of nginx to learn the hot requests from.')
+        parser.add_argument('--top', type=int, default=50)
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep replaying the requests after each write.')
+        parser.add_argument(
+            '--interval', type=float, default=0.5,
+            help='Seconds between checks for writes.')
+        parser.add_argument(
+            '--refresh', type=float, default=settings.API_CACHE_TIMEOUT / 2,
+            help='Seconds after which the requests are replayed anyway, '
+                 'before their responses expire.')
+
+    def handle(self, *args, **options):
+        urls = list(settings.CACHE_WARMUP_REQUESTS)
+        urls.extend(url for url in learn_requests(options['log'],
+                                                  options['top'])
+                    if url not in urls)
+        warmer = Warmer()
+        written = last_write()
+        self.warm(warmer, urls, options['verbosity'])
+        if not options['loop']:
+            return
+
+        warmed = time.time()
+        while True:
+            time.sleep(options['interval'])
+            current = last_write()
+            if (current == written and
+                    time.time() - warmed < options['refresh']):
+                continue
+            written, warmed = current, time.time()
+            close_old_connections()
+            self.warm(warmer, urls, options['verbosity'])
+
+    def warm(self, warmer, urls, verbosity):
+        started = time.time()
+        results = warmer.warm(urls)
+        for url, status, seconds in results:
+            if status != 200:
+                self.stderr.write('%s answered %s' % (url, status))
+            elif verbosity > 1:
+                self.stdout.write('%8.1fms %s' % (seconds * 1000, url))
+        if verbosity > 0:
+            self.stdout.write('Warmed %d requests in %.1fms' % (
+                len(results), (time.time() - started) * 1000))
@@ -0,0 +1,317 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+
+
+METRIC_KEY_PREFIX = 'api:metric:'
+# Every sample ever flushed by any process, see `register`.
+SAMPLES = 'samples:'
+SAMPLES_KEY_PREFIX = METRIC_KEY_PREFIX + SAMPLES
+REGISTERED_KEY_PREFIX = METRIC_KEY_PREFIX + 'registered:'
+# Parts of a request timed by `span`, in the order of the Server-Timing header.
+SPANS = ('view', 'cache_key', 'cache', 'sql', 'elasticsearch', 'render')
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0)
+# Histograms and counters recorded by `record_request`.
+FAMILIES = tuple(
+    'api_%s_duration_seconds_%s' % (name, kind)
+    for name in ('request',) + SPANS
+    for kind in ('bucket', 'count', 'sum')) + (
+    'api_sql_queries_total', 'api_response_cache_total')
+HISTOGRAM_SUFFIXES = ('_bucket', '_count', '_sum')
+
+logger = logging.getLogger(__name__)
+
+
+def incr(name, value=1):
+    """
+    Add `value` to a counter shared by every process through the cache,
+    returning its new value.
+    """
+    key = METRIC_KEY_PREFIX + name
+    try:
+        return cache.incr(key, value)
+    except ValueError:
+        if cache.add(key, value, None):
+            return value
+        return cache.incr(key, value)
+
+
+def observe(name, seconds):
+    """
+    Count a call in `<name>.count` and add its duration, in microseconds, to
+    `<name>.us`, on the next flush, see `incr_later`.
+    """
+    incr_later(name + '.count')
+    incr_later(name + '.us', int(seconds * 1000000))
+
+
+@contextmanager
+def timed(name):
+    """
+    Observe the time spent in a block.
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - started)
+
+
+def read(names):
+    """
+    Current value of each counter, 0 for the ones never incremented.
+    """
+    values = cache.get_many([METRIC_KEY_PREFIX + name for name in names])
+    return dict((name, values.get(METRIC_KEY_PREFIX + name, 0))
+                for name in names)
+
+
+def reset(names):
+    cache.delete_many([METRIC_KEY_PREFIX + name for name in names])
+
+
+class RequestTimings(object):
+    """
+    Time spent in each span of a request and how many times it was entered,
+    along with the events counted by `count`.
+    """
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.events = Counter()
+
+
+_local = threading.local()
+
+
+def start_request():
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def end_request():
+    _local.timings = None
+
+
+@contextmanager
+def span(name):
+    """
+    Time a block as part of the `name` span of the current request. Outside
+    of a request it costs nothing but the check.
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.seconds[name] += time.perf_counter() - started
+        timings.calls[name] += 1
+
+
+def count(event):
+    """
+    Count an event of the current request.
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.events[event] += 1
+
+
+def server_timing(timings, total):
+    """
+    `Server-Timing` header of a request.
+    """
+    parts = []
+    for name in SPANS:
+        if name in timings.calls:
+            parts.append('%s;dur=%.3f;desc="%d calls"' % (
+                name, timings.seconds[name] * 1000, timings.calls[name]))
+    parts.append('total;dur=%.3f' % (total * 1000))
+    return ', '.join(parts)
+
+
+_pending = Counter()
+# Counters added up by `incr_later`.
+_pending_counters = Counter()
+_pending_lock = threading.Lock()
+# Process whose flusher thread is running, forked workers start their own.
+_flusher_pid = None
+
+
+def _observe_duration(family, labels, seconds):
+    for bound in DURATION_BUCKETS:
+        if seconds <= bound:
+            _pending['%s_bucket{%s,le="%s"}' % (family, labels, bound)] += 1
+    _pending['%s_bucket{%s,le="+Inf"}' % (family, labels)] += 1
+    _pending['%s_count{%s}' % (family, labels)] += 1
+    # in microseconds, counters only take integers
+    _pending['%s_sum{%s}' % (family, labels)] += int(seconds * 1000000)
+
+
+def record_request(endpoint, timings, total):
+    """
+    Add a request to the histograms of its endpoint. They are kept by the
+    process and added to the shared counters by a background thread every
+    `API_METRICS_FLUSH_INTERVAL` seconds, so recording takes no round trip
+    to the cache.
+    """
+    labels = 'endpoint="%s"' % endpoint
+    with _pending_lock:
+        _observe_duration('api_request_duration_seconds', labels, total)
+        for name in SPANS:
+            if name in timings.calls:
+                _observe_duration('api_%s_duration_seconds' % name, labels,
+                                  timings.seconds[name])
+        _pending['api_sql_queries_total{%s}' % labels] += timings.calls['sql']
+        for event, value in timings.events.items():
+            key_constructor, result = event.rsplit('.', 1)
+            sample = ('api_response_cache_total{%s,key_constructor="%s",'
+                      'result="%s"}' % (labels, key_constructor, result))
+            _pending[sample] += value
+    start_flusher()
+
+
+def incr_later(name, value=1):
+    """
+    Like `incr`, but the process keeps the count and adds it to the shared
+    counter on the next flush, so it takes no round trip to the cache.
+    """
+    with _pending_lock:
+        _pending_counters[name] += value
+    start_flusher()
+
+
+def start_flusher():
+    """
+    Start the thread flushing the samples of this process, once per
+    process.
+    """
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _pending_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_forever, name='api-metrics-flusher',
+                     daemon=True).start()
+
+
+def _flush_forever():
+    while True:
+        time.sleep(settings.API_METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logger.exception('Failed to flush the API metrics')
+
+
+def flush():
+    """
+    Add the samples and the counters recorded by this process to the shared
+    counters, and register the new samples, see `register`.
+    """
+    global _pending, _pending_counters
+    with _pending_lock:
+        pending, _pending = _pending, Counter()
+        counters, _pending_counters = _pending_counters, Counter()
+    for name, value in counters.items():
+        incr(name, value)
+    if not pending:
+        return
+    register(pending)
+    for sample, value in pending.items():
+        incr(sample, value)
+
+
+def register(samples):
+    """
+    Make samples show up in `prometheus`. Each family keeps its sample
+    names in numbered slots, only the process adding the `registered` key
+    of a sample takes a new slot for it, so no name is ever overwritten.
+    """
+    registered = cache.get_many(
+        [REGISTERED_KEY_PREFIX + sample for sample in samples])
+    for sample in samples:
+        if REGISTERED_KEY_PREFIX + sample in registered:
+            continue
+        if cache.add(REGISTERED_KEY_PREFIX + sample, True, None):
+            family = sample.split('{', 1)[0]
+            slot = incr(SAMPLES + family)
+            cache.set('%s%s:%s' % (SAMPLES_KEY_PREFIX, family, slot), sample,
+                      None)
+
+
+def samples():
+    """
+    Every registered sample, family by family.
+    """
+    sizes = cache.get_many([SAMPLES_KEY_PREFIX + family
+                            for family in FAMILIES])
+    keys = ['%s%s:%s' % (SAMPLES_KEY_PREFIX, family, slot)
+            for family in FAMILIES
+            for slot in range(
+                1, sizes.get(SAMPLES_KEY_PREFIX + family, 0) + 1)]
+    return sorted(set(cache.get_many(keys).values()), key=sample_order)
+
+
+def split_sample(sample):
+    """
+    `(family, kind, suffix)` of a sample, the suffix of the histogram
+    samples is empty for the counters.
+    """
+    name = sample.split('{', 1)[0]
+    for suffix in HISTOGRAM_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)], 'histogram', suffix
+    return name, 'counter', ''
+
+
+def sample_order(sample):
+    """
+    Sort key keeping each family and each of its series together, with the
+    buckets by increasing `le`, `+Inf` last, as Prometheus expects them.
+    """
+    family, _, suffix = split_sample(sample)
+    labels = sample.partition('{')[2].rstrip('}')
+    bound = 0.0
+    if suffix == '_bucket':
+        # `le` is the last label, see `_observe_duration`
+        labels, _, le = labels.rpartition('le="')
+        labels, bound = labels.rstrip(','), float(le.rstrip('"'))
+    position = HISTOGRAM_SUFFIXES.index(suffix) if suffix else 0
+    return family, labels, position, bound
+
+
+def prometheus(counters=()):
+    """
+    Every flushed sample in the Prometheus text format, along with the
+    `counters` incremented with `incr`.
+    """
+    names = samples()
+    values = cache.get_many([METRIC_KEY_PREFIX + sample for sample in names])
+    lines, families = [], set()
+    for sample in names:
+        family, kind, _ = split_sample(sample)
+        if family not in families:
+            families.add(family)
+            lines.append('# TYPE %s %s' % (family, kind))
+        value = values.get(METRIC_KEY_PREFIX + sample, 0)
+        if sample.startswith(family + '_sum'):
+            value = value / 1000000
+        lines.append('%s %s' % (sample, value))
+    for name, value in sorted(read(counters).items()):
+        family = 'api_%s_total' % name.replace('.', '_')
+        lines.append('# TYPE %s counter' % family)
+        lines.append('%s %s' % (family, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,32 @@
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from api import metrics
+
+
+class ServerTimingMiddleware(object):
+    """
+    Time every request, with the spans timed by `metrics.span` along the
+    way, sending them back in a `Server-Timing` header and adding them to
+    the histograms of the endpoint. Goes first, so the other middlewares are
+    timed as well.
+    """
+
+    def __init__(self, get_response):
+        if not settings.API_METRICS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end_request()
+        total = time.perf_counter() - started
+        response['Server-Timing'] = metrics.server_timing(timings, total)
+        if request.resolver_match is not None:
+            metrics.record_request(
+                request.resolver_match.view_name, timings, total)
+        return response
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedindexupdate',
+            name='scopes',
+            field=models.TextField(blank=True, default='', help_text='Space separated cache scopes of the search responses the object shows up in, bumped once it is indexed'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from api import metrics
+from api.cache import cache_response, conditional_response
+from api.utils import (
+    default_list_cache_key_func,
+    default_object_cache_key_func,
+)
+
+
+class ConditionalCacheResponseMixin(object):
+    """
+    Like `CacheResponseAndETAGMixin`, but conditional requests are answered
+    before any queryset is built, see `conditional_response`, and concurrent
+    misses are rebuilt once, see `cache_response`.
+    """
+
+    @conditional_response()
+    @cache_response(key_func=default_list_cache_key_func)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_response()
+    @cache_response(key_func=default_object_cache_key_func)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+
+class TimedViewMixin(object):
+    """
+    Time the view, authentication and serialization included, as the `view`
+    span of the request.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with metrics.span('view'):
+            return super().dispatch(request, *args, **kwargs)
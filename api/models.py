@@ -0,0 +1,32 @@
+from django.db import models
+from django.utils import timezone
+
+
+class QueuedIndexUpdate(models.Model):
+    """
+    An object waiting to be updated on or removed from the search index.
+    There is a single row per object, so repeated changes collapse into the
+    last one.
+    """
+    UPDATE = 'update'
+    REMOVE = 'remove'
+    ACTIONS = (
+        (UPDATE, 'update'),
+        (REMOVE, 'remove'),
+    )
+
+    model = models.CharField(max_length=100,
+                             help_text='app_label.model_name of the object')
+    object_id = models.CharField(max_length=64)
+    action = models.CharField(choices=ACTIONS, max_length=6)
+    queued = models.DateTimeField(default=timezone.now, db_index=True)
+    scopes = models.TextField(
+        blank=True, default='',
+        help_text='Space separated cache scopes of the search responses the '
+                  'object shows up in, bumped once it is indexed')
+
+    class Meta:
+        unique_together = ('model', 'object_id')
+
+    def __str__(self):
+        return '%s %s.%s' % (self.action, self.model, self.object_id)
@@ -0,0 +1,336 @@
+import base64
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from api.utils import hyperlink_template
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on `(created, id)`, newest first.
+
+    Every page is an index range scan starting right after the row the cursor
+    points to, so deep pages cost the same as the first one and no COUNT(*)
+    is ever needed.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    # PaginationKeyBit looks for `page_query_param` to build the cache key,
+    # so every page is cached on its own.
+    page_query_param = cursor_query_param
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_branches([queryset], request, view=view)
+
+    def paginate_branches(self, branches, request, view=None):
+        """
+        Page through the UNION ALL of disjoint querysets. Each branch is
+        filtered on its own, so the database can walk every branch index in
+        order and merge them instead of scanning the whole table.
+        """
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor[2]
+
+        rows = list(self.get_page_queryset(branches))
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        self.next_position = self.previous_position = None
+        if rows:
+            if has_more or reverse:
+                self.next_position = self.get_position(rows[-1])
+            if (has_more and reverse) or (
+                    self.cursor is not None and not reverse):
+                self.previous_position = self.get_position(rows[0])
+        return rows
+
+    def get_page_queryset(self, branches):
+        """
+        The query for the current page plus one row, telling if there are
+        more pages.
+        """
+        branches = [self.filter_after_cursor(branch) for branch in branches]
+        queryset = branches[0]
+        if len(branches) > 1:
+            queryset = queryset.union(*branches[1:], all=True)
+        if self.cursor is not None and self.cursor[2]:
+            queryset = queryset.order_by('created', 'id')
+        else:
+            queryset = queryset.order_by('-created', '-id')
+        return queryset[:self.page_size + 1]
+
+    def filter_after_cursor(self, queryset):
+        """
+        Filter the queryset to the rows after the cursor, in page order.
+        """
+        if self.cursor is None:
+            return queryset
+        created, pk, reverse = self.cursor
+        if reverse:
+            return queryset.filter(
+                Q(created__gt=created) | Q(created=created, id__gt=pk))
+        return queryset.filter(
+            Q(created__lt=created) | Q(created=created, id__lt=pk))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_position(self, row):
+        if isinstance(row, dict):
+            return row['created'], row['id']
+        return row.created, row.pk
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            decoded = force_text(base64.urlsafe_b64decode(encoded.encode()))
+            created, pk, reverse = decoded.split('|')
+            created = parse_datetime(created)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created, pk, reverse == 'r'
+
+    def encode_cursor(self, position, reverse):
+        created, pk = position
+        cursor = '%s|%s|%s' % (created.isoformat(), pk, 'r' if reverse else '')
+        encoded = force_text(base64.urlsafe_b64encode(cursor.encode()))
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, encoded)
+
+
+class DistancePagination(KeysetPagination):
+    """
+    Cursor pagination on `(distance, id)` for the radius search, nearest
+    first.
+
+    A page asks the engine for the `limit` nearest results past the cursor,
+    so Elasticsearch and the memory engine keep a bounded top-K instead of
+    sorting every match, whatever the number of tour points in the radius.
+    Pages only go forward.
+    """
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is not None:
+            queryset = queryset.after(*self.cursor)
+
+        results = list(queryset[:self.page_size + 1])
+        self.next_position = self.previous_position = None
+        if len(results) > self.page_size:
+            results = results[:self.page_size]
+            self.next_position = self.get_position(results[-1])
+        return results
+
+    def get_position(self, result):
+        return result.distance.km, int(result.pk)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            decoded = force_text(base64.urlsafe_b64decode(encoded.encode()))
+            km, pk = decoded.split('|')
+            return float(km), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position, reverse):
+        # repr keeps every digit, so the next page starts exactly there
+        cursor = '%r|%s' % position
+        encoded = force_text(base64.urlsafe_b64encode(cursor.encode()))
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, encoded)
+
+
+class CursorExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'The cursor expired, sync again from scratch.'
+    default_code = 'cursor_expired'
+
+
+class SyncPagination(KeysetPagination):
+    """
+    Delta sync of a list: the tour points created or updated and the
+    tombstones recorded since the cursor, oldest change first.
+
+    Both are read on `(updated, id)` and `(removed, id)` index ranges right
+    after the cursor and merged, so a sync costs as much as the changes it
+    returns, whatever the size of the list. Each page carries the cursor to
+    send next, the last one too.
+
+    Changes younger than `SYNC_LAG` seconds are left for the next sync, the
+    transactions writing them may not have committed yet and would be
+    skipped otherwise. Writes must commit within `SYNC_LAG` seconds of the
+    `updated` time they set, bulk ones stamp it with the clock in their last
+    statement, see `import_tourpoints`. Tombstones older than
+    `SYNC_TOMBSTONE_MAX_AGE` seconds are pruned, so older cursors are
+    refused, and a first sync, without a cursor, gets none.
+    """
+    page_size = 200
+    max_page_size = 1000
+    cursor_query_param = 'since'
+    page_query_param = cursor_query_param
+    # Order of the changes with the same time, a save recording a tombstone
+    # is synced after it.
+    TOMBSTONE, TOURPOINT = 0, 1
+
+    def paginate_changes(self, branches, tombstones, request, view=None):
+        """
+        Page through the changes of the UNION ALL of disjoint querysets of
+        `.values()` rows, as `paginate_branches` does, and of the tombstones.
+        Returns the rows, the ids of the removed tour points are kept for
+        the response.
+        """
+        self.request = request
+        self.format = getattr(view, 'format_kwarg', None)
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+        now = timezone.now()
+        if self.cursor is not None and self.cursor[0] < now - timedelta(
+                seconds=settings.SYNC_TOMBSTONE_MAX_AGE):
+            raise CursorExpired()
+        cutoff = now - timedelta(seconds=settings.SYNC_LAG)
+
+        queryset = self.filter_changes(branches[0], 'updated', self.TOURPOINT,
+                                       cutoff)
+        if len(branches) > 1:
+            queryset = queryset.union(*[
+                self.filter_changes(branch, 'updated', self.TOURPOINT, cutoff)
+                for branch in branches[1:]], all=True)
+        changes = [((row['updated'], self.TOURPOINT, row['id']), row)
+                   for row in queryset.order_by(
+                       'updated', 'id')[:self.page_size + 1]]
+        if self.cursor is not None:
+            # A first sync has nothing to remove.
+            tombstones = self.filter_changes(
+                tombstones.values('id', 'tourpoint_id', 'removed'),
+                'removed', self.TOMBSTONE, cutoff)
+            changes = sorted(changes + [
+                ((row['removed'], self.TOMBSTONE, row['id']), row)
+                for row in tombstones.order_by(
+                    'removed', 'id')[:self.page_size + 1]],
+                key=lambda change: change[0])
+
+        self.has_more = len(changes) > self.page_size
+        changes = changes[:self.page_size]
+        if self.has_more:
+            self.position = changes[-1][0]
+        else:
+            # Everything before the cutoff was seen, start from there.
+            self.position = max(self.cursor or (cutoff, self.TOMBSTONE, 0),
+                                (cutoff, self.TOMBSTONE, 0))
+        self.removed = list(OrderedDict.fromkeys(
+            row['tourpoint_id'] for (_, kind, _), row in changes
+            if kind == self.TOMBSTONE))
+        return [row for (_, kind, _), row in changes
+                if kind == self.TOURPOINT]
+
+    def filter_changes(self, queryset, field, kind, cutoff):
+        """
+        Filter the queryset to the changes between the cursor and the cutoff.
+        """
+        queryset = queryset.filter(**{field + '__lt': cutoff})
+        if self.cursor is None:
+            return queryset
+        time, cursor_kind, pk = self.cursor
+        if kind > cursor_kind:
+            return queryset.filter(**{field + '__gte': time})
+        if kind < cursor_kind:
+            return queryset.filter(**{field + '__gt': time})
+        return queryset.filter(
+            Q(**{field + '__gt': time}) | Q(**{field: time, 'id__gt': pk}))
+
+    def get_paginated_response(self, data):
+        """
+        Clients remove the tour points in `removed` first, then store the
+        ones in `results`.
+        """
+        tourpoint_url = hyperlink_template(
+            'tourpoint-detail', self.request, self.format)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('cursor', self.encode_position(self.position)),
+            ('results', data),
+            ('removed', [tourpoint_url(pk) for pk in self.removed]),
+        ]))
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   self.encode_position(self.position))
+
+    def get_previous_link(self):
+        return None
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            # a first sync gets everything
+            return None
+        try:
+            decoded = force_text(base64.urlsafe_b64decode(encoded.encode()))
+            time, kind, pk = decoded.split('|')
+            time = parse_datetime(time)
+            kind, pk = int(kind), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if time is None or kind not in (self.TOMBSTONE, self.TOURPOINT):
+            raise NotFound(self.invalid_cursor_message)
+        return time, kind, pk
+
+    def encode_position(self, position):
+        time, kind, pk = position
+        cursor = '%s|%s|%s' % (time.isoformat(), kind, pk)
+        return force_text(base64.urlsafe_b64encode(cursor.encode()))
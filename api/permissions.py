@@ -13,5 +13,6 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        # Instance must have an attribute named `owner`.
-        return obj.owner == request.user
+        # Instance must have an attribute named `owner`, compared by id so
+        # the owner isn't loaded.
+        return obj.owner_id == request.user.pk
@@ -0,0 +1,37 @@
+from django.db.backends.postgresql import base
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from api import metrics
+
+
+class TimedCursorMixin(object):
+    """
+    Time every query as the `sql` span of the request.
+    """
+
+    def execute(self, sql, params=None):
+        with metrics.span('sql'):
+            return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        with metrics.span('sql'):
+            return super().executemany(sql, param_list)
+
+
+class TimedCursorWrapper(TimedCursorMixin, CursorWrapper):
+    pass
+
+
+class TimedCursorDebugWrapper(TimedCursorMixin, CursorDebugWrapper):
+    pass
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The PostgreSQL backend with its queries timed, see `metrics.span`.
+    """
+
+    def make_cursor(self, cursor):
+        return TimedCursorWrapper(cursor, self)
+
+    def make_debug_cursor(self, cursor):
+        return TimedCursorDebugWrapper(cursor, self)
@@ -0,0 +1,12 @@
+from rest_framework import renderers
+from api import metrics
+
+
+class TimedJSONRenderer(renderers.JSONRenderer):
+    """
+    JSON renderer timed as the `render` span of the request.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with metrics.span('render'):
+            return super().render(data, accepted_media_type, renderer_context)
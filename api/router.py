@@ -19,6 +19,9 @@ urlpatterns = [
         url(r'^', include(router.urls)),
         url(r'^auth/', include('rest_auth.urls', namespace='auth')),
         url(r'^auth/facebook/$', FacebookLogin.as_view(), name='facebook-login'),
+        url(r'^tiles/(?P<category>[a-z]+)/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)/$',
+            views.TileView.as_view(), name='tile'),
+        url(r'^metrics/$', views.MetricsView.as_view(), name='metrics'),
         url(r'^$', views.APIRootView.as_view(), name='api-root'),
     ]))
 ]
@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from django.conf import settings
+from haystack import connections
+from haystack.backends.elasticsearch_backend import (
+    ElasticsearchSearchBackend,
+    ElasticsearchSearchEngine,
+    ElasticsearchSearchQuery,
+)
+from haystack.query import SearchQuerySet
+from api import metrics
+
+
+@contextmanager
+def failing_loudly(using='default'):
+    """
+    Let the searches of a block raise their errors instead of logging them
+    and returning no results, for `api.breaker` to see them. Backends are
+    kept per thread, other requests are not affected.
+    """
+    backend = connections[using].get_backend()
+    silently_fail, backend.silently_fail = backend.silently_fail, False
+    try:
+        yield
+    finally:
+        backend.silently_fail = silently_fail
+
+
+class SearchTimeoutConnection(object):
+    """
+    Elasticsearch client giving up on searches after `SEARCH_TIMEOUT`
+    seconds. Other requests, like bulk indexing, keep the timeout of the
+    connection.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def search(self, *args, **kwargs):
+        kwargs.setdefault('request_timeout', settings.SEARCH_TIMEOUT)
+        return self.conn.search(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class FilterContextSearchBackend(ElasticsearchSearchBackend):
+    """
+    Elasticsearch backend accepting raw filters to apply in filter context,
+    where they are neither scored nor analyzed, and get cached by
+    Elasticsearch. Searches give up after `SEARCH_TIMEOUT` seconds and are
+    timed as the `elasticsearch` span of the request.
+    """
+
+    def __init__(self, connection_alias, **connection_options):
+        super().__init__(connection_alias, **connection_options)
+        self.conn = SearchTimeoutConnection(self.conn)
+
+    def search(self, query_string, **kwargs):
+        with metrics.span('elasticsearch'):
+            return super().search(query_string, **kwargs)
+
+    def build_search_kwargs(self, query_string, context_filters=None,
+                            **kwargs):
+        search_kwargs = super().build_search_kwargs(query_string, **kwargs)
+        if not context_filters:
+            return search_kwargs
+        query = search_kwargs['query']
+        filters = list(context_filters)
+        if 'filtered' in query:
+            if 'filter' in query['filtered']:
+                filters.insert(0, query['filtered']['filter'])
+        else:
+            query = search_kwargs['query'] = {'filtered': {'query': query}}
+        query['filtered']['filter'] = {'bool': {'must': filters}}
+        return search_kwargs
+
+
+class FilterContextSearchQuery(ElasticsearchSearchQuery):
+    """
+    Search query carrying the filters for `FilterContextSearchBackend`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.context_filters = []
+
+    def add_context_filter(self, context_filter):
+        self.context_filters.append(context_filter)
+
+    def build_params(self, *args, **kwargs):
+        search_kwargs = super().build_params(*args, **kwargs)
+        if self.context_filters:
+            search_kwargs['context_filters'] = self.context_filters
+        return search_kwargs
+
+    def _clone(self, klass=None, using=None):
+        clone = super()._clone(klass=klass, using=using)
+        clone.context_filters = list(self.context_filters)
+        return clone
+
+
+class FilterContextSearchEngine(ElasticsearchSearchEngine):
+    backend = FilterContextSearchBackend
+    query = FilterContextSearchQuery
+
+
+class FilterContextSearchQuerySet(SearchQuerySet):
+
+    def context_filter(self, *context_filters):
+        """
+        Narrow the results with raw Elasticsearch filters, e.g.
+        `{'term': {'private': False}}`.
+        """
+        clone = self._clone()
+        for context_filter in context_filters:
+            clone.query.add_context_filter(context_filter)
+        return clone
+
+
+class DistanceSearchQuerySet(FilterContextSearchQuerySet):
+
+    def after(self, km, pk):
+        """
+        Results coming after `(km, pk)` when sorted with
+        `order_by('distance', 'tourpoint_id')`, for keyset pagination.
+        """
+        distance_point = self.query.distance_point
+        lng, lat = distance_point['point'].coords
+        # Same distance computation as the `_geo_distance` sort.
+        origin = {distance_point['field']: [lng, lat], 'unit': 'km',
+                  'distance_type': 'sloppy_arc'}
+        return self.context_filter({'bool': {'should': [
+            {'geo_distance_range': dict(origin, gt=km)},
+            {'bool': {'must': [
+                {'geo_distance_range': dict(origin, gte=km, lte=km)},
+                {'range': {'tourpoint_id': {'gt': pk}}}]}}]}})
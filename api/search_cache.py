@@ -0,0 +1,195 @@
+import time
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from haystack.utils.geo import D, Point
+from api import geo, metrics
+from api.search_backends import DistanceSearchQuerySet
+from api.utils import get_generations
+from tourpoint.models import CATEGORIES, TourPoint
+
+
+CELL_KEY_PREFIX = 'api:geocell:'
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Fields kept for every tour point of a cell, as `TourPointLocationSerializer`
+# needs them.
+ROW_FIELDS = ('pk', 'name', 'category', 'latitude', 'longitude', 'private',
+              'owner', 'owner_id')
+METRICS = ('geo_search.cell_hit', 'geo_search.cell_miss',
+           'geo_search.cell_overflow', 'geo_search.cached.count',
+           'geo_search.cached.us', 'geo_search.elasticsearch.count',
+           'geo_search.elasticsearch.us')
+
+
+def geohash(lat, lng, precision):
+    """
+    Geohash of a point with `precision` characters, along with the
+    `(min, max)` latitude and longitude of its cell.
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = count = 0
+    even = True
+    while len(chars) < precision:
+        value_range, value = (lng_range, lng) if even else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        count += 1
+        if count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = count = 0
+    return ''.join(chars), tuple(lat_range), tuple(lng_range)
+
+
+def snap(lat, lng, km):
+    """
+    Snap a radius search to the geohash cell of the point and the smallest
+    radius bucket around the center of the cell covering the whole search,
+    returning `(geohash, center_lat, center_lng, radius)`. None when no
+    bucket is large enough.
+    """
+    cell, lat_range, lng_range = geohash(
+        lat, lng, settings.GEO_SEARCH_CACHE_PRECISION)
+    center_lat, center_lng = sum(lat_range) / 2, sum(lng_range) / 2
+    corners_lat = np.array([lat_range[0], lat_range[0],
+                            lat_range[1], lat_range[1]])
+    corners_lng = np.array([lng_range[0], lng_range[1],
+                            lng_range[0], lng_range[1]])
+    reach = geo.haversine(center_lat, center_lng, corners_lat,
+                          corners_lng).max()
+    for radius in sorted(settings.GEO_SEARCH_CACHE_RADII):
+        if radius >= km + reach:
+            return cell, center_lat, center_lng, radius
+    return None
+
+
+def cell_parts(user):
+    """
+    The cached slices a user sees, as `(name, scopes, filters)`. Public tour
+    points are shared by everybody, anonymous users only keep the
+    restaurants, private ones are cached per owner.
+    """
+    public = ('public',
+              ['tourpoints'] + ['public:%s' % category
+                                for category, _ in CATEGORIES],
+              [{'term': {'private': False}}])
+    if user.is_anonymous():
+        return [public]
+    return [public, ('owner:%s' % user.pk,
+                     ['tourpoints', 'owner:%s' % user.pk],
+                     [{'term': {'private': True}},
+                      {'term': {'owner_id': user.pk}}])]
+
+
+def fetch_cell(center_lat, center_lng, radius, filters):
+    """
+    Tour points within `radius` of the center of a cell, as tuples of
+    `ROW_FIELDS`. None when there are more than `GEO_SEARCH_CACHE_MAX_ROWS`.
+    """
+    limit = settings.GEO_SEARCH_CACHE_MAX_ROWS
+    results = DistanceSearchQuerySet().models(TourPoint).dwithin(
+        'coordinates', Point(center_lng, center_lat), D(km=radius)
+    ).context_filter(*filters)[:limit + 1]
+    if len(results) > limit:
+        return None
+    return [(int(result.pk),) + tuple(
+        getattr(result, field) for field in ROW_FIELDS[1:])
+        for result in results]
+
+
+def get_cell_rows(cell, user):
+    """
+    Rows of every tour point `user` may see in a snapped cell, from the
+    cache when possible. None when a slice has too many rows to be cached.
+    """
+    geohash_, center_lat, center_lng, radius = cell
+    parts = cell_parts(user)
+    generations = get_generations(
+        [scope for _, scopes, _ in parts for scope in scopes])
+    keys, offset = [], 0
+    for name, scopes, _ in parts:
+        keys.append('%s%s:%s:%s:%s' % (
+            CELL_KEY_PREFIX, name, geohash_, radius, '.'.join(
+                map(str, generations[offset:offset + len(scopes)]))))
+        offset += len(scopes)
+
+    cached = cache.get_many(keys)
+    rows = []
+    for key, (_, _, filters) in zip(keys, parts):
+        if key in cached:
+            metrics.incr_later('geo_search.cell_hit')
+            part = cached[key]
+        else:
+            metrics.incr_later('geo_search.cell_miss')
+            part = fetch_cell(center_lat, center_lng, radius, filters)
+            # An overflowing cell is remembered as False, so it isn't
+            # fetched again until it changes.
+            cache.set(key, part if part is not None else False,
+                      settings.GEO_SEARCH_CACHE_TIMEOUT)
+        if part is None or part is False:
+            metrics.incr_later('geo_search.cell_overflow')
+            return None
+        rows.extend(part)
+    if user.is_anonymous():
+        rows = [row for row in rows if row[2] == 'restaurant']
+    return rows
+
+
+class QuantizedSearchResults(object):
+    """
+    Radius search answered from the cached tour points of the snapped cell,
+    filtered and sorted for the exact point and radius of the request.
+
+    Behaves like the `DistanceSearchQuerySet` it wraps, which still answers
+    the searches too large to be cached.
+    """
+
+    def __init__(self, queryset, lat, lng, km, user, after=None, bbox=None):
+        self.queryset = queryset
+        self.lat, self.lng, self.km = lat, lng, km
+        self.user = user
+        self.after_position, self.bbox = after, bbox
+
+    @property
+    def query(self):
+        return self.queryset.query
+
+    def after(self, km, pk):
+        return QuantizedSearchResults(
+            self.queryset.after(km, pk), self.lat, self.lng, self.km,
+            self.user, after=(km, pk), bbox=self.bbox)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.start:
+            raise TypeError('Only the first results can be taken')
+        started = time.time()
+        cell = snap(self.lat, self.lng, self.km)
+        rows = get_cell_rows(cell, self.user) if cell else None
+        if rows is not None:
+            hits = self.hits(rows, index.stop)
+            metrics.observe('geo_search.cached', time.time() - started)
+            return hits
+        with metrics.timed('geo_search.elasticsearch'):
+            return list(self.queryset[index])
+
+    def hits(self, rows, limit):
+        if not rows:
+            return []
+        columns = dict(zip(ROW_FIELDS, zip(*rows)))
+        pks = np.array(columns['pk'], dtype=np.int64)
+        # (lat, lng) is (longitude, latitude), see `geo.point_of`
+        lats = np.array(columns['longitude'], dtype=np.float64)
+        lngs = np.array(columns['latitude'], dtype=np.float64)
+        distances = geo.haversine(self.lat, self.lng, lats, lngs)
+        if self.bbox is not None:
+            distances[~geo.in_bbox(lats, lngs, self.bbox)] = np.inf
+        order = geo.nearest(distances, pks, self.km, limit,
+                            self.after_position)
+        return [geo.GeoHit(*(rows[i] + (D(km=float(distances[i])),)))
+                for i in order]
@@ -6,15 +6,30 @@ class TourPointLocationIndex(indexes.SearchIndex, indexes.Indexable):
     """
     Index the TourPoint objects, defines which attributes will be indexed, 
     so we can serach for them.
+
+    Every field of the search response is stored here, so results are built
+    without going to the database.
     """
     text = indexes.CharField(document=True)
     name = indexes.CharField(model_attr='name')
-    category = indexes.CharField(model_attr='category')
+    # faceted adds the not analyzed `category_exact` to filter on
+    category = indexes.CharField(model_attr='category', faceted=True)
     coordinates = indexes.LocationField(model_attr="coordinates")
     private = indexes.BooleanField(model_attr='private')
     longitude = indexes.FloatField(model_attr='longitude')
     latitude = indexes.FloatField(model_attr='latitude')
-    owner = indexes.CharField(model_attr='owner')
+    owner = indexes.CharField(model_attr='owner__username')
+    owner_id = indexes.IntegerField(model_attr='owner_id')
+    # `django_id` is a string, ties of distance are broken on this one so
+    # they come in the numeric order of the other engines.
+    tourpoint_id = indexes.IntegerField(model_attr='pk')
 
     def get_model(self):
         return TourPoint
+
+    def index_queryset(self, using=None):
+        """
+        Load the owners along, `owner` would take a query per tour point
+        otherwise.
+        """
+        return self.get_model().objects.select_related('owner')
@@ -1,9 +1,51 @@
+from collections import Counter, OrderedDict
+from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
 from tourpoint.models import TourPoint
 from drf_haystack.serializers import HaystackSerializer
 from api.search_indexes import TourPointLocationIndex
-from api.validators import coodinates_validor
+from api.utils import hyperlink_template
+from api.validators import bbox_validator, coodinates_validor
+
+
+class TourPointListSerializer(serializers.ListSerializer):
+    """
+    Creates many tour points with bulk inserts.
+    """
+    unique_message = 'tour point with this name already exists.'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Names are checked for the whole batch at once, see
+        # `to_internal_value`, instead of one query per tour point.
+        name = self.child.fields['name']
+        name.validators = [validator for validator in name.validators
+                           if not isinstance(validator, UniqueValidator)]
+
+    def to_internal_value(self, data):
+        tourpoints = super().to_internal_value(data)
+        names = Counter(tourpoint['name'] for tourpoint in tourpoints)
+        taken = set(TourPoint.objects.filter(
+            name__in=list(names)).values_list('name', flat=True))
+        errors = []
+        for tourpoint in tourpoints:
+            if tourpoint['name'] in taken:
+                errors.append({'name': [self.unique_message]})
+            elif names[tourpoint['name']] > 1:
+                errors.append(
+                    {'name': ['Tour point name repeated in this batch.']})
+            else:
+                errors.append({})
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return tourpoints
+
+    def create(self, validated_data):
+        return TourPoint.objects.bulk_create(
+            [TourPoint(**attrs) for attrs in validated_data],
+            batch_size=settings.TOURPOINT_BULK_CREATE_BATCH_SIZE)
 
 
 class TourPointSerializer(serializers.HyperlinkedModelSerializer):
@@ -20,6 +62,43 @@ class TourPointSerializer(serializers.HyperlinkedModelSerializer):
         model = TourPoint
         fields = ('url', 'name', 'category', 'owner', 'longitude', 'latitude',
                   'private')
+        list_serializer_class = TourPointListSerializer
+
+
+class TourPointRowSerializer(object):
+    """
+    Read only fast path for `TourPointSerializer`.
+
+    It takes the rows of `.values(*TourPointRowSerializer.values)` instead of
+    model instances and reverses the urls only once per request, using
+    `owner_id` for the owner link. The output is exactly the same as
+    `TourPointSerializer(many=True).data`, the `format` of the context
+    included.
+    """
+    values = ('id', 'name', 'category', 'owner_id', 'longitude', 'latitude',
+              'private', 'created')
+
+    def __init__(self, rows, context):
+        self.rows = rows
+        request, format = context['request'], context.get('format')
+        self.tourpoint_url = hyperlink_template(
+            'tourpoint-detail', request, format)
+        self.owner_url = hyperlink_template('user-detail', request, format)
+
+    def to_representation(self, row):
+        return OrderedDict((
+            ('url', self.tourpoint_url(row['id'])),
+            ('name', row['name']),
+            ('category', row['category']),
+            ('owner', self.owner_url(row['owner_id'])),
+            ('longitude', row['longitude']),
+            ('latitude', row['latitude']),
+            ('private', row['private']),
+        ))
+
+    @property
+    def data(self):
+        return [self.to_representation(row) for row in self.rows]
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -59,7 +138,26 @@ class TourPointLocationSerializer(HaystackSerializer):
 
 class SearchQueryParamsSerializer(serializers.Serializer):
     from_ = serializers.CharField(validators=[coodinates_validor])
-    km = serializers.FloatField()
+    km = serializers.FloatField(min_value=0)
+    bbox = serializers.CharField(required=False, validators=[bbox_validator])
+
+    def validate_km(self, value):
+        maximum = settings.GEO_SEARCH_MAX_KM
+        if value > maximum:
+            raise serializers.ValidationError(
+                'The radius may be at most %s km.' % maximum)
+        return value
+
+    def validate_bbox(self, value):
+        return tuple(map(float, value.split(',')))
+
+
+class ClusterQueryParamsSerializer(serializers.Serializer):
+    bbox = serializers.CharField(validators=[bbox_validator])
+    zoom = serializers.IntegerField(min_value=0, max_value=22)
+
+    def validate_bbox(self, value):
+        return tuple(map(float, value.split(',')))
 
 
 # workaround bacause the query parameter from is also a reserved python word.
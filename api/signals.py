@@ -0,0 +1,136 @@
+from collections import defaultdict
+from django.apps import apps
+from django.db import connection, models
+from django.db.models import Q
+from django.utils import timezone
+from haystack import connection_router, connections
+from haystack.signals import BaseSignalProcessor
+from api.models import QueuedIndexUpdate
+from api.search_backends import failing_loudly
+from api.utils import bump_generations, search_scopes, tourpoint_scopes
+from tourpoint.models import TourPoint
+
+
+ENQUEUE_CHUNK_SIZE = 1000
+
+
+def enqueue(model, pks, action, scopes=()):
+    """
+    Queue objects for the search index worker, replacing whatever was queued
+    for them before. It runs in the same transaction as the change, so the
+    change can't be committed without being queued.
+
+    `scopes` are bumped again once the objects are indexed, along with the
+    ones queued before, see `process_queue`.
+    """
+    pks = [str(pk) for pk in dict.fromkeys(pks)]
+    label = model._meta.label_lower
+    now = timezone.now()
+    scopes = ' '.join(sorted(set(scopes)))
+    sql = ('INSERT INTO {table} AS entry '
+           '(model, object_id, action, queued, scopes) '
+           'VALUES {values} ON CONFLICT (model, object_id) DO UPDATE '
+           'SET action = EXCLUDED.action, queued = EXCLUDED.queued, '
+           "scopes = trim(entry.scopes || ' ' || EXCLUDED.scopes)")
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), ENQUEUE_CHUNK_SIZE):
+            chunk = pks[start:start + ENQUEUE_CHUNK_SIZE]
+            params = []
+            for pk in chunk:
+                params.extend([label, pk, action, now, scopes])
+            cursor.execute(sql.format(
+                table=QueuedIndexUpdate._meta.db_table,
+                values=', '.join(['(%s, %s, %s, %s, %s)'] * len(chunk))),
+                params)
+
+
+def process_queue(batch_size):
+    """
+    Send one batch of queued objects to the search index, oldest first, and
+    return how many there were.
+
+    Entries are only dropped after the index accepted them, and only if they
+    were not queued again in the meantime, so every change reaches the index
+    at least once.
+
+    The scopes of the entries are bumped once the index accepted them. The
+    writes bumped them already, but the search responses cached until the
+    index caught up hold the old results under the new generations.
+    """
+    entries = list(QueuedIndexUpdate.objects.order_by('queued')[:batch_size])
+    if not entries:
+        return 0
+
+    queued = defaultdict(lambda: ([], []))
+    for entry in entries:
+        updates, removes = queued[entry.model]
+        if entry.action == QueuedIndexUpdate.REMOVE:
+            removes.append(entry.object_id)
+        else:
+            updates.append(entry.object_id)
+
+    for label, (updates, removes) in queued.items():
+        model = apps.get_model(label)
+        for using in connection_router.for_write():
+            backend = connections[using].get_backend()
+            index = connections[using].get_unified_index().get_index(model)
+            # A failure must keep the entries queued instead of being logged
+            # and forgotten.
+            with failing_loudly(using):
+                if updates:
+                    backend.update(index, index.index_queryset(
+                        using=using).filter(pk__in=updates))
+                for pk in removes:
+                    backend.remove('%s.%s' % (label, pk))
+
+    processed = Q()
+    scopes = set()
+    for entry in entries:
+        processed |= Q(pk=entry.pk, queued=entry.queued)
+        scopes.update(entry.scopes.split())
+    QueuedIndexUpdate.objects.filter(processed).delete()
+    if scopes:
+        bump_generations(scopes)
+    return len(entries)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Instead of calling the search index on every save and delete, queue the
+    changed objects so `manage.py process_search_queue` indexes them in bulk.
+    """
+
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+
+    def is_indexed(self, model):
+        for using in self.connection_router.for_write():
+            unified_index = self.connections[using].get_unified_index()
+            if model in unified_index.get_indexed_models():
+                return True
+        return False
+
+    def get_scopes(self, instance):
+        """
+        Scopes of the search responses a tour point shows up in, before and
+        after the change.
+        """
+        if not isinstance(instance, TourPoint):
+            return set()
+        return search_scopes(tourpoint_scopes(instance) | getattr(
+            instance, '_previous_cache_scopes', set()))
+
+    def handle_save(self, sender, instance, **kwargs):
+        if self.is_indexed(sender):
+            enqueue(sender, [instance.pk], QueuedIndexUpdate.UPDATE,
+                    self.get_scopes(instance))
+
+    def handle_delete(self, sender, instance, **kwargs):
+        if self.is_indexed(sender):
+            enqueue(sender, [instance.pk], QueuedIndexUpdate.REMOVE,
+                    self.get_scopes(instance))
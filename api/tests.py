@@ -1,10 +1,53 @@
+import csv
+import gzip
+import io
+import json
+import os
+import threading
+import tempfile
+import time
+from collections import Counter
+from unittest import mock
+from elasticsearch import exceptions as es_exceptions
+from haystack import connections as haystack_connections
 from django.urls import reverse
+from django.core.cache import cache
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.conf import settings
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import parse_http_date
 # from django.contrib.sites.models import Site
 from django.contrib.auth import get_user_model
-from rest_framework import status
+from rest_framework import status, views
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 # from allauth.socialaccount.models import SocialApp
-from api import factories
+from api import (
+    breaker,
+    factories,
+    geo,
+    metrics,
+    search_backends,
+    search_cache,
+    tiles,
+    warmup,
+)
+from api.cache import RESPONSE_KEY_PREFIX, cache_response
+from api.cache_backends import TwoTierCache
+from api.models import QueuedIndexUpdate
+from api.signals import process_queue
+from api.pagination import KeysetPagination
+from api.serializers import TourPointRowSerializer, TourPointSerializer
+from api.utils import bump_generations
+from tourpoint.models import TourPoint
 
 
 # Test ommited since we can't have a new User Token every time and this leads
@@ -56,7 +99,7 @@ class TourPointTests(APITestCase):
         response = self.client.get(
             reverse('user-tourpoints', args=[user.pk]))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 10)
+        self.assertEqual(len(response.data['results']), 10)
 
     def test_user_can_delete_his_own_tourpoints(self):
         data = {
@@ -89,26 +132,1126 @@ class TourPointTests(APITestCase):
         factories.TourPointFactory.create_batch(10)
         self.client.logout()
         response = self.client.get(reverse('tourpoint-list'))
-        for tourpoint in response.data:
+        for tourpoint in response.data['results']:
             self.assertEqual(tourpoint['category'], 'restaurant')
 
     def test_user_can_see_tour_points_in_a_radius_from_location(self):
         factories.TourPointFactory.create_batch(size=10)
+        process_queue(batch_size=100)
         user = factories.UserFactory.create()
         self.client.force_login(user)
         response = self.client.get(reverse('tourpoint-search-list'), {
             'from': '-25.4283699,-49.2790737',
             'km': 5.0})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertNotEqual(len(response.data), 0)
+        self.assertNotEqual(len(response.data['results']), 0)
 
     def test_anonymous_user_may_only_see_public_restaurants_in_a_radius_from_location(self):
         factories.TourPointFactory.create_batch(size=20)
+        process_queue(batch_size=100)
         self.client.logout()
         response = self.client.get(reverse('tourpoint-search-list'), {
             'from': '-25.4283699,-49.2790737',
             'km': 5.0})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        for tourpoint in response.data:
+        for tourpoint in response.data['results']:
             self.assertEqual(tourpoint['category'], 'restaurant')
             self.assertEqual(tourpoint['private'], False)
+
+    def test_clusters_count_tour_points_per_cell(self):
+        factories.TourPointFactory.create_batch(size=20)
+        process_queue(batch_size=100)
+        self.client.logout()
+        response = self.client.get(reverse('tourpoint-search-clusters'), {
+            'bbox': '-26,-50,-25,-49', 'zoom': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sum(cluster['count'] for cluster in response.data['clusters']),
+            TourPoint.objects.visible_to(AnonymousUser()).count())
+        for cluster in response.data['clusters']:
+            self.assertEqual(set(cluster['categories']), {'restaurant'})
+
+    def test_tour_points_list_is_paginated_by_cursor(self):
+        factories.TourPointFactory.create_batch(size=25, owner=self.user)
+        seen = []
+        url = reverse('tourpoint-list') + '?page_size=10'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 10)
+            seen.extend(tp['url'] for tp in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_previous_page_returns_the_same_tour_points(self):
+        factories.TourPointFactory.create_batch(size=15, owner=self.user)
+        first = self.client.get(reverse('tourpoint-list'), {'page_size': 10})
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+
+    def test_user_can_create_many_tour_points_at_once(self):
+        data = [{
+            'name': 'Park %d' % i,
+            'category': 'park',
+            'longitude': -25.4258213,
+            'latitude': -49.3141436,
+            'private': False
+        } for i in range(5)]
+        response = self.client.post(
+            reverse('tourpoint-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(self.user.tourpoints.count(), 5)
+        self.assertEqual(QueuedIndexUpdate.objects.count(), 5)
+
+    def test_bulk_create_reports_errors_per_tour_point(self):
+        data = [
+            {'name': 'Barigui Park', 'category': 'park',
+             'longitude': -25.4258213, 'latitude': -49.3141436},
+            {'name': 'Tangua Park', 'category': 'beach',
+             'longitude': -25.4258213, 'latitude': -49.3141436},
+        ]
+        response = self.client.post(
+            reverse('tourpoint-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('category', response.data[1])
+        self.assertFalse(TourPoint.objects.exists())
+
+    def test_bulk_create_rejects_repeated_names(self):
+        data = [{'name': 'Barigui Park', 'category': 'park',
+                 'longitude': -25.4258213, 'latitude': -49.3141436}] * 2
+        response = self.client.post(
+            reverse('tourpoint-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('name', response.data[0])
+        self.assertIn('name', response.data[1])
+
+    def test_bulk_create_checks_names_in_a_single_query(self):
+        factories.TourPointFactory.create(name='Park 3')
+
+        def post(size):
+            data = [{'name': 'Park %d' % i, 'category': 'park',
+                     'longitude': -25.4258213, 'latitude': -49.3141436}
+                    for i in range(size)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    reverse('tourpoint-list'), data, format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            self.assertIn('name', response.data[3])
+            return len(queries)
+
+        self.assertEqual(post(5), post(500))
+
+    def export(self, export_type):
+        response = self.client.get(
+            reverse('tourpoint-export'), {'type': export_type})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def test_export_streams_visible_tour_points_as_ndjson(self):
+        factories.TourPointFactory.create_batch(size=10)
+        factories.TourPointFactory.create(owner=self.user, private=True)
+        rows = [json.loads(line)
+                for line in self.export('ndjson').splitlines()]
+        self.assertEqual(
+            len(rows), TourPoint.objects.visible_to(self.user).count())
+        detail = self.client.get(rows[0]['url'])
+        self.assertEqual(rows[0], dict(detail.data))
+
+    def test_export_streams_csv(self):
+        factories.TourPointFactory.create_batch(size=10)
+        self.client.logout()
+        rows = list(csv.DictReader(self.export('csv').splitlines()))
+        self.assertEqual(
+            len(rows), TourPoint.objects.filter(
+                category='restaurant', private=False).count())
+        for row in rows:
+            self.assertEqual(row['category'], 'restaurant')
+
+    def test_fast_serializer_output_is_byte_identical(self):
+        factories.TourPointFactory.create_batch(size=10)
+        queryset = TourPoint.objects.order_by('pk')
+        renderer = JSONRenderer()
+        for format in (None, 'json'):
+            context = {'request': Request(
+                APIRequestFactory().get(reverse('tourpoint-list'))),
+                'format': format}
+            self.assertEqual(
+                renderer.render(TourPointRowSerializer(
+                    queryset.values(*TourPointRowSerializer.values),
+                    context=context).data),
+                renderer.render(TourPointSerializer(
+                    queryset, many=True, context=context).data))
+
+
+class QueuedIndexUpdateTests(APITestCase):
+
+    def test_changes_to_the_same_object_are_queued_once(self):
+        tourpoint = factories.TourPointFactory.create()
+        tourpoint.name = 'Botanical Garden'
+        tourpoint.save()
+        entry = QueuedIndexUpdate.objects.get()
+        self.assertEqual(entry.model, 'tourpoint.tourpoint')
+        self.assertEqual(entry.object_id, str(tourpoint.pk))
+        self.assertEqual(entry.action, QueuedIndexUpdate.UPDATE)
+
+        tourpoint.delete()
+        entry = QueuedIndexUpdate.objects.get()
+        self.assertEqual(entry.action, QueuedIndexUpdate.REMOVE)
+
+    def test_processed_changes_leave_the_queue(self):
+        factories.TourPointFactory.create_batch(size=5)
+        self.assertEqual(QueuedIndexUpdate.objects.count(), 5)
+        self.assertEqual(process_queue(batch_size=3), 3)
+        self.assertEqual(process_queue(batch_size=3), 2)
+        self.assertFalse(QueuedIndexUpdate.objects.exists())
+
+    def test_searches_cached_before_indexing_are_refreshed(self):
+        cache.clear()
+        tourpoint = factories.TourPointFactory.create(
+            name='Old name', category='restaurant', private=False)
+        process_queue(batch_size=10)
+
+        def search():
+            response = self.client.get(reverse('tourpoint-search-list'), {
+                'from': '%r,%r' % geo.point_of(tourpoint), 'km': 1})
+            return [result['name'] for result in response.data['results']]
+
+        tourpoint.name = 'New name'
+        tourpoint.save()
+        # not indexed yet
+        self.assertEqual(search(), ['Old name'])
+        process_queue(batch_size=10)
+        self.assertEqual(search(), ['New name'])
+
+
+class ReindexTests(APITestCase):
+    """
+    The pool runs the chunks in process and Elasticsearch is mocked, only
+    what the command asks for is checked.
+    """
+
+    def setUp(self):
+        factories.TourPointFactory.create_batch(size=5)
+        self.first = TourPoint.objects.order_by('pk')[0].pk
+        self.backend = haystack_connections['default'].get_backend()
+        self.alias = self.backend.index_name
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        self.indexed = []
+
+    def imap_unordered(self, function, chunks):
+        for index_name, start, end in chunks:
+            self.indexed.append((index_name, start))
+            yield start
+
+    def reindex(self, conn, **options):
+        pool = mock.Mock(imap_unordered=self.imap_unordered)
+        # closing the connections would end the test transaction
+        with mock.patch('django.db.connections.close_all'), \
+                mock.patch('multiprocessing.Pool', return_value=pool), \
+                mock.patch.object(self.backend, 'conn', conn), \
+                mock.patch.object(self.backend, 'update'), \
+                mock.patch.object(self.backend, 'remove'):
+            call_command('reindex_tourpoints', workers=1, chunk_size=2,
+                         checkpoint=self.checkpoint, stdout=io.StringIO(),
+                         **options)
+
+    def test_resumes_from_the_checkpoint(self):
+        with open(self.checkpoint, 'w') as checkpoint_file:
+            json.dump({'index': self.alias, 'chunk_size': 2,
+                       'done': [self.first], 'started': time.time()},
+                      checkpoint_file)
+        self.reindex(mock.Mock())
+        self.assertEqual(self.indexed, [(self.alias, self.first + 2),
+                                        (self.alias, self.first + 4)])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_alias_is_moved_to_the_new_index(self):
+        silently_fail = self.backend.silently_fail
+        conn = mock.Mock()
+        conn.indices.exists_alias.return_value = True
+        conn.indices.get_alias.return_value = {self.alias + '_old': {}}
+        self.reindex(conn, new_index=True)
+        index = self.indexed[0][0]
+        self.assertTrue(index.startswith(self.alias + '_'))
+        conn.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': self.alias + '_old',
+                            'alias': self.alias}},
+                {'add': {'index': index, 'alias': self.alias}}]})
+        conn.indices.delete.assert_called_once_with(index=self.alias + '_old')
+        # the catch up runs in this process, its backend is left as it was
+        self.assertEqual(self.backend.index_name, self.alias)
+        self.assertEqual(self.backend.silently_fail, silently_fail)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'snowman-tests'}})
+class ScopedCacheInvalidationTests(APITestCase):
+    """
+    The ETag is built from the same generations as the cache key, so a read
+    returning the same ETag as the previous one is a cache hit.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.writer = factories.UserFactory.create()
+        self.reader = factories.UserFactory.create()
+        factories.TourPointFactory.create_batch(size=10)
+
+    def read(self, user):
+        if user is None:
+            self.client.logout()
+        else:
+            self.client.force_login(user)
+        response = self.client.get(reverse('tourpoint-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response['ETag']
+
+    def run_workload(self, write, rounds=30):
+        readers = (None, self.reader, self.writer)
+        reads, hits, etags = Counter(), Counter(), {}
+        for i in range(rounds):
+            if i % 3 == 0:
+                write(i)
+            for user in readers:
+                etag = self.read(user)
+                reads[user] += 1
+                hits[user] += etags.get(user) == etag
+                etags[user] = etag
+        return {user: hits[user] / reads[user] for user in readers}
+
+    def test_private_writes_only_invalidate_their_owner(self):
+        hit_rates = self.run_workload(
+            lambda i: factories.TourPointFactory.create(
+                owner=self.writer, private=True))
+        # Only the first read of the other users is a miss.
+        self.assertEqual(hit_rates[None], 29 / 30)
+        self.assertEqual(hit_rates[self.reader], 29 / 30)
+        # The writer misses right after each one of the 10 writes.
+        self.assertEqual(hit_rates[self.writer], 20 / 30)
+
+    def test_public_writes_only_invalidate_their_category(self):
+        hit_rates = self.run_workload(
+            lambda i: factories.TourPointFactory.create(
+                owner=self.writer, private=False, category='park'))
+        # Anonymous users only see restaurants.
+        self.assertEqual(hit_rates[None], 29 / 30)
+        self.assertEqual(hit_rates[self.reader], 20 / 30)
+        self.assertEqual(hit_rates[self.writer], 20 / 30)
+
+
+class VisibilityQueryPlanTests(TestCase):
+    """
+    Sequential scans are disabled, so the planner only picks one when there
+    is no usable index, no matter how small the test table is.
+    """
+
+    def setUp(self):
+        self.user = factories.UserFactory.create()
+        factories.TourPointFactory.create_batch(size=20, owner=self.user)
+        self.newest = TourPoint.objects.latest('created')
+
+    def assertNoSeqScan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertNotIn('Seq Scan', plan, plan)
+
+    def page_queryset(self, branches, reverse=None):
+        paginator = KeysetPagination()
+        paginator.cursor = None
+        if reverse is not None:
+            paginator.cursor = (self.newest.created, self.newest.pk, reverse)
+        return paginator.get_page_queryset(branches)
+
+    def test_anonymous_list_uses_indexes(self):
+        branches = TourPoint.objects.visible_branches(AnonymousUser())
+        for reverse in (None, False, True):
+            self.assertNoSeqScan(self.page_queryset(branches, reverse))
+
+    def test_authenticated_list_uses_indexes(self):
+        branches = TourPoint.objects.visible_branches(self.user)
+        for reverse in (None, False, True):
+            self.assertNoSeqScan(self.page_queryset(branches, reverse))
+
+    def test_user_tour_points_use_indexes(self):
+        self.assertNoSeqScan(self.page_queryset([self.user.tourpoints.all()]))
+
+    def test_bounding_box_uses_indexes(self):
+        self.assertNoSeqScan(TourPoint.objects.filter(
+            latitude__range=(-50, -49), longitude__range=(-26, -25)))
+
+
+@override_settings(GEO_SEARCH_ENGINE='memory')
+class MemoryGeoSearchTests(APITestCase):
+
+    def setUp(self):
+        geo.engine.clear()
+        self.user = factories.UserFactory.create()
+        factories.TourPointFactory.create_batch(size=12)
+        factories.TourPointFactory.create(owner=self.user, private=True)
+
+    def tearDown(self):
+        geo.engine.clear()
+
+    def search(self, **params):
+        params.setdefault('from', '-25.4283699,-49.2790737')
+        params.setdefault('km', 5.0)
+        return self.client.get(reverse('tourpoint-search-list'), params)
+
+    def test_user_sees_public_and_own_tour_points(self):
+        self.client.force_login(self.user)
+        response = self.search()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            len(response.data['results']),
+            TourPoint.objects.visible_to(self.user).count())
+        for tourpoint in response.data['results']:
+            self.assertEqual(set(tourpoint), {
+                'name', 'category', 'longitude', 'latitude', 'private',
+                'owner', 'distance'})
+            self.assertLess(tourpoint['distance']['km'], 5.0)
+            if tourpoint['private']:
+                self.assertEqual(tourpoint['owner'], self.user.username)
+
+    def test_anonymous_user_only_sees_public_restaurants(self):
+        response = self.search()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(len(response.data['results']), 0)
+        for tourpoint in response.data['results']:
+            self.assertEqual(tourpoint['category'], 'restaurant')
+            self.assertEqual(tourpoint['private'], False)
+
+    def test_engine_forgets_removed_tour_points(self):
+        geo.engine.load()
+        for tourpoint in TourPoint.objects.all():
+            geo.engine.remove(tourpoint.pk)
+        response = self.search()
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_searches_do_not_wait_for_a_reload(self):
+        geo.engine.load()
+        geo.engine.loaded_at -= geo.engine.max_age + 1
+        # another thread is reloading
+        with geo.engine.load_lock:
+            with self.assertNumQueries(0):
+                response = self.search()
+        self.assertNotEqual(len(response.data['results']), 0)
+
+    def test_engine_catches_up_with_other_processes(self):
+        geo.engine.load()
+        geo.engine.checked_at -= settings.SYNC_LAG + 1
+        # written by another process, no signal reaches this engine
+        TourPoint.objects.update(private=True, updated=timezone.now())
+        bump_generations(['tourpoints'])
+        response = self.search()
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_memory_engine_results_expire_with_the_engine(self):
+        with self.settings(API_CACHE_TIMEOUT=geo.engine.max_age * 2):
+            with mock.patch('api.cache.cache.set') as cache_set:
+                self.search()
+        timeouts = [args[2] for args, _ in cache_set.call_args_list
+                    if args[0].startswith(RESPONSE_KEY_PREFIX)]
+        self.assertEqual(timeouts, [geo.engine.max_age])
+
+    def test_pages_go_nearest_first(self):
+        self.client.force_login(self.user)
+        names, distances = [], []
+        url = None
+        while True:
+            if url is None:
+                response = self.search(limit=5)
+            else:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 5)
+            for tourpoint in response.data['results']:
+                names.append(tourpoint['name'])
+                distances.append(tourpoint['distance']['km'])
+            url = response.data['next']
+            if url is None:
+                break
+        self.assertEqual(distances, sorted(distances))
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(
+            len(names), TourPoint.objects.visible_to(self.user).count())
+
+    def test_clusters_are_grouped_by_the_database(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('tourpoint-search-clusters'), {
+            'bbox': '-26,-50,-25,-49', 'zoom': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['precision'], 5)
+        self.assertEqual(
+            sum(cluster['count'] for cluster in response.data['clusters']),
+            TourPoint.objects.visible_to(self.user).count())
+        for cluster in response.data['clusters']:
+            self.assertEqual(len(cluster['geohash']), 5)
+            self.assertEqual(
+                sum(cluster['categories'].values()), cluster['count'])
+
+    def test_radius_is_bounded(self):
+        response = self.search(km=settings.GEO_SEARCH_MAX_KM + 1)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_results_are_limited_to_the_bounding_box(self):
+        self.client.force_login(self.user)
+        lat, lng = geo.point_of(TourPoint.objects.first())
+        response = self.search(bbox='%s,%s,%s,%s' % (
+            lat - 0.0001, lng - 0.0001, lat + 0.0001, lng + 0.0001), km=50)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for tourpoint in response.data['results']:
+            self.assertAlmostEqual(
+                tourpoint['longitude'], lat, delta=0.0001)
+            self.assertAlmostEqual(
+                tourpoint['latitude'], lng, delta=0.0001)
+
+
+@override_settings(GEO_SEARCH_CACHE=True, CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class QuantizedGeoSearchTests(APITestCase):
+
+    def setUp(self):
+        metrics.flush()
+        cache.clear()
+        self.user = factories.UserFactory.create()
+        factories.TourPointFactory.create_batch(size=12)
+        factories.TourPointFactory.create(owner=self.user, private=True)
+        process_queue(batch_size=100)
+
+    def search(self, point):
+        return self.client.get(reverse('tourpoint-search-list'), {
+            'from': point, 'km': 5.0})
+
+    def test_geohash(self):
+        self.assertEqual(
+            search_cache.geohash(57.64911, 10.40744, 11)[0], 'u4pruydqqvj')
+
+    def test_nearby_searches_share_the_cell(self):
+        self.client.force_login(self.user)
+        first = self.search('-25.4283699,-49.2790737')
+        second = self.search('-25.4283701,-49.2790741')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        metrics.flush()
+        counters = metrics.read(search_cache.METRICS)
+        # the public and the private slices of the cell, once each
+        self.assertEqual(counters['geo_search.cell_miss'], 2)
+        self.assertEqual(counters['geo_search.cell_hit'], 2)
+        self.assertEqual(
+            [tourpoint['name'] for tourpoint in first.data['results']],
+            [tourpoint['name'] for tourpoint in second.data['results']])
+        self.assertEqual(
+            len(first.data['results']),
+            TourPoint.objects.visible_to(self.user).count())
+
+    def test_writes_invalidate_the_cell(self):
+        self.search('-25.4283699,-49.2790737')
+        factories.TourPointFactory.create(category='restaurant',
+                                          private=False)
+        process_queue(batch_size=100)
+        response = self.search('-25.4283699,-49.2790737')
+        metrics.flush()
+        self.assertEqual(
+            metrics.read(search_cache.METRICS)['geo_search.cell_miss'], 2)
+        self.assertEqual(
+            len(response.data['results']),
+            TourPoint.objects.visible_to(AnonymousUser()).count())
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TileTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        factories.TourPointFactory.create_batch(size=9)
+        # (lat, lng) is (longitude, latitude), see `geo.point_of`
+        self.x, self.y = tiles.tile_of(-25.4230441, -49.3084172, 12)
+
+    def get(self, category='restaurant', **params):
+        return self.client.get(reverse('tile', kwargs={
+            'category': category, 'zoom': 12, 'x': self.x, 'y': self.y}),
+            params)
+
+    def test_tile_has_the_public_tour_points_in_it(self):
+        response = self.get()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/geo+json')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        features = json.loads(response.content.decode())['features']
+        self.assertEqual(
+            sorted(feature['id'] for feature in features),
+            sorted(TourPoint.objects.filter(
+                category='restaurant', private=False).values_list(
+                    'pk', flat=True)))
+
+    def test_versioned_tile_is_immutable(self):
+        version = self.get()['X-Tile-Version']
+        response = self.get(v=version)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('immutable', response['Cache-Control'])
+        response = self.get(v='outdated')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertIn('v=%s' % version, response['Location'])
+
+    def test_unchanged_tile_is_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.client.get(
+            reverse('tile', kwargs={'category': 'restaurant', 'zoom': 12,
+                                    'x': self.x, 'y': self.y}),
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_writes_only_change_the_tiles_holding_them(self):
+        version = self.get()['X-Tile-Version']
+        factories.TourPointFactory.create(
+            category='restaurant', private=False, longitude=10, latitude=10)
+        factories.TourPointFactory.create(category='park', private=False)
+        factories.TourPointFactory.create(category='restaurant', private=True)
+        self.assertEqual(self.get()['X-Tile-Version'], version)
+        factories.TourPointFactory.create(category='restaurant', private=False)
+        self.assertNotEqual(self.get()['X-Tile-Version'], version)
+
+    def test_other_categories_need_authentication(self):
+        self.assertEqual(self.get('park').status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+        self.client.force_login(factories.UserFactory.create())
+        response = self.get('park')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=60')
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConditionalRequestTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        factories.TourPointFactory.create_batch(size=10)
+
+    def test_unchanged_list_is_answered_without_queries(self):
+        response = self.client.get(reverse('tourpoint-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('tourpoint-list'),
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_weak_etags_match(self):
+        etag = self.client.get(reverse('tourpoint-list'))['ETag']
+        response = self.client.get(reverse('tourpoint-list'),
+                                   HTTP_IF_NONE_MATCH='W/' + etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_last_modified_follows_the_tour_points(self):
+        tourpoint = factories.TourPointFactory.create(
+            category='restaurant', private=False)
+        response = self.client.get(reverse('tourpoint-list'))
+        last_modified = response['Last-Modified']
+        self.assertGreaterEqual(parse_http_date(last_modified),
+                                int(tourpoint.updated.timestamp()))
+        response = self.client.get(reverse('tourpoint-list'),
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_writes_change_the_validators(self):
+        etag = self.client.get(reverse('tourpoint-list'))['ETag']
+        factories.TourPointFactory.create(category='restaurant', private=False)
+        response = self.client.get(reverse('tourpoint-list'),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class StampedeView(views.APIView):
+    """
+    Counts how many times each response is built, slowly enough for
+    concurrent requests to overlap.
+    """
+    builds = Counter()
+    lock = threading.Lock()
+
+    def get_cache_scopes(self):
+        return ['stampede']
+
+    @cache_response(
+        key_func=lambda **kwargs: 'stampede:%s' % kwargs['kwargs']['name'])
+    def get(self, request, name):
+        with self.lock:
+            self.builds[name] += 1
+            build = self.builds[name]
+        time.sleep(0.3)
+        return Response({'name': name, 'build': build})
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StampedeProtectionTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        StampedeView.builds.clear()
+
+    def request_concurrently(self, per_key=8):
+        view = StampedeView.as_view()
+        factory = APIRequestFactory()
+        responses = []
+
+        def get(name):
+            responses.append(view(factory.get('/'), name=name))
+
+        threads = [threading.Thread(target=get, args=(name,))
+                   for name in ('a', 'b') for _ in range(per_key)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for response in responses:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [json.loads(response.content.decode())
+                for response in responses]
+
+    def test_concurrent_misses_are_built_once_per_key(self):
+        responses = self.request_concurrently()
+        self.assertEqual(StampedeView.builds, {'a': 1, 'b': 1})
+        self.assertEqual(len(responses), 16)
+
+    def test_outdated_responses_are_served_while_rebuilt(self):
+        self.request_concurrently()
+        bump_generations(['stampede'])
+        responses = self.request_concurrently()
+        self.assertEqual(StampedeView.builds, {'a': 2, 'b': 2})
+        builds = Counter(response['build'] for response in responses)
+        # one rebuild per key, everybody else got the outdated response
+        self.assertEqual(builds, {1: 14, 2: 2})
+
+    def test_outdated_responses_are_served_long_after_the_change(self):
+        self.request_concurrently()
+        # nobody asked for them since the write
+        bump_generations(['stampede'], time.time() - 60)
+        responses = self.request_concurrently()
+        builds = Counter(response['build'] for response in responses)
+        self.assertEqual(builds, {1: 14, 2: 2})
+
+
+class PayloadView(views.APIView):
+    builds = 0
+
+    @cache_response(key_func=lambda **kwargs: 'payload')
+    def get(self, request):
+        PayloadView.builds += 1
+        return Response({'names': ['Melissa Wang'] * 50})
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CompressedResponseTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        PayloadView.builds = 0
+
+    def get(self, **headers):
+        return PayloadView.as_view()(APIRequestFactory().get('/', **headers))
+
+    def test_hits_are_served_in_the_accepted_encoding(self):
+        miss = self.get()
+        content = miss.rendered_content
+        self.assertIn('Accept-Encoding', miss['Vary'])
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(PayloadView.builds, 1)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), content)
+
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, content)
+        self.assertEqual(PayloadView.builds, 1)
+
+
+class TwoTierCacheTests(SimpleTestCase):
+
+    def worker(self, **options):
+        options.setdefault('LOCAL_MAX_ENTRIES', 10)
+        options.setdefault('LOCAL_TIMEOUT', 60)
+        options['REMOTE_BACKEND'] = \
+            'django.core.cache.backends.locmem.LocMemCache'
+        # locmem caches with the same location share their values
+        return TwoTierCache('two-tier', {'OPTIONS': options})
+
+    def tearDown(self):
+        self.worker().clear()
+
+    def test_reads_are_served_by_the_local_tier(self):
+        worker = self.worker()
+        worker.remote.set('a', 1)
+        self.assertEqual(worker.get('a'), 1)
+        self.assertEqual(worker.get('a'), 1)
+        self.assertIsNone(worker.get('b'))
+        self.assertEqual(worker.stats(), {
+            'local_hit': 1, 'remote_hit': 1, 'miss': 1, 'local_entries': 1})
+
+    def test_local_tier_is_bounded(self):
+        worker = self.worker(LOCAL_MAX_ENTRIES=2)
+        worker.set_many({'a': 1, 'b': 2})
+        worker.get('a')
+        worker.set('c', 3)
+        self.assertEqual(worker.stats()['local_entries'], 2)
+        # 'b' was the least recently used
+        self.assertEqual(worker.get_many(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(worker.stats()['remote_hit'], 1)
+
+    def test_writes_of_other_workers_are_seen_after_local_timeout(self):
+        worker, other = self.worker(LOCAL_TIMEOUT=0.2), self.worker()
+        worker.set('generation', 1)
+        other.incr('generation')
+        self.assertEqual(other.get('generation'), 2)
+        self.assertEqual(worker.get('generation'), 1)
+        time.sleep(0.3)
+        self.assertEqual(worker.get('generation'), 2)
+
+    def test_failed_add_drops_the_local_value(self):
+        worker, other = self.worker(), self.worker()
+        worker.set('lock', 'mine')
+        other.set('lock', 'theirs')
+        self.assertFalse(worker.add('lock', 'mine'))
+        self.assertEqual(worker.get('lock'), 'theirs')
+
+
+@override_settings(CACHE_WARMUP_HOST='testserver', CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheWarmupTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        factories.TourPointFactory.create_batch(
+            size=5, category='restaurant', private=False)
+
+    def test_hot_requests_are_learned_from_access_logs(self):
+        line = ('10.0.0.1 - - [18/Oct/2026:10:00:00 +0000] "GET %s HTTP/1.1" '
+                '%s 512 "-" "okhttp/3.8.0"\n')
+        with tempfile.NamedTemporaryFile('w') as log:
+            log.writelines([line % ('/api/v1/tourpoints/', 200)] * 3 +
+                           [line % ('/api/v1/', 200)] * 2 +
+                           [line % ('/api/v1/users/1/', 404)] * 5 +
+                           [line % ('/static/app.js', 200)] * 5)
+            log.flush()
+            self.assertEqual(warmup.learn_requests([log.name], 10),
+                             ['/api/v1/tourpoints/', '/api/v1/'])
+            self.assertEqual(warmup.learn_requests([log.name], 1),
+                             ['/api/v1/tourpoints/'])
+
+    def test_warmed_requests_are_served_from_the_cache(self):
+        url = reverse('tourpoint-list')
+        results = warmup.Warmer().warm([url])
+        self.assertEqual(results[0][:2], (url, status.HTTP_200_OK))
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(response.content.decode())['results']),
+                         5)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedAuthenticationTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = factories.UserFactory.create()
+        factories.TourPointFactory.create_batch(size=5, owner=self.user)
+        self.url = reverse('user-tourpoints', kwargs={'pk': self.user.pk})
+
+    def test_cached_get_with_a_token_takes_no_query(self):
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.assertEqual(self.client.get(self.url).status_code,
+                         status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        token.delete()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cached_get_with_a_session_takes_no_query(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.url).status_code,
+                         status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_changed_users_are_loaded_again(self):
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ServerTimingTests(APITestCase):
+
+    def setUp(self):
+        metrics.flush()
+        cache.clear()
+        factories.TourPointFactory.create_batch(
+            size=5, category='restaurant', private=False)
+
+    def test_spans_are_sent_back(self):
+        response = self.client.get(reverse('tourpoint-list'))
+        timing = response['Server-Timing']
+        self.assertIn('view;dur=', timing)
+        self.assertIn('sql;dur=', timing)
+        self.assertIn('render;dur=', timing)
+        self.assertTrue(timing.split(', ')[-1].startswith('total;dur='))
+
+    def test_requests_are_only_recorded_by_the_process(self):
+        sample = ('api_request_duration_seconds_count'
+                  '{endpoint="tourpoint-list"}')
+        self.client.get(reverse('tourpoint-list'))
+        self.assertEqual(metrics.read([sample])[sample], 0)
+        metrics.flush()
+        self.assertEqual(metrics.read([sample])[sample], 1)
+        self.assertIn(sample, metrics.samples())
+
+    def test_buckets_are_ordered_by_bound(self):
+        self.client.get(reverse('tourpoint-list'))
+        metrics.flush()
+        prefix = ('api_request_duration_seconds_bucket'
+                  '{endpoint="tourpoint-list",le="')
+        bounds = [sample[len(prefix):-2] for sample in metrics.samples()
+                  if sample.startswith(prefix)]
+        # only the buckets above the duration were incremented
+        self.assertEqual(bounds, [str(bound) for bound in
+                                  metrics.DURATION_BUCKETS
+                                  if str(bound) in bounds] + ['+Inf'])
+
+    def test_endpoint_histograms_are_served_to_staff(self):
+        self.client.get(reverse('tourpoint-list'))
+        self.client.get(reverse('tourpoint-list'))
+        metrics.flush()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = get_user_model().objects.create_superuser(
+            username='admin', email='admin@snowman.com',
+            password='ADeuWcg6BG0WHQ==')
+        self.client.force_login(admin)
+        content = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('# TYPE api_request_duration_seconds histogram', content)
+        self.assertIn('api_request_duration_seconds_count'
+                      '{endpoint="tourpoint-list"} 2\n', content)
+        self.assertIn('api_request_duration_seconds_bucket'
+                      '{endpoint="tourpoint-list",le="+Inf"} 2\n', content)
+        self.assertIn('api_response_cache_total{endpoint="tourpoint-list",'
+                      'key_constructor="CustomListKeyConstructor",'
+                      'result="hit"} 1\n', content)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.breaker = breaker.CircuitBreaker(
+            'test', failures=2, window=60, reset=0.2)
+        self.calls = 0
+
+    def down(self):
+        self.calls += 1
+        raise es_exceptions.ConnectionTimeout('TIMEOUT', 'timed out', None)
+
+    def up(self):
+        self.calls += 1
+        return 'elasticsearch'
+
+    def test_opens_after_repeated_outages(self):
+        for _ in range(2):
+            self.assertEqual(self.breaker.call(self.down, lambda: 'db'), 'db')
+        self.assertEqual(self.breaker.state(), 'open')
+        self.assertEqual(self.breaker.call(self.up, lambda: 'db'), 'db')
+        self.assertEqual(self.calls, 2)
+
+    def test_a_single_trial_closes_it_again(self):
+        for _ in range(2):
+            self.breaker.call(self.down, lambda: 'db')
+        time.sleep(0.3)
+        self.assertEqual(self.breaker.state(), 'half_open')
+        self.assertEqual(self.breaker.call(self.up, lambda: 'db'),
+                         'elasticsearch')
+        self.assertEqual(self.breaker.state(), 'closed')
+
+    def test_bad_requests_are_raised(self):
+        def bad_request():
+            raise es_exceptions.RequestError(400, 'parsing_exception', {})
+        with self.assertRaises(es_exceptions.RequestError):
+            self.breaker.call(bad_request, lambda: 'db')
+        self.assertEqual(self.breaker.state(), 'closed')
+
+    def test_only_breaker_searches_fail_loudly(self):
+        backend = haystack_connections['default'].get_backend()
+        self.assertTrue(backend.silently_fail)
+        with search_backends.failing_loudly():
+            self.assertFalse(backend.silently_fail)
+        self.assertTrue(backend.silently_fail)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DatabaseGeoSearchTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        geo.engine.clear()
+        self.user = factories.UserFactory.create()
+        for i in range(12):
+            factories.TourPointFactory.create(
+                longitude=-25.4230441 + i * 0.01,
+                latitude=-49.3084172 + i * 0.01)
+        factories.TourPointFactory.create(owner=self.user, private=True)
+
+    def tearDown(self):
+        geo.engine.clear()
+
+    def test_same_results_as_the_memory_engine(self):
+        for user in (AnonymousUser(), self.user):
+            for after in (None, (3.0, 0)):
+                expected = geo.engine.search(-25.43, -49.28, 8, user,
+                                             limit=5, after=after)
+                results = geo.database.search(-25.43, -49.28, 8, user,
+                                              limit=5, after=after)
+                self.assertEqual([hit.pk for hit in results],
+                                 [hit.pk for hit in expected])
+                for hit, expected_hit in zip(results, expected):
+                    self.assertAlmostEqual(hit.distance.km,
+                                           expected_hit.distance.km, places=6)
+
+    def test_both_engines_search_across_the_antimeridian(self):
+        # (lat, lng) is (longitude, latitude), see `geo.point_of`
+        east = factories.TourPointFactory.create(
+            owner=self.user, longitude=0, latitude=179.99)
+        west = factories.TourPointFactory.create(
+            owner=self.user, longitude=0, latitude=-179.99)
+        for engine in (geo.engine, geo.database):
+            for lng in (179.995, -179.995):
+                results = engine.search(0, lng, 5, self.user)
+                self.assertEqual({hit.pk for hit in results},
+                                 {east.pk, west.pk})
+
+    def test_open_circuit_searches_postgres(self):
+        breaker.search_breaker.failed('half_open')
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('tourpoint-search-list'), {
+            'from': '-25.43,-49.28', 'km': 8})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [tourpoint['name'] for tourpoint in response.data['results']],
+            [hit.name for hit in geo.engine.search(
+                -25.43, -49.28, 8, self.user, limit=20)])
+        for tourpoint in response.data['results']:
+            self.assertEqual(set(tourpoint), {
+                'name', 'category', 'longitude', 'latitude', 'private',
+                'owner', 'distance'})
+
+
+@override_settings(SYNC_LAG=0)
+class DeltaSyncTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = factories.UserFactory.create()
+        self.other = factories.UserFactory.create()
+        self.client.force_login(self.user)
+        factories.TourPointFactory.create_batch(size=6, owner=self.other)
+
+    def sync(self, cursor='', **params):
+        params['since'] = cursor
+        response = self.client.get(reverse('tourpoint-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_first_sync_returns_every_visible_tour_point(self):
+        # nothing to remove from a client that has nothing yet
+        TourPoint.objects.filter(private=False).first().delete()
+        names, removed = [], []
+        data = self.sync(page_size=2)
+        while data['next']:
+            names.extend(tourpoint['name'] for tourpoint in data['results'])
+            removed.extend(data['removed'])
+            data = self.client.get(data['next']).data
+        names.extend(tourpoint['name'] for tourpoint in data['results'])
+        self.assertEqual(sorted(names), sorted(
+            TourPoint.objects.visible_to(self.user).values_list(
+                'name', flat=True)))
+        self.assertEqual(removed, [])
+
+    def test_sync_only_returns_the_changes(self):
+        cursor = self.sync()['cursor']
+        self.assertEqual(self.sync(cursor)['results'], [])
+
+        created = factories.TourPointFactory.create(
+            owner=self.user, private=False)
+        updated = TourPoint.objects.filter(
+            private=False, owner=self.other).first()
+        updated.name = 'Renamed'
+        updated.save()
+        data = self.sync(cursor)
+        self.assertEqual(
+            sorted(tourpoint['name'] for tourpoint in data['results']),
+            sorted([created.name, 'Renamed']))
+        self.assertEqual(data['removed'], [])
+        self.assertEqual(self.sync(data['cursor'])['results'], [])
+
+    def test_deleted_and_hidden_tour_points_are_removed(self):
+        deleted = factories.TourPointFactory.create(
+            owner=self.other, private=False)
+        hidden = factories.TourPointFactory.create(
+            owner=self.other, private=False)
+        cursor = self.sync()['cursor']
+        deleted_url = reverse('tourpoint-detail', args=[deleted.pk])
+        hidden_url = reverse('tourpoint-detail', args=[hidden.pk])
+        deleted.delete()
+        hidden.private = True
+        hidden.save()
+
+        data = self.sync(cursor)
+        self.assertEqual(data['results'], [])
+        self.assertEqual(
+            sorted(url.replace('http://testserver', '')
+                   for url in data['removed']),
+            sorted([deleted_url, hidden_url]))
+        # the owner still sees it
+        self.client.force_login(self.other)
+        data = self.sync(cursor)
+        self.assertEqual([tourpoint['name'] for tourpoint in data['results']],
+                         [hidden.name])
+
+    def test_tombstones_of_private_tour_points_stay_private(self):
+        cursor = self.sync()['cursor']
+        TourPoint.objects.filter(owner=self.other, private=True).delete()
+        self.assertEqual(self.sync(cursor)['removed'], [])
+
+    def test_expired_cursor_is_refused(self):
+        cursor = self.sync()['cursor']
+        with self.settings(SYNC_TOMBSTONE_MAX_AGE=0):
+            response = self.client.get(reverse('tourpoint-list'),
+                                       {'since': cursor})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
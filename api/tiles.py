@@ -0,0 +1,72 @@
+import hashlib
+import json
+import math
+from django.conf import settings
+
+
+def tile_of(lat, lng, zoom):
+    """
+    `(x, y)` of the web mercator tile holding a point at a zoom level.
+    """
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    x = int(math.floor((lng + 180.0) / 360.0 * n))
+    y = int(math.floor(
+        (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n))
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(zoom, x, y):
+    """
+    `(min_lat, min_lng, max_lat, max_lng)` of a tile.
+    """
+    n = 2 ** zoom
+
+    def lat_at(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * y / n))))
+
+    return (lat_at(y + 1), x * 360.0 / n - 180.0,
+            lat_at(y), (x + 1) * 360.0 / n - 180.0)
+
+
+def tile_scope(category, zoom, x, y):
+    return 'tile:%s:%s/%s/%s' % (category, zoom, x, y)
+
+
+def tile_scopes(tourpoint):
+    """
+    Scopes of the tiles holding a public tour point, one per zoom level.
+    """
+    if tourpoint.private:
+        return set()
+    # (lat, lng) is (longitude, latitude), see `geo.point_of`
+    lat, lng = tourpoint.longitude, tourpoint.latitude
+    return set(
+        tile_scope(tourpoint.category, zoom, *tile_of(lat, lng, zoom))
+        for zoom in range(settings.TILE_MIN_ZOOM, settings.TILE_MAX_ZOOM + 1))
+
+
+def tile_version(generations):
+    return hashlib.md5(
+        '.'.join(map(str, generations)).encode()).hexdigest()[:16]
+
+
+def render_tile(queryset, zoom, x, y):
+    """
+    GeoJSON of the tour points of `queryset` inside a tile, as bytes. The
+    edges follow `tile_of`, so every point is in exactly one tile.
+    """
+    min_lat, min_lng, max_lat, max_lng = tile_bounds(zoom, x, y)
+    rows = queryset.filter(
+        longitude__gt=min_lat, longitude__lte=max_lat,
+        latitude__gte=min_lng, latitude__lt=max_lng,
+    ).order_by('pk').values_list('pk', 'name', 'longitude', 'latitude')
+    return json.dumps({
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'id': pk,
+            'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+            'properties': {'name': name},
+        } for pk, name, lat, lng in rows],
+    }, separators=(',', ':')).encode()
@@ -1,38 +1,177 @@
-import datetime
+import time
 from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.utils import timezone
 from django.utils.encoding import force_text
+from rest_framework.reverse import reverse
 from rest_framework_extensions.key_constructor.constructors import (
     DefaultKeyConstructor
 )
 from rest_framework_extensions.key_constructor.bits import (
     KeyBitBase,
+    KwargsKeyBit,
     RetrieveSqlQueryKeyBit,
     ListSqlQueryKeyBit,
     PaginationKeyBit,
     QueryParamsKeyBit,
     UserKeyBit
 )
+from tourpoint.models import CATEGORIES, TourPointTombstone
+from api.tiles import tile_scopes
 
 
-class UpdatedAtKeyBit(KeyBitBase):
+GENERATION_KEY_PREFIX = 'api:generation:'
+MODIFIED_KEY_PREFIX = 'api:modified:'
+# Time of the last bump of any scope.
+LAST_WRITE_KEY = 'api:last-write'
+PK_PLACEHOLDER = '__pk__'
+
+
+def hyperlink_template(view_name, request, format=None):
+    """
+    Build the urls of `view_name` for many objects out of a single `reverse`,
+    returning a function from the primary key to the url. `format` is the
+    format suffix, as `HyperlinkedRelatedField` adds it.
+    """
+    prefix, suffix = reverse(
+        view_name, kwargs={'pk': PK_PLACEHOLDER}, request=request,
+        format=format).split(PK_PLACEHOLDER)
+    return lambda pk: '%s%s%s' % (prefix, pk, suffix)
+
+
+def _generation_seed():
+    """
+    Starting value for a generation counter. It comes from the clock, so a
+    counter recreated after a memcached eviction is always greater than any
+    value handed out before, and never brings back old cache keys.
+    """
+    return int(time.time() * 1000000)
+
+
+def get_versions(scopes):
+    """
+    Return the current generation of each scope, creating the missing ones,
+    and the last time any of them changed as a timestamp. It takes a single
+    cache round trip once the counters exist.
+    """
+    generation_keys = [GENERATION_KEY_PREFIX + scope for scope in scopes]
+    modified_keys = [MODIFIED_KEY_PREFIX + scope for scope in scopes]
+    values = cache.get_many(generation_keys + modified_keys)
+    missing = [key for key in generation_keys if key not in values]
+    if missing:
+        for key in missing:
+            cache.add(key, _generation_seed(), None)
+        values.update(cache.get_many(missing))
+    # A scope whose last change is unknown may have changed just now.
+    now = time.time()
+    for key in modified_keys:
+        if key not in values:
+            cache.add(key, now, None)
+            values[key] = now
+    generations = [values.get(key) or _generation_seed()
+                   for key in generation_keys]
+    return generations, max([values[key] for key in modified_keys] or [0])
+
+
+def get_generations(scopes):
+    """
+    Return the current generation of each scope, creating the missing ones.
+    """
+    return get_versions(scopes)[0]
+
+
+def get_request_versions(view_instance, request):
     """
-    Custom key bit to look for api_updated_at_timestamp key.
+    `get_versions` of the scopes of a view, looked up once per request.
+    Views list them on `get_cache_scopes`.
     """
-    def get_data(self, **kwargs):
-        key = 'api_updated_at_timestamp'
-        value = cache.get(key, None)
-        if not value:
-            value = datetime.datetime.utcnow()
-            cache.set(key, value=value)
-        return force_text(value)
+    versions = getattr(request, '_cache_versions', None)
+    if versions is None:
+        get_cache_scopes = getattr(view_instance, 'get_cache_scopes', None)
+        scopes = sorted(get_cache_scopes()) if get_cache_scopes else []
+        versions = request._cache_versions = get_versions(scopes)
+    return versions
+
+
+def bump_generations(scopes, modified=None):
+    """
+    Atomically increase the generation of each scope, invalidating every
+    cache key built on top of it, and record `modified`, a timestamp
+    defaulting to now, as their last change.
+    """
+    scopes = set(scopes)
+    for scope in scopes:
+        key = GENERATION_KEY_PREFIX + scope
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The counter is gone, a new seed is already ahead of it. If some
+            # other worker recreated it first just increment theirs.
+            if not cache.add(key, _generation_seed(), None):
+                cache.incr(key)
+    modified = modified or time.time()
+    values = dict((MODIFIED_KEY_PREFIX + scope, modified) for scope in scopes)
+    values[LAST_WRITE_KEY] = time.time()
+    cache.set_many(values, None)
+
+
+def last_write():
+    """
+    Time of the last `bump_generations`, None when unknown.
+    """
+    return cache.get(LAST_WRITE_KEY)
+
+
+def tourpoint_scopes(instance):
+    """
+    Scopes a tour point belongs to. Private tour points are only visible to
+    their owners, so they don't touch any public slice nor any map tile.
+    """
+    scopes = {'tourpoint:%s' % instance.pk, 'owner:%s' % instance.owner_id}
+    if not instance.private:
+        scopes.add('public:%s' % instance.category)
+        scopes.update(tile_scopes(instance))
+    return scopes
+
+
+def search_scopes(scopes):
+    """
+    The scopes search responses depend on, map tiles are rendered from the
+    database.
+    """
+    return set(scope for scope in scopes if not scope.startswith('tile:'))
+
+
+def visible_tourpoint_scopes(user):
+    """
+    Scopes covering every tour point a user is able to see. The `tourpoints`
+    scope covers all of them, it is only bumped by bulk loads.
+    """
+    if user.is_anonymous():
+        return ['tourpoints', 'public:restaurant']
+    scopes = ['public:%s' % category for category, _ in CATEGORIES]
+    scopes.extend(['tourpoints', 'owner:%s' % user.pk])
+    return scopes
+
+
+class GenerationKeyBit(KeyBitBase):
+    """
+    Custom key bit with the generations of the scopes the view depends on.
+    Views list them on `get_cache_scopes`.
+    """
+    def get_data(self, params, view_instance, view_method, request, args,
+                 kwargs):
+        generations, _ = get_request_versions(view_instance, request)
+        return force_text('.'.join(map(str, generations)))
 
 
 class CustomObjectKeyConstructor(DefaultKeyConstructor):
     """
-    Used to compute cache key for a single object.
+    Used to compute cache key for a single object. The generations are kept
+    along with the cached response, see `api.cache.cache_response`, so an
+    outdated response can still be found.
     """
     retrieve_sql = RetrieveSqlQueryKeyBit()
-    updated_at = UpdatedAtKeyBit()
     user = UserKeyBit()
 
 
@@ -42,21 +181,112 @@ class CustomListKeyConstructor(DefaultKeyConstructor):
     """
     list_sql = ListSqlQueryKeyBit()
     pagination = PaginationKeyBit()
-    updated_at = UpdatedAtKeyBit()
     user = UserKeyBit()
     all_query_params = QueryParamsKeyBit()
 
 
-def change_api_updated_at(sender=None, instance=None, *args, **kwargs):
+class CustomQueryKeyConstructor(DefaultKeyConstructor):
+    """
+    Used to compute cache key for responses built from the query parameters
+    alone, without a queryset.
+    """
+    user = UserKeyBit()
+    all_query_params = QueryParamsKeyBit()
+
+
+class CustomValidatorKeyConstructor(DefaultKeyConstructor):
+    """
+    Used to compute the ETag of any response. It never builds a queryset,
+    the generations already tell when the data changed.
+    """
+    kwargs = KwargsKeyBit()
+    generations = GenerationKeyBit()
+    user = UserKeyBit()
+    all_query_params = QueryParamsKeyBit()
+
+
+def remember_tourpoint_scopes(sender, instance=None, raw=False, *args,
+                              **kwargs):
     """
-    Set a new timestamp for the cache.
+    Keep the scopes an existing tour point belonged to before being saved, so
+    moving it to another slice invalidates both, and the state it was seen
+    in, for `record_tombstone`.
     """
+    if raw or instance.pk is None:
+        return
+    previous = sender.objects.filter(pk=instance.pk).first()
+    instance._previous_cache_scopes = (
+        tourpoint_scopes(previous) if previous else set())
+    instance._previous_state = (
+        (previous.category, previous.private) if previous else None)
+
 
-    cache.set('api_updated_at_timestamp', datetime.datetime.utcnow())
+def invalidate_tourpoint(sender=None, instance=None, *args, **kwargs):
+    """
+    Bump the generations of the scopes a tour point belongs to. A save
+    modifies them when the tour point was `updated`, a delete right now.
+    """
+    scopes = tourpoint_scopes(instance)
+    scopes.update(getattr(instance, '_previous_cache_scopes', ()))
+    modified = None
+    if kwargs.get('signal') is post_save:
+        modified = instance.updated.timestamp()
+    bump_generations(scopes, modified)
+
+
+def record_tombstone(sender=None, instance=None, raw=False, *args,
+                     **kwargs):
+    """
+    Record a tombstone for the clients syncing the tour points list when a
+    tour point is deleted, or when a save hides it from somebody: a public
+    one made private or moved out of the restaurants anonymous users see.
+    Its owner sees it whatever happens, and the save itself is synced.
+    """
+    if raw:
+        return
+    if kwargs.get('signal') is post_save:
+        previous = getattr(instance, '_previous_state', None)
+        if previous is None or previous[1]:
+            return
+        category, private = previous
+        if not instance.private and instance.category == category:
+            return
+        # same time as the update, so a sync never gets one without the other
+        removed = instance.updated
+    else:
+        category, private = instance.category, instance.private
+        removed = timezone.now()
+    TourPointTombstone.objects.create(
+        tourpoint_id=instance.pk, owner_id=instance.owner_id,
+        category=category, private=private, removed=removed)
+
+
+def invalidate_tourpoints(tourpoints):
+    """
+    Invalidate a batch of new tour points, bumping each owner and public
+    slice only once. Nothing could have cached them by id yet.
+    """
+    if not tourpoints:
+        return
+    scopes = set()
+    for tourpoint in tourpoints:
+        scopes.update(tourpoint_scopes(tourpoint))
+        scopes.discard('tourpoint:%s' % tourpoint.pk)
+    bump_generations(scopes, max(
+        tourpoint.updated for tourpoint in tourpoints).timestamp())
+
+
+def invalidate_user(sender=None, instance=None, *args, **kwargs):
+    """
+    Bump the generation of a user scope.
+    """
+    bump_generations(['user:%s' % instance.pk])
 
 
 default_object_cache_key_func = CustomObjectKeyConstructor()
 default_list_cache_key_func = CustomListKeyConstructor()
+default_query_cache_key_func = CustomQueryKeyConstructor()
+default_validator_func = CustomValidatorKeyConstructor()
 
-default_object_etag_func = default_object_cache_key_func
-default_list_etag_func = default_list_cache_key_func
+default_object_etag_func = default_validator_func
+default_list_etag_func = default_validator_func
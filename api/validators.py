@@ -8,3 +8,16 @@ def coodinates_validor(value):
         raise serializers.ValidationError(
             "The query parameter 'from' must be a comma separated latitude,"\
             "longitude .e.g. '-25.4230441,-49.3084172'.")
+
+
+def bbox_validator(value):
+    try:
+        min_lat, min_lng, max_lat, max_lng = map(float, value.split(','))
+    except:
+        raise serializers.ValidationError(
+            "The query parameter 'bbox' must be four comma separated values "\
+            "in the same order as 'from', the lower corner followed by the "\
+            "upper one .e.g. '-25.5,-49.4,-25.3,-49.1'.")
+    if min_lat > max_lat or min_lng > max_lng:
+        raise serializers.ValidationError(
+            "The lower corner of 'bbox' must come first.")
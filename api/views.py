@@ -1,26 +1,62 @@
+from collections import OrderedDict
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.core.cache import cache
+from django.db import transaction
+from django.http import (
+    HttpResponse,
+    HttpResponseNotModified,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from allauth.socialaccount.providers.facebook.views import FacebookOAuth2Adapter
 from rest_auth.registration.views import SocialLoginView
-from rest_framework import viewsets, permissions, views, mixins
+from rest_framework import viewsets, permissions, views, mixins, status
+from rest_framework.exceptions import (
+    NotAuthenticated,
+    NotFound,
+    ValidationError,
+)
 from rest_framework.response import Response
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.reverse import reverse
-from rest_framework_extensions.mixins import CacheResponseAndETAGMixin
-from rest_framework_extensions.cache.decorators import cache_response
-from rest_framework_extensions.etag.decorators import etag
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from drf_haystack.viewsets import HaystackGenericAPIView
 from drf_haystack.filters import HaystackGEOSpatialFilter, HaystackFilter
-from haystack.query import SQ
-from tourpoint.models import TourPoint
-from api import serializers
+from elasticsearch import TransportError
+from haystack.utils.geo import Point
+from tourpoint.models import CATEGORIES, TourPoint, TourPointTombstone
+from api import (
+    breaker,
+    cache_backends,
+    clusters,
+    export,
+    geo,
+    metrics,
+    search_cache,
+    serializers,
+    tiles,
+)
+from api.cache import cache_response, conditional_response
+from api.mixins import ConditionalCacheResponseMixin, TimedViewMixin
+from api.models import QueuedIndexUpdate
+from api.pagination import (
+    DistancePagination,
+    KeysetPagination,
+    SyncPagination,
+)
 from api.permissions import IsOwnerOrReadOnly
+from api.search_backends import DistanceSearchQuerySet
+from api.signals import enqueue
 from api.utils import (
-    default_object_cache_key_func,
     default_list_cache_key_func,
-    default_object_etag_func,
-    default_list_etag_func,
+    default_query_cache_key_func,
+    get_generations,
+    invalidate_tourpoints,
+    search_scopes,
+    tourpoint_scopes,
+    visible_tourpoint_scopes,
 )
 
 
@@ -45,8 +81,8 @@ class APIRootView(views.APIView):
 
     Returns a index with the main resources for this API.
     """
-    @etag()
-    @cache_response()
+    @conditional_response()
+    @cache_response(key_func=default_query_cache_key_func)
     def get(self, request, *args, **kwargs):
         data = {
             'users': reverse(
@@ -99,7 +135,8 @@ class FacebookLogin(SocialLoginView):
     adapter_class = FacebookOAuth2Adapter
 
 
-class TourPointViewSet(CacheResponseAndETAGMixin, mixins.CreateModelMixin,
+class TourPointViewSet(TimedViewMixin, ConditionalCacheResponseMixin,
+                       mixins.CreateModelMixin,
                        mixins.RetrieveModelMixin,
                        mixins.DestroyModelMixin,
                        mixins.ListModelMixin,
@@ -116,6 +153,37 @@ class TourPointViewSet(CacheResponseAndETAGMixin, mixins.CreateModelMixin,
 
     If the user is anonymous returns only public restaurants.
 
+    The list is paginated, newest first. Follow the `next` and `previous` \
+    links to move between pages and set `page_size` (up to 200) to change \
+    how many tour points come in each one.
+
+        {
+            "next": "http://localhost/api/v1/tourpoints/?cursor=MjAxNy0wNC0w...",
+            "previous": null,
+            "results": [...]
+        }
+
+    ### Sync GET: /api/<version\>/tourpoints/?since=<cursor\>
+
+    Returns only what changed since a previous sync, oldest change first: \
+    the tour points created or updated in `results` and the urls of the \
+    ones deleted or no longer visible in `removed`. Remove those first, \
+    then store the others.
+
+    Start with an empty `since` to get every tour point, then send the \
+    `cursor` of the last response each time. Follow `next` while it is set, \
+    up to `page_size` (at most 1000) changes come in each page.
+
+        {
+            "next": null,
+            "cursor": "MjAxNy0wNC0wM1QxOTozMDowMCswMDowMHwwfDA=",
+            "results": [...],
+            "removed": ["http://localhost/api/v1/tourpoints/7/"]
+        }
+
+    Cursors older than a month are refused with a 410 GONE, sync again from \
+    scratch then.
+
 
     ### Retrieve GET: /api/<version\>/tourpoints/<pk\>/
 
@@ -155,6 +223,21 @@ class TourPointViewSet(CacheResponseAndETAGMixin, mixins.CreateModelMixin,
             "private": false
         }
 
+    ### Bulk create POST: '/api/<version\>/tourpoints/'
+
+    Posting a list of tour points in the same format creates all of them at \
+    once. Either every tour point is created or none is, in which case the \
+    response is a list with the errors of each one, in the same order.
+
+    The response is the list of created tour points.
+
+    ### Export GET: /api/<version\>/tourpoints/export/?type=<ndjson|csv\>
+
+    Streams every tour point in the list, following the same rules, as \
+    newline delimited JSON (the default) or CSV. The response starts right \
+    away and is never built in memory, no matter how many tour points there \
+    are.
+
     ### Destroy DELETE: /api/<version\>/tourpoints/<pk\>/
 
     Authenticated users may also delete his own tour points.
@@ -168,20 +251,104 @@ class TourPointViewSet(CacheResponseAndETAGMixin, mixins.CreateModelMixin,
     queryset = TourPoint.objects.all()
     serializer_class = serializers.TourPointSerializer
     permission_classes = (IsOwnerOrReadOnly, IsAuthenticatedOrReadOnly)
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         """
         If a user is anonymous returns only, public restrautants, otherwise
         returns all public tour points and his own private ones.
         """
-        if self.request.user.is_anonymous():
-            queryset = self.queryset.filter(
-                category='restaurant', private=False)
-        else:
-            queryset = self.queryset.filter(
-                Q(Q(Q(private=True) & Q(
-                    owner=self.request.user)) | Q(private=False)))
-        return queryset
+        return self.queryset.visible_to(self.request.user)
+
+    def paginate_queryset(self, queryset):
+        """
+        Page through the visible tour points as the union of public and own
+        private ones, so each part is read from its own index.
+        """
+        branches = [
+            branch.values(*serializers.TourPointRowSerializer.values)
+            for branch in self.queryset.visible_branches(self.request.user)]
+        return self.paginator.paginate_branches(
+            branches, self.request, view=self)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Sync the changes when a cursor is given in `since`.
+        """
+        if SyncPagination.cursor_query_param in request.query_params:
+            return self.sync(request)
+        return super().list(request, *args, **kwargs)
+
+    def sync(self, request):
+        """
+        The changes of the visible tour points since the cursor. They are
+        neither cached nor validated, every client has its own cursor and
+        the answer moves with the clock.
+        """
+        paginator = SyncPagination()
+        branches = [
+            branch.values(*serializers.TourPointRowSerializer.values +
+                          ('updated',))
+            for branch in self.queryset.visible_branches(request.user)]
+        page = paginator.paginate_changes(
+            branches, TourPointTombstone.objects.visible_to(request.user),
+            request, view=self)
+        serializer = serializers.TourPointRowSerializer(
+            page, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
+
+    def get_serializer(self, *args, **kwargs):
+        """
+        Lists are read as `.values()` rows, serialized by the fast read only
+        serializer.
+        """
+        if self.action == 'list' and kwargs.get('many'):
+            return serializers.TourPointRowSerializer(
+                *args, context=self.get_serializer_context())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_cache_scopes(self):
+        """
+        A single tour point only depends on itself, a list depends on every
+        tour point the user can see.
+        """
+        if self.action == 'retrieve':
+            return ['tourpoints',
+                    'tourpoint:%s' % self.kwargs[self.lookup_field]]
+        return visible_tourpoint_scopes(self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        """
+        Create all the tour points at once when a list is posted.
+        """
+        if not isinstance(request.data, list):
+            return super().create(request, *args, **kwargs)
+        if len(request.data) > settings.TOURPOINT_BULK_CREATE_MAX_ITEMS:
+            raise ValidationError(
+                'Up to %d tour points may be created at once.' %
+                settings.TOURPOINT_BULK_CREATE_MAX_ITEMS)
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.perform_bulk_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @list_route()
+    def export(self, request):
+        """
+        Stream the visible tour points as NDJSON or CSV.
+        """
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in export.EXPORTS:
+            raise ValidationError({'type': ['Must be one of: %s.' % ', '.join(
+                sorted(export.EXPORTS))]})
+        stream, content_type = export.EXPORTS[export_type]
+        response = StreamingHttpResponse(
+            stream(self.get_queryset(), request), content_type=content_type)
+        response['Content-Disposition'] = (
+            'attachment; filename="tourpoints.%s"' % export_type)
+        # Let nginx pass the chunks through as they come.
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
     def perform_create(self, serializer):
         """
@@ -190,8 +357,26 @@ class TourPointViewSet(CacheResponseAndETAGMixin, mixins.CreateModelMixin,
         serializer.validated_data['owner'] = self.request.user
         super().perform_create(serializer)
 
-
-class UserViewSet(CacheResponseAndETAGMixin, mixins.RetrieveModelMixin,
+    def perform_bulk_create(self, serializer):
+        """
+        Insert the tour points without signals, queue them for the search
+        index in one go and invalidate the cache once for the whole batch.
+        """
+        with transaction.atomic():
+            tourpoints = serializer.save(owner=self.request.user)
+            enqueue(TourPoint, [tourpoint.pk for tourpoint in tourpoints],
+                    QueuedIndexUpdate.UPDATE, search_scopes(
+                        scope for tourpoint in tourpoints
+                        for scope in tourpoint_scopes(tourpoint)
+                        if not scope.startswith('tourpoint:')))
+        invalidate_tourpoints(tourpoints)
+        if geo.engine.loaded_at is not None:
+            for tourpoint in tourpoints:
+                geo.engine.update(tourpoint)
+
+
+class UserViewSet(TimedViewMixin, ConditionalCacheResponseMixin,
+                  mixins.RetrieveModelMixin,
                   mixins.ListModelMixin,
                   viewsets.GenericViewSet):
     """
@@ -206,7 +391,8 @@ class UserViewSet(CacheResponseAndETAGMixin, mixins.RetrieveModelMixin,
 
     ## List GET: /api/<version\>/users/<pk\>/tourpoints/
 
-    This resource returs a list with all tour points created by the user.
+    This resource returs a list with all tour points created by the user, \
+    paginated the same way as the tour points list.
 
     It is worth to notice that the user is reevaluated on the session, and
     the resource only returns information for the authenticated user.
@@ -223,9 +409,18 @@ class UserViewSet(CacheResponseAndETAGMixin, mixins.RetrieveModelMixin,
         """
         return get_user_model().objects.filter(id=self.request.user.pk)
 
-    @etag(default_list_etag_func)
+    def get_cache_scopes(self):
+        """
+        The tour points list depends on the user tour points, everything else
+        only on the user itself.
+        """
+        if self.action == 'tourpoints':
+            return ['tourpoints', 'owner:%s' % self.kwargs['pk']]
+        return ['user:%s' % self.request.user.pk]
+
+    @conditional_response()
     @cache_response(key_func=default_list_cache_key_func)
-    @detail_route()
+    @detail_route(pagination_class=KeysetPagination)
     def tourpoints(self, request, pk=None):
         """
         Custom action to list a user tour points.
@@ -233,19 +428,21 @@ class UserViewSet(CacheResponseAndETAGMixin, mixins.RetrieveModelMixin,
         tour points for that user, but it can be easily changed to return a
         list for a given user if we need to.
         """
-        tourpoints = self.get_object().tourpoints.all()
+        tourpoints = self.get_object().tourpoints.values(
+            *serializers.TourPointRowSerializer.values)
         page = self.paginate_queryset(tourpoints)
         if page is not None:
-            serializer = serializers.TourPointSerializer(
-                page, many=True, context={'request': request})
+            serializer = serializers.TourPointRowSerializer(
+                page, context=self.get_serializer_context())
             return self.get_paginated_response(serializer.data)
 
-        serializer = serializers.TourPointSerializer(
-            tourpoints, many=True, context={'request': request})
+        serializer = serializers.TourPointRowSerializer(
+            tourpoints, context=self.get_serializer_context())
         return Response(serializer.data)
 
 
-class TourPointLocationGeoSearchViewSet(CacheResponseAndETAGMixin,
+class TourPointLocationGeoSearchViewSet(TimedViewMixin,
+                                        ConditionalCacheResponseMixin,
                                         mixins.ListModelMixin,
                                         viewsets.ViewSetMixin,
                                         HaystackGenericAPIView):
@@ -259,10 +456,25 @@ class TourPointLocationGeoSearchViewSet(CacheResponseAndETAGMixin,
         from=-25.4230441,-49.3084172    # comma separated longitude and latitude 
         km=5                            # a radius distance in kilometers
 
+    The radius can't be larger than 50 km. Optionally:
+
+        limit=20        # how many tour points per page, up to 100
+        bbox=-25.5,-49.4,-25.3,-49.1    # only tour points in this box, \
+lower corner first in the same order as from
+
     ### Resonse
 
-    The response will be a list of tour point objects in the same format as \
-    follow.
+    The response is a page of the nearest tour points, closest first, and a \
+    link to the next page. Every page costs the same, however many tour \
+    points are in the radius.
+
+        {
+            "next": "http://localhost/api/v1/search/?cursor=MC40Mnw3",
+            "previous": null,
+            "results": [...]
+        }
+
+    Each tour point is in the same format as follow.
 
         {
             "name": "Melissa Wang",
@@ -282,6 +494,8 @@ class TourPointLocationGeoSearchViewSet(CacheResponseAndETAGMixin,
     If any query parameter is missing the response will be empty.
     """
     index_models = [TourPoint]
+    object_class = DistanceSearchQuerySet
+    pagination_class = DistancePagination
     serializer_class = serializers.TourPointLocationSerializer
     filter_backends = [HaystackGEOSpatialFilter, HaystackFilter]
 
@@ -296,20 +510,209 @@ class TourPointLocationGeoSearchViewSet(CacheResponseAndETAGMixin,
             data=self.request.query_params)
         params_serializer.is_valid(raise_exception=True)
 
+        params = params_serializer.validated_data
+        bbox = params.get('bbox')
+        if settings.GEO_SEARCH_ENGINE == 'memory':
+            lat, lng = geo.parse_point(params['from'])
+            return geo.GeoSearchResults(
+                geo.engine, lat, lng, params['km'], self.request.user,
+                bbox=bbox)
+
         # apply the super filter to the queryset, so now we have only objects
         # respecting the radius search.
         queryset = super().filter_queryset(queryset)
+        if bbox is not None:
+            min_lat, min_lng, max_lat, max_lng = bbox
+            queryset = queryset.within(
+                'coordinates', Point(min_lng, min_lat),
+                Point(max_lng, max_lat))
+        queryset = queryset.order_by('distance', 'tourpoint_id')
+        queryset = queryset.context_filter(*self.get_visibility_filters())
+
+        lat, lng = geo.parse_point(params['from'])
+        if settings.GEO_SEARCH_CACHE:
+            queryset = search_cache.QuantizedSearchResults(
+                queryset, lat, lng, params['km'], self.request.user,
+                bbox=bbox)
+        # Postgres answers the same search while Elasticsearch is down.
+        return breaker.FallbackSearchResults(queryset, geo.GeoSearchResults(
+            geo.database, lat, lng, params['km'], self.request.user,
+            bbox=bbox))
+
+    @conditional_response()
+    @cache_response(key_func=default_query_cache_key_func)
+    @list_route()
+    def clusters(self, request, *args, **kwargs):
+        """
+        ## Request GET: /api/<version\>/search/clusters/?bbox=<box\>&zoom=<zoom\>
+
+        Tour points counted per map cell, to draw clusters on zoomed out
+        maps without transferring every tour point.
+
+            bbox=-25.5,-49.4,-25.3,-49.1    # lower corner first, in the \
+same order as from
+            zoom=12                         # map zoom level, from 0 to 22
+
+        The higher the zoom the smaller the cells. Each cluster has the count \
+        of tour points per category and their centroid.
+
+            {
+                "precision": 5,
+                "clusters": [
+                    {
+                        "geohash": "6gkzw",
+                        "count": 12,
+                        "categories": {"restaurant": 5, "park": 7},
+                        "longitude": -25.4230441,
+                        "latitude": -49.3084172
+                    }
+                ]
+            }
 
+        Only the tour points the user is allowed to see are counted.
+        """
+        params_serializer = serializers.ClusterQueryParamsSerializer(
+            data=request.query_params)
+        params_serializer.is_valid(raise_exception=True)
+        bbox = params_serializer.validated_data['bbox']
+        precision = clusters.precision_for(
+            params_serializer.validated_data['zoom'])
+
+        cells = None
+        if settings.GEO_SEARCH_ENGINE == 'haystack':
+            try:
+                cells = breaker.search_breaker.call(
+                    lambda: clusters.es_clusters(
+                        bbox, precision, self.get_visibility_filters()),
+                    lambda: None)
+            except TransportError:
+                # Elasticsearch can't answer, Postgres can group them as well.
+                pass
+        if cells is None:
+            cells = clusters.db_clusters(
+                TourPoint.objects.visible_to(request.user), bbox, precision)
+        return Response(OrderedDict([
+            ('precision', precision),
+            ('clusters', cells),
+        ]))
+
+    def get_visibility_filters(self):
+        """
+        The anonymous and authenticated rules as Elasticsearch filters, run
+        in filter context so they are cached and never scored.
+        """
         # If a user is anonymous return only public restaurants
         if self.request.user.is_anonymous():
-                queryset = queryset.filter(
-                        category='restaurant', private='false')
+            return [{'term': {'category_exact': 'restaurant'}},
+                    {'term': {'private': False}}]
+        # If the user is authenticated show all public and his own tour
+        # points.
+        return [{'bool': {'should': [
+            {'term': {'private': False}},
+            {'term': {'owner_id': self.request.user.pk}}]}}]
+
+    def get_cache_timeout(self):
+        """
+        The memory engine may miss the writes served by other processes
+        until it reloads, so its results aren't kept any longer.
+        """
+        if settings.GEO_SEARCH_ENGINE == 'memory':
+            return geo.engine.max_age
+        return None
+
+    def get_cache_scopes(self):
+        """
+        Search results depend on every tour point the user can see.
+        """
+        return visible_tourpoint_scopes(self.request.user)
+
+
+class TileView(views.APIView):
+    """
+    ## Request GET: /api/<version\>/tiles/<category\>/<z\>/<x\>/<y\>/
+
+    The public tour points of a category inside a web mercator map tile, as \
+    GeoJSON. Tiles go from zoom 10 to 18, the \
+    [clusters](/api/v1/search/clusters/) cover the zoom levels further out.
+
+    Restaurant tiles are public, the others are only served to \
+    authenticated users.
+
+    Every tile has a version, sent as its ETag and in the `X-Tile-Version` \
+    header, which only changes when one of its tour points does. A tile url \
+    with `?v=<version>` never changes and may be cached forever, an \
+    outdated version redirects to the current one.
+
+        {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "id": 1,
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [-49.3084172, -25.4230441]
+                    },
+                    "properties": {"name": "Melissa Wang"}
+                }
+            ]
+        }
+    """
+
+    def get(self, request, category, zoom, x, y):
+        zoom, x, y = int(zoom), int(x), int(y)
+        if (category not in dict(CATEGORIES) or
+                not settings.TILE_MIN_ZOOM <= zoom <= settings.TILE_MAX_ZOOM or
+                x >= 2 ** zoom or y >= 2 ** zoom):
+            raise NotFound()
+        public = category == 'restaurant'
+        if not public and request.user.is_anonymous():
+            raise NotAuthenticated()
+
+        scope = tiles.tile_scope(category, zoom, x, y)
+        version = tiles.tile_version(get_generations(['tourpoints', scope]))
+        requested = request.query_params.get('v')
+        if requested is not None and requested != version:
+            response = HttpResponseRedirect(replace_query_param(
+                request.build_absolute_uri(), 'v', version))
+            response['Cache-Control'] = 'no-cache'
+            return response
+
+        etag = '"%s"' % version
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
         else:
-            # If the user is authenticated show all public and his own tour
-            # points.
-            queryset = queryset.filter(
-                    SQ(SQ(SQ(private='true') & SQ(
-                        owner=self.request.user.username)) | SQ(
-                            private='false')))
-        return queryset
+            key = 'api:tile:%s:%s' % (scope, version)
+            content = cache.get(key)
+            if content is None:
+                content = tiles.render_tile(TourPoint.objects.filter(
+                    category=category, private=False), zoom, x, y)
+                cache.set(key, content, None)
+            response = HttpResponse(content,
+                                    content_type='application/geo+json')
+        response['ETag'] = etag
+        response['X-Tile-Version'] = version
+        response['Cache-Control'] = '%s, max-age=%d%s' % (
+            'public' if public else 'private',
+            31536000 if requested else settings.TILE_MAX_AGE,
+            ', immutable' if requested else '')
+        return response
+
+
+class MetricsView(views.APIView):
+    """
+    ## Request GET: /api/<version\>/metrics/
 
+    Request timings of every endpoint as histograms, along with the cache,
+    geo search and circuit breaker counters, added up over every process,
+    and the state of the Elasticsearch circuit breaker, in the Prometheus
+    text format. Only for staff users.
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        return HttpResponse(
+            metrics.prometheus(cache_backends.METRICS + search_cache.METRICS +
+                               breaker.search_breaker.metrics) +
+            breaker.search_breaker.prometheus(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,52 @@
+import re
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.test import RequestFactory
+
+
+# A GET of the API answered with a 200 in the combined log format of nginx.
+ACCESS_LOG_REQUEST = re.compile(r'"GET (/api/\S*) HTTP/[0-9.]+" 200 ')
+
+
+def learn_requests(log_paths, top):
+    """
+    The `top` API urls requested the most in access logs.
+    """
+    counts = Counter()
+    for path in log_paths:
+        with open(path, errors='replace') as log:
+            for line in log:
+                match = ACCESS_LOG_REQUEST.search(line)
+                if match:
+                    counts[match.group(1)] += 1
+    return [url for url, _ in counts.most_common(top)]
+
+
+class Warmer(object):
+    """
+    Replays anonymous GET requests through the middlewares and the views, so
+    their responses are cached exactly as if a client had sent them.
+
+    Responses hold absolute urls, so the requests go to the host and scheme
+    clients use, `CACHE_WARMUP_HOST` and `CACHE_WARMUP_SECURE`.
+    """
+
+    def __init__(self):
+        self.handler = BaseHandler()
+        self.handler.load_middleware()
+        self.factory = RequestFactory(HTTP_HOST=settings.CACHE_WARMUP_HOST)
+
+    def warm(self, urls):
+        """
+        Request every url, returning `(url, status, seconds)` for each.
+        """
+        results = []
+        for url in urls:
+            started = time.time()
+            response = self.handler.get_response(self.factory.get(
+                url, secure=settings.CACHE_WARMUP_SECURE))
+            response.close()
+            results.append((url, response.status_code, time.time() - started))
+        return results
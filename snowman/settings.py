@@ -54,6 +54,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,7 +90,8 @@ WSGI_APPLICATION = 'snowman.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        # postgresql with the queries timed, see api.metrics
+        'ENGINE': 'api.postgresql',
         'NAME': 'snowman',
         'USER': 'snowman',
         'PASSWORD': 'Q4mAELAAw1BhZA==',
@@ -119,12 +121,16 @@ AUTH_PASSWORD_VALIDATORS = [
 
 AUTHENTICATION_BACKENDS = (
     # Needed to login by username in Django admin, regardless of `allauth`
-    'django.contrib.auth.backends.ModelBackend',
+    'api.authentication.CachedModelBackend',
 
     # `allauth` specific authentication methods, such as login by e-mail
-    'allauth.account.auth_backends.AuthenticationBackend',
+    'api.authentication.CachedAuthenticationBackend',
 )
 
+# Sessions, tokens and their users are read through the cache.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+AUTH_CACHE_TIMEOUT = 60 * 60
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.10/topics/i18n/
 
@@ -151,19 +157,74 @@ SITE_ID = 1
 
 HAYSTACK_CONNECTIONS = {
     'default': {
-        'ENGINE': 'haystack.backends.elasticsearch_backend.ElasticsearchSearchEngine',
+        'ENGINE': 'api.search_backends.FilterContextSearchEngine',
         'URL': 'http://search:9200',
         'INDEX_NAME': 'snowman',
     },
 }
 
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# Searches on Elasticsearch give up after SEARCH_TIMEOUT seconds. After
+# SEARCH_BREAKER_FAILURES timeouts or errors within SEARCH_BREAKER_WINDOW
+# seconds the circuit breaker opens and radius searches are answered by
+# Postgres for SEARCH_BREAKER_RESET seconds, then a single search tries
+# Elasticsearch again.
+SEARCH_TIMEOUT = 1.5
+SEARCH_BREAKER_FAILURES = 5
+SEARCH_BREAKER_WINDOW = 30
+SEARCH_BREAKER_RESET = 30
+
+# Changes are queued in the database and indexed in bulk by
+# `manage.py process_search_queue`, which waits for up to
+# SEARCH_QUEUE_BATCH_SIZE changes but never more than
+# SEARCH_QUEUE_MAX_STALENESS seconds.
+HAYSTACK_SIGNAL_PROCESSOR = 'api.signals.QueuedSignalProcessor'
+SEARCH_QUEUE_BATCH_SIZE = 500
+SEARCH_QUEUE_MAX_STALENESS = 5
+
+# Engine answering the radius search, 'haystack' for Elasticsearch or
+# 'memory' for the in process engine in api.geo. The memory engine buckets
+# points in cells of GEO_SEARCH_CELL_SIZE degrees. Every process catches up
+# with the writes served by the others when the generations are bumped, and
+# reloads it after GEO_SEARCH_MAX_AGE seconds, which also caps how long its
+# results are cached.
+GEO_SEARCH_ENGINE = 'haystack'
+GEO_SEARCH_CELL_SIZE = 0.25
+GEO_SEARCH_MAX_AGE = 300
+# Largest radius, in km, a search may ask for.
+GEO_SEARCH_MAX_KM = 50
+# Opt in cache of the searches on Elasticsearch. The point is snapped to a
+# geohash cell of GEO_SEARCH_CACHE_PRECISION characters and the radius to the
+# smallest of GEO_SEARCH_CACHE_RADII covering the whole search from anywhere
+# in the cell. The tour points of that cell are cached for
+# GEO_SEARCH_CACHE_TIMEOUT seconds, unless there are more than
+# GEO_SEARCH_CACHE_MAX_ROWS, and every request filters them on its own.
+GEO_SEARCH_CACHE = False
+GEO_SEARCH_CACHE_PRECISION = 6
+GEO_SEARCH_CACHE_RADII = (2, 5, 10, 20, 35, 60)
+GEO_SEARCH_CACHE_MAX_ROWS = 5000
+GEO_SEARCH_CACHE_TIMEOUT = 300
+
+# Map tiles of the public tour points are served from zoom TILE_MIN_ZOOM to
+# TILE_MAX_ZOOM, clusters cover the zoom levels below. Unversioned tile urls
+# are cached for TILE_MAX_AGE seconds, versioned ones forever.
+TILE_MIN_ZOOM = 10
+TILE_MAX_ZOOM = 18
+TILE_MAX_AGE = 60
 
 REST_SESSION_LOGIN = True
 
+# Bulk creation of tour points, the most tour points a single request may
+# post and how many go in each INSERT.
+TOURPOINT_BULK_CREATE_MAX_ITEMS = 10000
+TOURPOINT_BULK_CREATE_BATCH_SIZE = 1000
+
 REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
     )
@@ -175,10 +236,51 @@ if DEBUG:
     CACHES['default'] = {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
 else:
+    # Values read from memcached are kept by each worker for LOCAL_TIMEOUT
+    # seconds, so a bumped generation reaches every worker within that delay.
     CACHES['default'] = {
-        'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
-        'LOCATION': 'cache'}
-
+        'BACKEND': 'api.cache_backends.TwoTierCache',
+        'LOCATION': 'cache',
+        'OPTIONS': {
+            'REMOTE_BACKEND':
+                'django.core.cache.backends.memcached.PyLibMCCache',
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 1,
+        }}
+
+
+# Responses cached by api.cache.cache_response. An outdated response is
+# rebuilt by a single worker holding a lock for at most API_CACHE_LOCK_TIMEOUT
+# seconds, the others serve the outdated one for the first
+# API_CACHE_STALE_WINDOW seconds of the rebuild, then wait for the new one.
+API_CACHE_TIMEOUT = 60 * 15
+API_CACHE_LOCK_TIMEOUT = 10
+API_CACHE_STALE_WINDOW = 5
+
+# Request timings sent back in a Server-Timing header and added up into
+# per endpoint histograms, which each process adds to the shared counters every
+# API_METRICS_FLUSH_INTERVAL seconds.
+API_METRICS = True
+API_METRICS_FLUSH_INTERVAL = 10
+
+# Delta syncs of the tour points list leave the changes of the last SYNC_LAG
+# seconds for the next one, their transactions may still be running. It must
+# cover the time between setting `updated` and committing of any write.
+# Tombstones are pruned by the prune_tombstones command after
+# SYNC_TOMBSTONE_MAX_AGE seconds, older cursors must sync from scratch.
+SYNC_LAG = 5
+SYNC_TOMBSTONE_MAX_AGE = 60 * 60 * 24 * 30
+
+# Anonymous requests replayed by the warm_cache command, along with the ones
+# it learns from the access logs. Responses hold absolute urls, so they are
+# sent to the host and scheme clients use.
+CACHE_WARMUP_REQUESTS = [
+    '/api/v1/',
+    '/api/v1/tourpoints/',
+    '/api/v1/search/clusters/?bbox=-90,-180,90,180&zoom=2',
+]
+CACHE_WARMUP_HOST = 'localhost'
+CACHE_WARMUP_SECURE = False
 
 REST_FRAMEWORK_EXTENSIONS = {
     # 'DEFAULT_CACHE_RESPONSE_TIMEOUT': 60 * 15,
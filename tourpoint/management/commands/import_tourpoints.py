@@ -0,0 +1,219 @@
+import csv
+import io
+import json
+import sys
+import time
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from api.utils import bump_generations
+from tourpoint.models import CATEGORIES, TourPoint, TourPointTombstone
+
+
+COLUMNS = ('line', 'name', 'longitude', 'latitude', 'private', 'owner_id',
+           'category')
+BOOLEANS = {'true': True, '1': True, 'yes': True, 't': True,
+            'false': False, '0': False, 'no': False, 'f': False, '': False}
+STAGING_TABLE = 'tourpoint_import'
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Load tour points from a CSV or NDJSON file, upserting them by '
+            'name. Rows are validated and sent to Postgres in batches with '
+            'COPY, skipping signals; the search index and the cache are '
+            'refreshed once at the end. Columns are name, category, '
+            'longitude, latitude, private and optionally owner_id.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to load, '-' for stdin.")
+        parser.add_argument('--format', choices=('csv', 'ndjson'))
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument(
+            '--owner', help='Username owning the rows with no owner_id.')
+        parser.add_argument(
+            '--strict', action='store_true',
+            help='Stop at the first invalid row instead of skipping it.')
+        parser.add_argument(
+            '--no-reindex', action='store_true',
+            help="Don't rebuild the search index after loading.")
+
+    def handle(self, *args, **options):
+        self.strict = options['strict']
+        self.no_reindex = options['no_reindex']
+        self.default_owner = None
+        if options['owner']:
+            try:
+                self.default_owner = get_user_model().objects.get(
+                    username=options['owner']).pk
+            except get_user_model().DoesNotExist:
+                raise CommandError('No user named %s' % options['owner'])
+        self.owners = set()
+        self.categories = set(category for category, _ in CATEGORIES)
+
+        path = options['path']
+        file_format = options['format'] or (
+            'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+        source = sys.stdin if path == '-' else open(path, newline='')
+        started = time.time()
+        loaded = skipped = 0
+        try:
+            self.create_staging_table()
+            batch = []
+            for line, record in enumerate(self.read(source, file_format), 1):
+                try:
+                    batch.append(self.clean(line, record))
+                except InvalidRow as error:
+                    if self.strict:
+                        raise CommandError('Line %d: %s' % (line, error))
+                    self.stderr.write('Skipping line %d: %s' % (line, error))
+                    skipped += 1
+                    continue
+                if len(batch) == options['batch_size']:
+                    loaded += self.load(batch)
+                    batch = []
+                    self.stdout.write('%d tour points loaded' % loaded)
+            if batch:
+                loaded += self.load(batch)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        self.stdout.write('Loaded %d tour points in %.1fs, skipped %d' % (
+            loaded, time.time() - started, skipped))
+        if loaded:
+            self.refresh()
+
+    def read(self, source, file_format):
+        if file_format == 'csv':
+            return csv.DictReader(source)
+        return (json.loads(line) for line in source if line.strip())
+
+    def clean(self, line, record):
+        """
+        Validate a row, returning it as a tuple of `COLUMNS`.
+        """
+        try:
+            name = str(record['name']).strip()
+            category = record['category']
+            longitude = float(record['longitude'])
+            latitude = float(record['latitude'])
+            private = record.get('private', False)
+            owner_id = record.get('owner_id') or self.default_owner
+        except (KeyError, TypeError, ValueError) as error:
+            raise InvalidRow('missing or malformed %s' % error)
+        if not name or len(name) > 100:
+            raise InvalidRow('name must have from 1 to 100 characters')
+        if category not in self.categories:
+            raise InvalidRow('unknown category %r' % category)
+        if not (-180 <= longitude <= 180 and -180 <= latitude <= 180):
+            raise InvalidRow('coordinates out of range')
+        if not isinstance(private, bool):
+            try:
+                private = BOOLEANS[str(private).strip().lower()]
+            except KeyError:
+                raise InvalidRow('private must be a boolean')
+        if owner_id is None:
+            raise InvalidRow('no owner_id and no --owner given')
+        try:
+            owner_id = int(owner_id)
+        except (TypeError, ValueError):
+            raise InvalidRow('owner_id must be an integer')
+        return (line, name, longitude, latitude, private, owner_id, category)
+
+    def create_staging_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS {table} ('
+                'line bigint, name varchar(100), longitude double precision, '
+                'latitude double precision, private boolean, '
+                'owner_id integer, category varchar(10))'.format(
+                    table=STAGING_TABLE))
+
+    def check_owners(self, batch):
+        """
+        Drop the rows whose owners don't exist, looking each one up once.
+        """
+        unknown = set(row[5] for row in batch) - self.owners
+        if unknown:
+            self.owners.update(get_user_model().objects.filter(
+                pk__in=unknown).values_list('pk', flat=True))
+        valid = [row for row in batch if row[5] in self.owners]
+        for row in batch:
+            if row[5] not in self.owners:
+                if self.strict:
+                    raise CommandError('Line %d: no user with id %d' % (
+                        row[0], row[5]))
+                self.stderr.write('Skipping line %d: no user with id %d' % (
+                    row[0], row[5]))
+        return valid
+
+    def load(self, batch):
+        """
+        COPY a batch into the staging table and upsert it on `name`. When a
+        name repeats in the batch the last row wins.
+
+        The upsert records the tombstones `api.utils.record_tombstone` would,
+        comparing with the rows as they were before it. It is the last
+        statement of the transaction and stamps `updated` with the clock
+        instead of the transaction start, which the COPY pushes back, so
+        delta syncs don't skip the rows before they are committed.
+        """
+        batch = self.check_owners(batch)
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('TRUNCATE {staging}'.format(staging=STAGING_TABLE))
+            cursor.copy_expert(
+                'COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)'.format(
+                    staging=STAGING_TABLE, columns=', '.join(COLUMNS)),
+                buffer)
+            cursor.execute(
+                'WITH previous AS ('
+                'SELECT id, owner_id, category, private FROM {table} '
+                'WHERE name IN (SELECT name FROM {staging})'
+                '), upserted AS ('
+                'INSERT INTO {table} (name, longitude, latitude, private, '
+                'owner_id, category, created, updated) '
+                'SELECT DISTINCT ON (name) name, longitude, latitude, '
+                'private, owner_id, category, now(), clock_timestamp() '
+                'FROM {staging} ORDER BY name, line DESC '
+                'ON CONFLICT (name) DO UPDATE SET '
+                'longitude = EXCLUDED.longitude, '
+                'latitude = EXCLUDED.latitude, private = EXCLUDED.private, '
+                'owner_id = EXCLUDED.owner_id, category = EXCLUDED.category, '
+                'updated = EXCLUDED.updated '
+                'RETURNING id, owner_id, category, private, updated'
+                '), tombstones AS ('
+                # public tour points made private or moved out of the
+                # restaurants anonymous users see, and private ones given to
+                # another owner
+                'INSERT INTO {tombstones} (tourpoint_id, owner_id, category, '
+                'private, removed) '
+                'SELECT previous.id, previous.owner_id, previous.category, '
+                'previous.private, upserted.updated '
+                'FROM previous JOIN upserted ON upserted.id = previous.id '
+                'WHERE (NOT previous.private AND (upserted.private OR '
+                'upserted.category <> previous.category)) OR '
+                '(previous.private AND '
+                'upserted.owner_id <> previous.owner_id)'
+                ') SELECT count(*) FROM upserted'.format(
+                    table=TourPoint._meta.db_table, staging=STAGING_TABLE,
+                    tombstones=TourPointTombstone._meta.db_table))
+            loaded = cursor.fetchone()[0]
+        return loaded
+
+    def refresh(self):
+        """
+        Bring the cache and the search index up to date with what was loaded,
+        once for the whole file.
+        """
+        bump_generations(['tourpoints'])
+        if not self.no_reindex:
+            call_command('reindex_tourpoints', new_index=True,
+                         stdout=self.stdout, stderr=self.stderr)
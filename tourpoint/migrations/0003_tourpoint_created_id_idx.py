@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tourpoint', '0002_auto_20170403_1930'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tourpoint',
+            index=models.Index(fields=['created', 'id'], name='tourpoint_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('tourpoint', '0003_tourpoint_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY tourpoint_owner_private_idx '
+            'ON tourpoint_tourpoint (owner_id, private, created, id);',
+            reverse_sql='DROP INDEX IF EXISTS tourpoint_owner_private_idx;',
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='tourpoint',
+                    index=models.Index(fields=['owner', 'private', 'created', 'id'], name='tourpoint_owner_private_idx'),
+                ),
+            ],
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY tourpoint_lat_lng_idx '
+            'ON tourpoint_tourpoint (latitude, longitude);',
+            reverse_sql='DROP INDEX IF EXISTS tourpoint_lat_lng_idx;',
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='tourpoint',
+                    index=models.Index(fields=['latitude', 'longitude'], name='tourpoint_lat_lng_idx'),
+                ),
+            ],
+        ),
+        # public tour points, as seen by authenticated users
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY tourpoint_public_created_idx '
+            'ON tourpoint_tourpoint (created, id) WHERE NOT private;',
+            reverse_sql='DROP INDEX IF EXISTS tourpoint_public_created_idx;',
+        ),
+        # public tour points by category, as seen by anonymous users
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY tourpoint_public_category_idx '
+            'ON tourpoint_tourpoint (category, created, id) WHERE NOT private;',
+            reverse_sql='DROP INDEX IF EXISTS tourpoint_public_category_idx;',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tourpoint', '0004_visibility_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TourPointTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tourpoint_id', models.IntegerField()),
+                ('owner_id', models.IntegerField()),
+                ('category', models.CharField(choices=[('restaurant', 'restaurant'), ('museum', 'museum'), ('park', 'park')], max_length=10)),
+                ('private', models.BooleanField(default=False)),
+                ('removed', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tourpointtombstone',
+            index=models.Index(fields=['removed', 'id'], name='tombstone_removed_id_idx'),
+        ),
+    ]
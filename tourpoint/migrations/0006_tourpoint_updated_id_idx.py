@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('tourpoint', '0005_delta_sync'),
+    ]
+
+    operations = [
+        # IF NOT EXISTS, 0005 used to create it as well
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS tourpoint_updated_id_idx '
+            'ON tourpoint_tourpoint (updated, id);',
+            reverse_sql='DROP INDEX IF EXISTS tourpoint_updated_id_idx;',
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='tourpoint',
+                    index=models.Index(fields=['updated', 'id'], name='tourpoint_updated_id_idx'),
+                ),
+            ],
+        ),
+    ]
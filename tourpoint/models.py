@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from haystack.utils.geo import Point
 
 
@@ -10,6 +11,29 @@ CATEGORIES = (
 )
 
 
+class TourPointQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Anonymous users only see public restaurants, everybody else sees all
+        public tour points and his own private ones.
+        """
+        if user.is_anonymous():
+            return self.filter(category='restaurant', private=False)
+        return self.filter(
+            models.Q(private=False) | models.Q(private=True, owner=user))
+
+    def visible_branches(self, user):
+        """
+        The same tour points as `visible_to` split into disjoint querysets,
+        each one matching a single index, to be combined with UNION ALL.
+        """
+        if user.is_anonymous():
+            return [self.filter(category='restaurant', private=False)]
+        return [self.filter(private=False),
+                self.filter(private=True, owner=user)]
+
+
 class TourPoint(models.Model):
     """
     A Tour Point created by users.
@@ -33,9 +57,68 @@ class TourPoint(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = TourPointQuerySet.as_manager()
+
+    class Meta:
+        # The partial indexes on public tour points live in migration 0004,
+        # since they can't be declared here.
+        indexes = [
+            # keyset pagination
+            models.Index(fields=['created', 'id'],
+                         name='tourpoint_created_id_idx'),
+            # delta sync
+            models.Index(fields=['updated', 'id'],
+                         name='tourpoint_updated_id_idx'),
+            # owner tour points, private ones included
+            models.Index(fields=['owner', 'private', 'created', 'id'],
+                         name='tourpoint_owner_private_idx'),
+            # bounding boxes
+            models.Index(fields=['latitude', 'longitude'],
+                         name='tourpoint_lat_lng_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
     @property
     def coordinates(self):
-        return Point(self.latitude,self.longitude)
\ No newline at end of file
+        return Point(self.latitude,self.longitude)
+
+
+class TombstoneQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Tombstones of the tour points a user was able to see, following the
+        same rules as `TourPointQuerySet.visible_to` on their last state.
+        """
+        if user.is_anonymous():
+            return self.filter(category='restaurant', private=False)
+        return self.filter(
+            models.Q(private=False) | models.Q(private=True, owner_id=user.pk))
+
+
+class TourPointTombstone(models.Model):
+    """
+    A tour point that was deleted, or that some users can't see anymore,
+    kept for the clients syncing the list to remove it.
+
+    `category` and `private` hold the last state those users saw. The owner
+    is only kept as an id, tombstones outlive their users.
+    """
+    tourpoint_id = models.IntegerField()
+    owner_id = models.IntegerField()
+    category = models.CharField(choices=CATEGORIES, max_length=10)
+    private = models.BooleanField(default=False)
+    removed = models.DateTimeField(default=timezone.now)
+
+    objects = TombstoneQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['removed', 'id'],
+                         name='tombstone_removed_id_idx'),
+        ]
+
+    def __str__(self):
+        return 'tour point %s' % self.tourpoint_id
\ No newline at end of file
@@ -1,3 +1,94 @@
+import io
+import tempfile
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.test import TestCase
+from tourpoint.models import TourPoint, TourPointTombstone
 
-# Create your tests here.
+
+class ImportTourPointsTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='importer')
+
+    def import_file(self, content, suffix='.csv'):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix) as source:
+            source.write(content)
+            source.flush()
+            call_command('import_tourpoints', source.name, owner='importer',
+                         no_reindex=True, stdout=io.StringIO(),
+                         stderr=io.StringIO())
+
+    def test_import_csv_upserts_by_name(self):
+        self.import_file(
+            'name,category,longitude,latitude,private\n'
+            'Barigui Park,park,-25.42,-49.31,false\n'
+            'Madalosso,restaurant,-25.37,-49.26,false\n'
+            'Barigui Park,park,-25.43,-49.32,true\n'
+            'Nowhere,beach,0,0,false\n')
+        self.assertEqual(TourPoint.objects.count(), 2)
+        park = TourPoint.objects.get(name='Barigui Park')
+        self.assertEqual(park.longitude, -25.43)
+        self.assertTrue(park.private)
+        self.assertEqual(park.owner, self.user)
+
+        self.import_file(
+            '{"name": "Barigui Park", "category": "park", '
+            '"longitude": -25.44, "latitude": -49.33, "private": false}\n',
+            suffix='.ndjson')
+        self.assertEqual(TourPoint.objects.count(), 2)
+        park.refresh_from_db()
+        self.assertEqual(park.longitude, -25.44)
+        self.assertFalse(park.private)
+
+    def test_import_records_tombstones_of_hidden_tour_points(self):
+        self.import_file(
+            'name,category,longitude,latitude,private\n'
+            'Barigui Park,park,-25.42,-49.31,false\n'
+            'Madalosso,restaurant,-25.37,-49.26,false\n'
+            'Secret Garden,park,-25.40,-49.30,true\n')
+        self.assertFalse(TourPointTombstone.objects.exists())
+
+        self.import_file(
+            'name,category,longitude,latitude,private\n'
+            'Barigui Park,park,-25.42,-49.31,true\n'
+            'Madalosso,museum,-25.37,-49.26,false\n'
+            'Secret Garden,park,-25.40,-49.30,false\n')
+        tombstones = dict(
+            (tombstone.tourpoint_id, tombstone)
+            for tombstone in TourPointTombstone.objects.all())
+        park = TourPoint.objects.get(name='Barigui Park')
+        restaurant = TourPoint.objects.get(name='Madalosso')
+        self.assertEqual(set(tombstones), {park.pk, restaurant.pk})
+        self.assertEqual(tombstones[park.pk].category, 'park')
+        self.assertFalse(tombstones[park.pk].private)
+        self.assertEqual(tombstones[park.pk].removed, park.updated)
+        self.assertEqual(tombstones[restaurant.pk].category, 'restaurant')
+
+    def test_import_records_tombstones_of_private_tour_points_given_away(
+            self):
+        other = get_user_model().objects.create_user(username='other')
+        self.import_file(
+            'name,category,longitude,latitude,private\n'
+            'Secret Garden,park,-25.40,-49.30,true\n')
+        self.import_file(
+            '{"name": "Secret Garden", "category": "park", '
+            '"longitude": -25.40, "latitude": -49.30, "private": true, '
+            '"owner_id": %d}\n'
+            '{"name": "Tingui Park", "category": "park", '
+            '"longitude": -25.41, "latitude": -49.31, "owner_id": [1]}\n'
+            % other.pk, suffix='.ndjson')
+        garden = TourPoint.objects.get()
+        self.assertEqual(garden.owner, other)
+        tombstone = TourPointTombstone.objects.get()
+        self.assertEqual(tombstone.tourpoint_id, garden.pk)
+        self.assertEqual(tombstone.owner_id, self.user.pk)
+        self.assertTrue(tombstone.private)
+
+    def test_import_stamps_updated_after_the_copy(self):
+        self.import_file(
+            'name,category,longitude,latitude,private\n'
+            'Barigui Park,park,-25.42,-49.31,false\n')
+        park = TourPoint.objects.get(name='Barigui Park')
+        # created is the start of the transaction
+        self.assertGreater(park.updated, park.created)